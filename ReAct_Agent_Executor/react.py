@@ -1,7 +1,8 @@
 from dotenv import load_dotenv
 from langchain_core.tools import tool
 from langchain_openai import ChatOpenAI
-from langchain_tavily import TavilySearch
+
+from search_cache import CachedTavilySearch
 
 load_dotenv()
 
@@ -13,7 +14,8 @@ def triple(num:float) -> float:
     """
     return float(num) * 3
 
-tools = [TavilySearch(max_results=1), triple]
+# the search tool keeps its name and schema, repeated queries are answered from the search cache
+tools = [CachedTavilySearch(max_results=1), triple]
 
 # initialize a chat open AI and bind tools method and supply the tools that we already wrote.
 # link chain is going to take the tool descriptions and it's going to send that to the LM.
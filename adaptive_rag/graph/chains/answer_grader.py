@@ -1,8 +1,11 @@
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnableSequence
+from langchain_core.runnables import Runnable
 from langchain_openai import ChatOpenAI
 from pydantic import BaseModel, Field
 
+from graph.chains.micro_batch import MicroBatcher, batch_schema
+from graph.chains.verdict_cache import CachedGrader, prompt_version
+
 
 class GradeAnswer(BaseModel):
 
@@ -14,6 +17,7 @@ class GradeAnswer(BaseModel):
 # answer answers the questions or not.
 llm = ChatOpenAI(temperature=0)
 structured_llm_grader = llm.with_structured_output(GradeAnswer)
+structured_llm_batch_grader = llm.with_structured_output(batch_schema(GradeAnswer))
 
 system = """You are a grader assessing whether an answer addresses / resolves a question \n 
      Give a binary score 'yes' or 'no'. Yes' means that the answer resolves the question."""
@@ -25,4 +29,11 @@ answer_prompt = ChatPromptTemplate.from_messages(
 )
 # So eventually we'll get back here an object of the Grade Answer class, which will have the information
 # of true or false, whether it answered the question or not.
-answer_grader: RunnableSequence = answer_prompt | structured_llm_grader
+# verdicts are memoized per question and generation, see verdict_cache
+# cache misses of concurrent requests are graded together in one call, see micro_batch
+answer_grader: Runnable = CachedGrader(
+    "answer_grader",
+    MicroBatcher(answer_prompt, structured_llm_grader, structured_llm_batch_grader, GradeAnswer),
+    GradeAnswer,
+    prompt_version(answer_prompt, GradeAnswer.model_json_schema(), llm.model_name),
+)
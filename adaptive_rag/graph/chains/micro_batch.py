@@ -0,0 +1,164 @@
+import asyncio
+import os
+from typing import Any, Dict, List, Optional, Set, Tuple, Type
+
+from dotenv import load_dotenv
+from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.runnables import Runnable, RunnableConfig
+from pydantic import BaseModel, Field, create_model
+
+load_dotenv()
+
+# When server.py answers many questions at once, their grader calls arrive within milliseconds of
+# each other, each one a separate LLM request that repeats the grader's instructions. A MicroBatcher
+# holds the async calls to a grader for up to GRADER_BATCH_WINDOW_MS, or until max_size calls are
+# waiting, and grades them together in one structured output call: every call becomes a numbered
+# item with its own question and document (or generation), and the list of scores that comes back is
+# split again so every caller gets its own verdict. Sync calls are not batched, a single question in
+# a script has nothing to batch with. Set GRADER_BATCH_WINDOW_MS=0 to disable.
+GRADER_BATCH_WINDOW_MS = float(os.getenv("GRADER_BATCH_WINDOW_MS", 5))
+GRADER_BATCH_MAX_SIZE = int(os.getenv("GRADER_BATCH_MAX_SIZE", 16))
+
+BATCH_INSTRUCTIONS = """\n
+    You are given several numbered items, each with its own inputs. Grade every item on its own, as if it were the only one. \n
+    Give one score per item, in the same order as the items."""
+
+_Pending = Tuple[Any, Optional[RunnableConfig], "asyncio.Future[Any]"]
+
+
+def batch_schema(schema: Type[BaseModel]) -> Type[BaseModel]:
+    """
+    The structured output class of a batched call: one binary_score of schema per item.
+
+    Args:
+        schema (Type[BaseModel]): Structured output class of the grader, with a binary_score field
+
+    Returns:
+        Type[BaseModel]: A class with a binary_scores list of the same type
+    """
+    field = schema.model_fields["binary_score"]
+    return create_model(
+        f"{schema.__name__}Batch",
+        __doc__=f"{schema.__doc__ or ''} One score per numbered item.".strip(),
+        binary_scores=(
+            List[field.annotation],
+            Field(
+                description=f"One score per item, in the order of the items: {field.description}"
+            ),
+        ),
+    )
+
+
+class MicroBatcher(Runnable[Dict[str, Any], BaseModel]):
+    """Grades concurrent ainvoke calls to a grader together in one structured output call."""
+
+    def __init__(
+        self,
+        prompt: Runnable,
+        structured_llm: Runnable,
+        structured_batch_llm: Runnable,
+        schema: Type[BaseModel],
+        window_ms: float = GRADER_BATCH_WINDOW_MS,
+        max_size: int = GRADER_BATCH_MAX_SIZE,
+    ) -> None:
+        """
+        Args:
+            prompt (Runnable): The grader's prompt, a system message followed by one human message
+            structured_llm (Runnable): The LLM with structured output of schema, for single calls
+            structured_batch_llm (Runnable): The LLM with structured output of batch_schema(schema)
+            schema (Type[BaseModel]): The grader's structured output class
+            window_ms (float): Milliseconds the first call of a batch waits for others to join it
+            max_size (int): Calls in a batch, a full batch is sent without waiting for the window
+        """
+        self.prompt = prompt
+        self.chain = prompt | structured_llm
+        self.structured_batch_llm = structured_batch_llm
+        self.schema = schema
+        self.window_ms = window_ms
+        self.max_size = max_size
+        self.batches = 0
+        self.calls = 0
+        # one open batch per event loop, so the batcher works under any loop that calls the grader
+        self._pending: Dict[asyncio.AbstractEventLoop, List[_Pending]] = {}
+        self._timers: Dict[asyncio.AbstractEventLoop, asyncio.TimerHandle] = {}
+        # the event loop only keeps weak references to tasks
+        self._dispatching: Set[asyncio.Task] = set()
+
+    def get_input_schema(self, config: Optional[RunnableConfig] = None) -> Type[BaseModel]:
+        return self.chain.get_input_schema(config)
+
+    def get_output_schema(self, config: Optional[RunnableConfig] = None) -> Type[BaseModel]:
+        return self.chain.get_output_schema(config)
+
+    def invoke(
+        self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> BaseModel:
+        return self.chain.invoke(input, config, **kwargs)
+
+    async def ainvoke(
+        self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> BaseModel:
+        if self.window_ms <= 0:
+            return await self.chain.ainvoke(input, config, **kwargs)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.setdefault(loop, [])
+        batch.append((input, config, future))
+        if len(batch) >= self.max_size:
+            self._flush(loop)
+        elif len(batch) == 1:
+            self._timers[loop] = loop.call_later(self.window_ms / 1000, self._flush, loop)
+        return await future
+
+    def _flush(self, loop: asyncio.AbstractEventLoop) -> None:
+        timer = self._timers.pop(loop, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(loop, [])
+        if batch:
+            task = loop.create_task(self._dispatch(batch))
+            self._dispatching.add(task)
+            task.add_done_callback(self._dispatching.discard)
+
+    async def _grade_together(self, inputs: List[Dict[str, Any]]) -> List[BaseModel]:
+        prompts = await self.prompt.abatch(inputs)
+        messages = [prompt.to_messages() for prompt in prompts]
+        # the instructions are the same for every item, the human messages carry the inputs
+        system = messages[0][0].content + BATCH_INSTRUCTIONS
+        items = "\n\n".join(
+            f"Item {i}:\n{item[-1].content}" for i, item in enumerate(messages, start=1)
+        )
+        scores = await self.structured_batch_llm.ainvoke(
+            [SystemMessage(content=system), HumanMessage(content=items)]
+        )
+        if len(scores.binary_scores) != len(inputs):
+            raise ValueError(f"{len(scores.binary_scores)} scores for {len(inputs)} items")
+        return [self.schema(binary_score=score) for score in scores.binary_scores]
+
+    async def _dispatch(self, batch: List[_Pending]) -> None:
+        self.batches += 1
+        self.calls += len(batch)
+        inputs = [input for input, _, _ in batch]
+        results: List[Any] = []
+        if len(batch) > 1:
+            try:
+                results = await self._grade_together(inputs)
+            except Exception as e:
+                # one item the model couldn't grade must not fail the other requests
+                print(f"---BATCHED GRADING FAILED ({e}), GRADING ONE BY ONE---")
+        if not results:
+            # every call keeps its own config, so callbacks and tracing still belong to its request;
+            # the batch is bounded by max_size, not by the concurrency limit of whichever came first
+            configs = [
+                {k: v for k, v in (config or {}).items() if k != "max_concurrency"}
+                for _, config, _ in batch
+            ]
+            results = await self.chain.abatch(inputs, configs, return_exceptions=True)
+        for (_, _, future), result in zip(batch, results):
+            # the caller's request may have been cancelled while the batch ran
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
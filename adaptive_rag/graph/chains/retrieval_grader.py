@@ -1,7 +1,13 @@
+from typing import List
+
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI
 from pydantic import BaseModel, Field
 
+from graph.chains.micro_batch import MicroBatcher, batch_schema
+from graph.chains.serialize import SERIALIZER_VERSION
+from graph.chains.verdict_cache import CachedGrader, prompt_version
+
 llm = ChatOpenAI(temperature=0)
 
 # use structured output from our LLM and turning it into a Pydantic object that will have the information whether this document
@@ -16,6 +22,7 @@ class GradeDocuments(BaseModel):
 
 
 structured_llm_grader = llm.with_structured_output(GradeDocuments)
+structured_llm_batch_grader = llm.with_structured_output(batch_schema(GradeDocuments))
 
 system = """You are a grader assessing relevance of a retrieved document to a user question. \n 
     If the document contains keyword(s) or semantic meaning related to the question, grade it as relevant. \n
@@ -27,4 +34,46 @@ grade_prompt = ChatPromptTemplate.from_messages(
     ]
 )
 
-retrieval_grader = grade_prompt | structured_llm_grader
+# verdicts are memoized per question and document, see verdict_cache
+# cache misses of concurrent requests are graded together in one call, see micro_batch
+retrieval_grader = CachedGrader(
+    "retrieval_grader",
+    MicroBatcher(grade_prompt, structured_llm_grader, structured_llm_batch_grader, GradeDocuments),
+    GradeDocuments,
+    prompt_version(grade_prompt, GradeDocuments.model_json_schema(), llm.model_name),
+)
+
+
+# Listwise mode: grade all retrieved documents in one structured output call instead of one call
+# per document, so the system prompt is sent once and the node waits for a single round trip.
+class GradeDocumentList(BaseModel):
+    """Binary scores for relevance check on a numbered list of retrieved documents."""
+
+    binary_scores: List[str] = Field(
+        description="One score per document, in the order of the documents: relevant to the question, 'yes' or 'no'"
+    )
+
+
+structured_llm_list_grader = llm.with_structured_output(GradeDocumentList)
+
+list_system = """You are a grader assessing relevance of retrieved documents to a user question. \n
+    The documents are numbered. For each document, if it contains keyword(s) or semantic meaning related to the question, grade it as relevant. \n
+    Give one binary score 'yes' or 'no' per document, in the same order as the documents, to indicate whether it is relevant to the question."""
+list_grade_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", list_system),
+        ("human", "Retrieved documents: \n\n {documents} \n\n User question: {question}"),
+    ]
+)
+
+list_retrieval_grader = CachedGrader(
+    "list_retrieval_grader",
+    list_grade_prompt | structured_llm_list_grader,
+    GradeDocumentList,
+    prompt_version(
+        list_grade_prompt,
+        GradeDocumentList.model_json_schema(),
+        llm.model_name,
+        SERIALIZER_VERSION,
+    ),
+)
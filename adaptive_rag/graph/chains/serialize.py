@@ -0,0 +1,53 @@
+from typing import Sequence, Union
+
+from langchain_core.documents import Document
+from langchain_core.prompts import BasePromptTemplate
+from langchain_core.runnables import Runnable, RunnablePassthrough
+
+# A list of Documents put straight into a prompt is rendered with its repr, so the LLM was reading
+# page_content='...' with escaped newlines and the whole metadata dict of every chunk. The chains
+# render documents as numbered plain-text blocks instead, with whitespace collapsed:
+#   [1] first document text
+#   [2] (source: https://...) second document text
+# Changing the format changes what the graders see, so it is part of their cache version.
+SERIALIZER_VERSION = "numbered-v1"
+
+
+def format_documents(documents: Sequence[Union[Document, str]], with_sources: bool = False) -> str:
+    """
+    Render documents as compact numbered blocks.
+
+    Args:
+        documents (Sequence[Union[Document, str]]): Documents, or their texts
+        with_sources (bool): Put the "source" metadata of each document in front of its text
+
+    Returns:
+        str: One "[n] text" block per document, separated by blank lines
+    """
+    blocks = []
+    for i, document in enumerate(documents, start=1):
+        text = document.page_content if isinstance(document, Document) else document
+        source = document.metadata.get("source") if isinstance(document, Document) else None
+        prefix = f"(source: {source}) " if with_sources and source else ""
+        blocks.append(f"[{i}] {prefix}" + " ".join(text.split()))
+    return "\n\n".join(blocks)
+
+
+def with_formatted_documents(
+    prompt: BasePromptTemplate, key: str, with_sources: bool = False
+) -> Runnable:
+    """
+    The prompt, taking a list of documents for the variable key and formatting them first.
+
+    Args:
+        prompt (BasePromptTemplate): Prompt with a {key} variable
+        key (str): Name of the variable that gets the documents
+        with_sources (bool): Passed on to format_documents
+
+    Returns:
+        Runnable: Behaves like the prompt, with the same input schema, so CachedGrader keys stay the same
+    """
+    format_step = RunnablePassthrough.assign(
+        **{key: lambda inputs: format_documents(inputs[key], with_sources)}
+    )
+    return (format_step | prompt).with_types(input_type=prompt.get_input_schema())
@@ -0,0 +1,139 @@
+import asyncio
+import hashlib
+import os
+from functools import lru_cache
+from typing import Any, Dict, Optional, Type
+
+from dotenv import load_dotenv
+from langchain_core.documents import Document
+from langchain_core.runnables import Runnable, RunnableConfig
+from pydantic import BaseModel, RootModel
+
+from indexing.sqlite_cache import SQLiteCache
+
+load_dotenv()
+
+# Popular questions retrieve the same chunks all day, and the graders kept recomputing the same
+# verdicts. Verdicts are memoized in SQLite, keyed by the grader, a version of its prompt, the hash of
+# the normalized question and the hash of the graded document or generation, in a SQLiteCache that
+# every worker process can share. Entries expire after a TTL and the least recently used ones are
+# evicted above max_entries. Set VERDICT_CACHE_PATH to an empty string to disable it.
+VERDICT_CACHE_PATH = os.getenv("VERDICT_CACHE_PATH", "./.cache/verdicts.sqlite")
+VERDICT_CACHE_TTL = float(os.getenv("VERDICT_CACHE_TTL", 7 * 24 * 3600))
+VERDICT_CACHE_MAX_ENTRIES = int(os.getenv("VERDICT_CACHE_MAX_ENTRIES", 100_000))
+
+
+def _sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def normalize_question(question: str) -> str:
+    """Lower-case and collapse whitespace, so trivially different spellings share verdicts."""
+    return " ".join(question.lower().split())
+
+
+def _content_text(value: Any) -> str:
+    if isinstance(value, Document):
+        return value.page_content
+    if isinstance(value, (list, tuple)):
+        return "\x00".join(_content_text(v) for v in value)
+    return str(value)
+
+
+def prompt_version(*parts: Any) -> str:
+    """Short hash of whatever defines a grader's behavior, its prompt, schema and model."""
+    return _sha256(repr(parts))[:16]
+
+
+class VerdictCache(SQLiteCache):
+    """Persistent, LRU and TTL bounded store of grader verdicts shared across processes."""
+
+    def __init__(
+        self,
+        path: str,
+        ttl: float = VERDICT_CACHE_TTL,
+        max_entries: int = VERDICT_CACHE_MAX_ENTRIES,
+    ) -> None:
+        """
+        Args:
+            path (str): SQLite file of the cache, created if missing
+            ttl (float): Seconds after which a verdict is recomputed
+            max_entries (int): Number of verdicts above which the least recently used are evicted
+        """
+        super().__init__(path, "grader_verdicts", ttl, max_entries)
+
+
+@lru_cache(maxsize=None)
+def get_verdict_cache() -> Optional[VerdictCache]:
+    """The shared verdict cache, opened on first use so importing the graders stays cheap."""
+    if not VERDICT_CACHE_PATH:
+        return None
+    return VerdictCache(VERDICT_CACHE_PATH)
+
+
+class CachedGrader(Runnable[Dict[str, Any], BaseModel]):
+    """Runs a grader chain only when its verdict for the same inputs is not cached yet."""
+
+    def __init__(self, name: str, chain: Runnable, schema: Type[BaseModel], version: str) -> None:
+        """
+        Args:
+            name (str): Name of the grader, part of the cache key
+            chain (Runnable): The prompt | structured output chain
+            schema (Type[BaseModel]): The structured output class, used to restore cached verdicts
+            version (str): Changes whenever the prompt, schema or model change, see prompt_version
+        """
+        self.name = name
+        self.chain = chain
+        self.schema = schema
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        # only the prompt's variables are part of the key, callers may pass a shared input dict;
+        # chains that don't declare their inputs are keyed on everything they get
+        schema = chain.get_input_schema()
+        self.input_keys = None if issubclass(schema, RootModel) else set(schema.model_fields)
+
+    def _key(self, inputs: Dict[str, Any]) -> str:
+        if self.input_keys is not None:
+            inputs = {name: value for name, value in inputs.items() if name in self.input_keys}
+        question = normalize_question(str(inputs.get("question", "")))
+        content = "\x01".join(
+            f"{name}\x00{_content_text(value)}"
+            for name, value in sorted(inputs.items())
+            if name != "question"
+        )
+        return "\x00".join((self.name, self.version, _sha256(question), _sha256(content)))
+
+    def invoke(
+        self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> BaseModel:
+        cache = get_verdict_cache()
+        if cache is None:
+            return self.chain.invoke(input, config, **kwargs)
+        key = self._key(input)
+        cached = cache.get(key)
+        if cached is not None:
+            self.hits += 1
+            return self.schema.model_validate_json(cached)
+        self.misses += 1
+        verdict = self.chain.invoke(input, config, **kwargs)
+        cache.put(key, verdict.model_dump_json())
+        return verdict
+
+    async def ainvoke(
+        self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> BaseModel:
+        cache = get_verdict_cache()
+        if cache is None:
+            return await self.chain.ainvoke(input, config, **kwargs)
+        key = self._key(input)
+        # SQLite calls block, on a busy shared file for up to the lock timeout, so they run in a
+        # worker thread instead of stalling every other request on the event loop
+        cached = await asyncio.to_thread(cache.get, key)
+        if cached is not None:
+            self.hits += 1
+            return self.schema.model_validate_json(cached)
+        self.misses += 1
+        verdict = await self.chain.ainvoke(input, config, **kwargs)
+        await asyncio.to_thread(cache.put, key, verdict.model_dump_json())
+        return verdict
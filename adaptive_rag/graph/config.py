@@ -0,0 +1,59 @@
+import os
+from typing import Any, Optional
+
+from langchain_core.runnables import RunnableConfig
+
+# Settings a caller can change per run with app.invoke(..., config={"configurable": {...}}).
+# Anything not passed there falls back to the RAG_<NAME> environment variable, then to the default.
+DEFAULTS = {
+    # documents graded by the LLM at the same time in grade_documents
+    "grader_concurrency": 8,
+    # "pointwise" grades every document in its own LLM call, "listwise" all of them in a single call
+    "grader_mode": "pointwise",
+    # "on_irrelevant" starts the web search as soon as one document is graded irrelevant, "eager"
+    # when grading starts (the result is thrown away if every document is relevant), "off" waits
+    "speculative_search": "on_irrelevant",
+    # decide documents by their relevance score when graph.prefilter has calibrated thresholds
+    "prefilter": True,
+    # route obvious questions with the local centroid router, the LLM router decides the rest; it is
+    # only used once it was calibrated on logged decisions, see graph.chains.local_router
+    "local_router": True,
+    # probability the local router needs before its route is used, its calibrated threshold applies
+    # when that is higher
+    "router_confidence": 0.9,
+    # grade a generation for hallucinations and for answering the question at the same time; the
+    # answer verdict is thrown away when the generation is not grounded
+    "parallel_generation_grading": True,
+    # generations per request before the best one so far is returned with the degraded flag
+    "max_generations": 3,
+    # seconds per request after which the flow stops retrying
+    "deadline_seconds": 60.0,
+    # token budget of the documents in the generation prompt, 0 sends all of them, see graph.packing
+    "generation_context_tokens": 3000,
+    # token budget of the documents the hallucination grader checks the generation against; below
+    # the generation budget the grader would miss facts the answer was allowed to use
+    "grading_context_tokens": 3000,
+}
+
+
+def get_setting(config: Optional[RunnableConfig], name: str) -> Any:
+    """
+    Look up a run setting.
+
+    Args:
+        config (RunnableConfig): The config langgraph passes to nodes and edges, may be None
+        name (str): A key of DEFAULTS
+
+    Returns:
+        Any: The configured value, converted to the type of its default
+    """
+    configurable = (config or {}).get("configurable", {})
+    if name in configurable:
+        return configurable[name]
+    default = DEFAULTS[name]
+    value = os.getenv(f"RAG_{name.upper()}")
+    if value is None or default is None:
+        return default if value is None else value
+    if isinstance(default, bool):
+        return value.lower() in ("1", "true", "yes")
+    return type(default)(value)
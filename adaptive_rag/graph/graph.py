@@ -1,15 +1,51 @@
+import time
+from typing import Any, Dict
+
 from dotenv import load_dotenv
+from langchain_core.runnables import RunnableConfig, RunnableLambda, RunnableParallel
 from langgraph.graph import END, StateGraph
 
 from graph.chains.answer_grader import answer_grader
 from graph.chains.hallucination_grader import hallucination_grader
-from graph.chains.router import RouteQuery, question_router
-from graph.consts import GENERATE, GRADE_DOCUMENTS, RETRIEVE, WEBSEARCH
-from graph.nodes import generate, grade_documents, retrieve, web_search
+from graph.chains.local_router import aroute_with_confidence, route_with_confidence
+from graph.config import get_setting
+from graph.consts import (
+    FINALIZE,
+    GENERATE,
+    GRADE_DOCUMENTS,
+    GRADE_GENERATION,
+    RETRIEVE,
+    ROUTE_QUESTION,
+    START_REQUEST,
+    WEBSEARCH,
+)
+from graph.nodes import (
+    agenerate,
+    agrade_documents,
+    aretrieve,
+    aweb_search,
+    finalize,
+    generate,
+    grade_documents,
+    retrieve,
+    start_request,
+    web_search,
+)
+from graph.packing import pack_documents
 from graph.state import GraphState
 
 load_dotenv()
 
+def past_deadline(state: GraphState) -> bool:
+    return "deadline" in state and time.time() >= state["deadline"]
+
+
+def out_of_budget(state: GraphState, config: RunnableConfig) -> bool:
+    """Whether the request used up its generations or its time and must not go around the loop again."""
+    attempts = state.get("generation_attempts", 0)
+    return attempts >= get_setting(config, "max_generations") or past_deadline(state)
+
+
 def decide_to_generate(state):
     """
        Determines whether to generate an answer, or re-generate a question.
@@ -26,6 +62,10 @@ def decide_to_generate(state):
     # And this means that we found a document that is not relevant to the user's query.
     # So this is the heuristic that in this case we want to search online.
     # So here we would like to return the web search node.
+    if state["web_search"] and state["documents"] and past_deadline(state):
+        # no time left for a search, answer from the relevant documents we have
+        print("---DECISION: OUT OF TIME, GENERATE WITHOUT WEB SEARCH---")
+        return GENERATE
     if state["web_search"]:
         print(
             "---DECISION: NOT ALL DOCUMENTS ARE NOT RELEVANT TO QUESTION, INCLUDE WEB SEARCH---"
@@ -36,74 +76,198 @@ def decide_to_generate(state):
         print("---DECISION: GENERATE---")
         return GENERATE
 
-# this function will be the conditional edge function.
-def grade_generation_grounded_in_documents_and_question(state: GraphState) -> str:
+# both verdicts from one input dict, each grader only reads its own prompt variables
+generation_graders = RunnableParallel(hallucination=hallucination_grader, answer=answer_grader)
+
+
+def _verdict_update(generation: str, decision: str) -> Dict[str, Any]:
+    update = {"generation_verdict": decision}
+    if decision != "not supported":
+        # finalize returns the latest grounded generation when the retries run out, without grading
+        # it again after the deadline
+        update["grounded_generation"] = generation
+    return update
+
+
+def grade_generation(state: GraphState, config: RunnableConfig = None) -> Dict[str, Any]:
     """
-       Determines whether the generation is grounded in the document and answers question.
+       Grades whether the generation is grounded in the document and answers question.
 
        Args:
            state (dict): The current graph state
+           config (RunnableConfig): Run config, "parallel_generation_grading" runs both graders at once,
+               "grading_context_tokens" the documents the hallucination grader sees
 
        Returns:
-           str: Decision for next node to call
+           state (dict): The verdict, and grounded_generation when the generation is grounded
        """
     print("---CHECK HALLUCINATIONS---")
     # extract from the state the question, the documents and the generation.
     question = state["question"]
-    documents = state["documents"]
+    documents = pack_documents(state["documents"], get_setting(config, "grading_context_tokens"))
     generation = state["generation"]
 
     # run it with the retrieve documents, with the search or without the search and the response we get back has the attribute of binary score.
-    score = hallucination_grader.invoke(
-        {"documents": documents, "generation": generation}
-    )
+    answer_score = None
+    if get_setting(config, "parallel_generation_grading"):
+        # the answer is graded while the hallucination grader runs, halving the latency of this node
+        scores = generation_graders.invoke(
+            {"documents": documents, "generation": generation, "question": question}
+        )
+        score, answer_score = scores["hallucination"], scores["answer"]
+    else:
+        score = hallucination_grader.invoke(
+            {"documents": documents, "generation": generation}
+        )
     if hallucination_grade := score.binary_score:
         print("---DECISION: GENERATION IS GROUNDED IN DOCUMENTS---")
         print("---GRADE GENERATION vs QUESTION---")
-        score = answer_grader.invoke({"question": question, "generation": generation})
-        if answer_grade := score.binary_score:
+        if answer_score is None:
+            answer_score = answer_grader.invoke({"question": question, "generation": generation})
+        if answer_grade := answer_score.binary_score:
             print("---DECISION: GENERATION ADDRESSES QUESTION---")
-            return "useful"
+            decision = "useful"
         else:
             print("---DECISION: GENERATION DOES NOT ADDRESS QUESTION---")
-            return "not useful"
+            decision = "not useful"
     else:
         print("---DECISION: GENERATION IS NOT GROUNDED IN DOCUMENTS, RE-TRY---")
 
-        return "not supported"
+        decision = "not supported"
+    return _verdict_update(generation, decision)
 
 
-def route_question(state: GraphState) -> str:
+async def agrade_generation(state: GraphState, config: RunnableConfig = None) -> Dict[str, Any]:
+    """Async version of grade_generation."""
+    print("---CHECK HALLUCINATIONS---")
+    question = state["question"]
+    documents = pack_documents(state["documents"], get_setting(config, "grading_context_tokens"))
+    generation = state["generation"]
+
+    answer_score = None
+    if get_setting(config, "parallel_generation_grading"):
+        scores = await generation_graders.ainvoke(
+            {"documents": documents, "generation": generation, "question": question}
+        )
+        score, answer_score = scores["hallucination"], scores["answer"]
+    else:
+        score = await hallucination_grader.ainvoke(
+            {"documents": documents, "generation": generation}
+        )
+    if score.binary_score:
+        print("---DECISION: GENERATION IS GROUNDED IN DOCUMENTS---")
+        print("---GRADE GENERATION vs QUESTION---")
+        if answer_score is None:
+            answer_score = await answer_grader.ainvoke(
+                {"question": question, "generation": generation}
+            )
+        if answer_score.binary_score:
+            print("---DECISION: GENERATION ADDRESSES QUESTION---")
+            decision = "useful"
+        else:
+            print("---DECISION: GENERATION DOES NOT ADDRESS QUESTION---")
+            decision = "not useful"
+    else:
+        print("---DECISION: GENERATION IS NOT GROUNDED IN DOCUMENTS, RE-TRY---")
+        decision = "not supported"
+    return _verdict_update(generation, decision)
+
+
+# this function will be the conditional edge function.
+def grade_generation_grounded_in_documents_and_question(
+    state: GraphState, config: RunnableConfig = None
+) -> str:
+    """
+       Determines whether the generation is grounded in the document and answers question.
+
+       Args:
+           state (dict): The current graph state, graded by grade_generation
+           config (RunnableConfig): Run config, "max_generations" and "deadline_seconds" bound the
+               retries
+
+       Returns:
+           str: Decision for next node to call
+       """
+    decision = state["generation_verdict"]
+    # don't go around the loop again when the request is out of retries or time
+    if decision != "useful" and out_of_budget(state, config):
+        return "give up"
+    return decision
+
+
+def route_question(state: GraphState, config: RunnableConfig = None) -> Dict[str, Any]:
     """
       Route question to web search or RAG.
 
       Args:
           state (dict): The current graph state
+          config (RunnableConfig): Run config, "local_router" and "router_confidence" control the local
+              fast path in front of the LLM router
 
       Returns:
-          str: Next node to call
+          state (dict): The datasource, and the local router's confidence for grade_documents
       """
     print("---ROUTE QUESTION---")
     question = state["question"]
-    source: RouteQuery = question_router.invoke({"question": question})
-    if source.datasource == WEBSEARCH:
+    # obvious questions are routed locally without waiting for an LLM call
+    source, confidence = route_with_confidence(
+        question, get_setting(config, "local_router"), get_setting(config, "router_confidence")
+    )
+    return {"datasource": source.datasource, "route_confidence": confidence}
+
+
+async def aroute_question(state: GraphState, config: RunnableConfig = None) -> Dict[str, Any]:
+    """Async version of route_question."""
+    print("---ROUTE QUESTION---")
+    question = state["question"]
+    source, confidence = await aroute_with_confidence(
+        question, get_setting(config, "local_router"), get_setting(config, "router_confidence")
+    )
+    return {"datasource": source.datasource, "route_confidence": confidence}
+
+
+def decide_route(state: GraphState) -> str:
+    """
+      Sends the question to the node of its datasource.
+
+      Args:
+          state (dict): The current graph state
+
+      Returns:
+          str: Next node to call
+      """
+    if state["datasource"] == WEBSEARCH:
         print("---ROUTE QUESTION TO WEB SEARCH---")
         return WEBSEARCH
-    elif source.datasource == "vectorstore":
-        print("---ROUTE QUESTION TO RAG---")
-        return RETRIEVE
+    print("---ROUTE QUESTION TO RAG---")
+    return RETRIEVE
 
 
+# Every node and edge that waits on the network has a sync and an async version. app.invoke and
+# app.stream run the sync ones, app.ainvoke and app.astream the async ones, so one event loop can
+# serve many questions at once (see server.py) instead of one blocked process per question.
+def both(func, afunc) -> RunnableLambda:
+    return RunnableLambda(func, afunc=afunc, name=func.__name__)
+
 
 workflow = StateGraph(GraphState)
 
-workflow.add_node(RETRIEVE, retrieve)
-workflow.add_node(GRADE_DOCUMENTS, grade_documents)
-workflow.add_node(GENERATE, generate)
-workflow.add_node(WEBSEARCH, web_search)
+workflow.add_node(START_REQUEST, start_request)
+workflow.add_node(ROUTE_QUESTION, both(route_question, aroute_question))
+workflow.add_node(RETRIEVE, both(retrieve, aretrieve))
+workflow.add_node(GRADE_DOCUMENTS, both(grade_documents, agrade_documents))
+workflow.add_node(GENERATE, both(generate, agenerate))
+workflow.add_node(GRADE_GENERATION, both(grade_generation, agrade_generation))
+workflow.add_node(WEBSEARCH, both(web_search, aweb_search))
+workflow.add_node(FINALIZE, finalize)
 
-workflow.set_conditional_entry_point(
-    route_question,
+# the request gets its deadline and retry budget before the question is routed; routing is a node
+# so its confidence lands in the state, where grade_documents reads it
+workflow.set_entry_point(START_REQUEST)
+workflow.add_edge(START_REQUEST, ROUTE_QUESTION)
+workflow.add_conditional_edges(
+    ROUTE_QUESTION,
+    decide_route,
     {
         WEBSEARCH: WEBSEARCH,
         RETRIEVE: RETRIEVE,
@@ -119,20 +283,31 @@ workflow.add_conditional_edges(
     },
 )
 
+# grading is a node so its verdict lands in the state, where finalize reads it
+workflow.add_edge(GENERATE, GRADE_GENERATION)
 workflow.add_conditional_edges(
-    GENERATE,
+    GRADE_GENERATION,
     grade_generation_grounded_in_documents_and_question,
     {
         "not supported": GENERATE,
         "useful": END,
         "not useful": WEBSEARCH,
+        "give up": FINALIZE,
     },
 )
 
 workflow.add_edge(WEBSEARCH, GENERATE)
 workflow.add_edge(GENERATE, END)
+workflow.add_edge(FINALIZE, END)
 
 
 app = workflow.compile()
 
-app.get_graph().draw_mermaid_png(output_file_path="graph.png")
+
+def render_graph(output_file_path: str = "graph.png") -> None:
+    """Render the graph as a png. This calls the mermaid.ink API, so it is never done at import time."""
+    app.get_graph().draw_mermaid_png(output_file_path=output_file_path)
+
+
+if __name__ == "__main__":
+    render_graph()
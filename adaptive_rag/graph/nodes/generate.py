@@ -1,6 +1,10 @@
 from typing import Any, Dict
 
+from langchain_core.runnables import RunnableConfig
+
 from graph.chains.generation import generation_chain
+from graph.config import get_setting
+from graph.packing import pack_documents
 from graph.state import GraphState
 
 
@@ -11,19 +15,43 @@ from graph.state import GraphState
 # that we want to answer.
 # So after we have all the documents, we can augment the original query.
 # And now it's time to generate.
-def generate(state: GraphState) -> Dict[str, Any]:
+def generate(state: GraphState, config: RunnableConfig = None) -> Dict[str, Any]:
     """
        Generate answer using the vectorstore
 
        Args:
            state (dict): The current graph state
+           config (RunnableConfig): Run config, "generation_context_tokens" bounds the prompt
 
        Returns:
-           state (dict): New key added to state, generation, that contains LLM generation
+           state (dict): New key added to state, generation, that contains LLM generation, and the
+               generation attempts counted against the retry budget
        """
     print("---GENERATE---")
     question = state["question"]
     documents = state["documents"]
+    # only the most relevant documents that fit the token budget go into the prompt
+    context = pack_documents(documents, get_setting(config, "generation_context_tokens"))
     # send question and documents and get response from LLM
-    generation = generation_chain.invoke({"context": documents, "question": question})
-    return {"documents": documents, "question": question, "generation": generation}
+    generation = generation_chain.invoke({"context": context, "question": question})
+    return {
+        "documents": documents,
+        "question": question,
+        "generation": generation,
+        "generation_attempts": state.get("generation_attempts", 0) + 1,
+    }
+
+
+async def agenerate(state: GraphState, config: RunnableConfig = None) -> Dict[str, Any]:
+    """Async version of generate."""
+    print("---GENERATE---")
+    question = state["question"]
+    documents = state["documents"]
+    context = pack_documents(documents, get_setting(config, "generation_context_tokens"))
+    generation = await generation_chain.ainvoke({"context": context, "question": question})
+    return {
+        "documents": documents,
+        "question": question,
+        "generation": generation,
+        "generation_attempts": state.get("generation_attempts", 0) + 1,
+    }
@@ -1,18 +1,140 @@
-from typing import Any, Dict
+import asyncio
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from graph.chains.retrieval_grader import retrieval_grader
+from langchain_core.documents import Document
+from langchain_core.runnables import RunnableConfig
+
+from graph.chains.retrieval_grader import list_retrieval_grader, retrieval_grader
+from graph.chains.serialize import format_documents
+from graph.config import get_setting
+from graph.nodes.web_search import astart_search, start_search
+from graph.prefilter import load_thresholds, prefilter_grades
 from graph.state import GraphState
 
+
+def grade_pointwise(
+    question: str,
+    documents: List[Document],
+    config: RunnableConfig,
+    on_irrelevant: Optional[Callable[[], None]] = None,
+) -> List[str]:
+    """Grade each document in its own LLM call, the calls run concurrently."""
+    # The documents are graded concurrently, so the node takes about one LLM round trip instead of k.
+    # Grades are handled as they come in, so on_irrelevant runs as soon as the first "no" arrives.
+    grades = [""] * len(documents)
+    for i, score in retrieval_grader.batch_as_completed(
+        [{"question": question, "document": d.page_content} for d in documents],
+        config={"max_concurrency": get_setting(config, "grader_concurrency")},
+    ):
+        grades[i] = score.binary_score
+        if on_irrelevant is not None and grades[i].lower() != "yes":
+            on_irrelevant()
+    return grades
+
+
+def grade_listwise(question: str, documents: List[Document], config: RunnableConfig) -> List[str]:
+    """Grade all documents in a single LLM call, falling back to pointwise if the list doesn't line up."""
+    if not documents:
+        return []
+    score = list_retrieval_grader.invoke(
+        {"question": question, "documents": format_documents(documents)}
+    )
+    if len(score.binary_scores) != len(documents):
+        print("---LISTWISE GRADES DON'T MATCH THE DOCUMENTS, GRADING ONE BY ONE---")
+        return grade_pointwise(question, documents, config)
+    return score.binary_scores
+
+
+async def agrade_pointwise(
+    question: str,
+    documents: List[Document],
+    config: RunnableConfig,
+    on_irrelevant: Optional[Callable[[], None]] = None,
+) -> List[str]:
+    """Async version of grade_pointwise."""
+    grades = [""] * len(documents)
+    async for i, score in retrieval_grader.abatch_as_completed(
+        [{"question": question, "document": d.page_content} for d in documents],
+        config={"max_concurrency": get_setting(config, "grader_concurrency")},
+    ):
+        grades[i] = score.binary_score
+        if on_irrelevant is not None and grades[i].lower() != "yes":
+            on_irrelevant()
+    return grades
+
+
+async def agrade_listwise(
+    question: str, documents: List[Document], config: RunnableConfig
+) -> List[str]:
+    """Async version of grade_listwise."""
+    if not documents:
+        return []
+    score = await list_retrieval_grader.ainvoke(
+        {"question": question, "documents": format_documents(documents)}
+    )
+    if len(score.binary_scores) != len(documents):
+        print("---LISTWISE GRADES DON'T MATCH THE DOCUMENTS, GRADING ONE BY ONE---")
+        return await agrade_pointwise(question, documents, config)
+    return score.binary_scores
+
+
+def _prefilter(documents: List[Document], config: RunnableConfig) -> List[Optional[str]]:
+    # Documents with a very high or very low retriever relevance score are decided by the calibrated
+    # thresholds, only the ambiguous ones are sent to the LLM grader.
+    thresholds = load_thresholds() if get_setting(config, "prefilter") else None
+    grades = prefilter_grades(documents, thresholds)
+    if thresholds is not None:
+        print(
+            f"---PREFILTER: {grades.count('yes')} RELEVANT, {grades.count('no')} NOT RELEVANT BY SCORE, "
+            f"{grades.count(None)} TO GRADE---"
+        )
+    return grades
+
+
+def _uncertain_route(state: GraphState, config: RunnableConfig) -> bool:
+    # a question the local router sent here with low confidence may well need the web after all
+    confidence = state.get("route_confidence")
+    if confidence is not None and confidence < get_setting(config, "router_confidence"):
+        print(f"---ROUTE UNCERTAIN ({confidence:.2f})---")
+        return True
+    return False
+
+
+def _filter_relevant(documents: List[Document], grades: List[str]) -> Tuple[List[Document], bool]:
+    filtered_docs = []
+    web_search = False
+    for d, grade in zip(documents, grades):
+        if grade.lower() == "yes":
+            print("---GRADE: DOCUMENT RELEVANT---")
+            # append document to list because it's relevant to the question
+            filtered_docs.append(d)
+        else:
+            # And finally, if we have found any document that's not relevant, we're going to change the web searching
+            # flag to be true so we can go and later on search for that query.
+            print("---GRADE: DOCUMENT NOT RELEVANT---")
+            web_search = True
+            continue
+    return filtered_docs, web_search
+
+
 # So we're going to define a function which will receive the state.
 
 
-def grade_documents(state: GraphState) -> Dict[str, Any]:
+def grade_documents(state: GraphState, config: RunnableConfig = None) -> Dict[str, Any]:
     """
     Determines whether the retrieved documents are relevant to the question
     If any document is not relevant, we will set a flag to run web search
 
     Args:
         state (dict): The current graph state
+        config (RunnableConfig): Run config, "grader_mode" picks pointwise or listwise grading and
+            "grader_concurrency" caps the pointwise LLM calls in parallel, "prefilter" lets calibrated
+            relevance score thresholds decide the obvious documents without the LLM, "speculative_search"
+            picks when the web search starts, before grading if the route confidence is below
+            "router_confidence". The speculative search runs in a worker thread, when its result
+            is not needed it is only discarded: cancel() stops a search that hasn't started yet,
+            one that is already running still finishes in its thread
 
     Returns:
         state (dict): Filtered out irrelevant documents and updated web_search state
@@ -23,25 +145,108 @@ def grade_documents(state: GraphState) -> Dict[str, Any]:
     question = state["question"]
     documents = state["documents"]
 
-    filtered_docs = []
-    web_search = False
     # And in that state we're going to have already the fetched documents.
     # We're going to iterate through all the documents.
     # And our grader chain is going to decide for each document whether it's relevant or not.
-    for d in documents:
-        score = retrieval_grader.invoke(
-            {"question": question, "document": d.page_content}
-        )
-        grade = score.binary_score
-        if grade.lower() == "yes":
-            print("---GRADE: DOCUMENT RELEVANT---")
-            # append document to list because it's relevant to the question
-            filtered_docs.append(d)
+    # Speculative web search: the search starts while grading is still running, so when a document
+    # turns out irrelevant its latency is hidden behind the grading calls.
+    speculative = get_setting(config, "speculative_search")
+    search: Optional[Future] = None
+
+    def start_speculative_search() -> None:
+        nonlocal search
+        if search is None:
+            print("---SPECULATIVE WEB SEARCH STARTED---")
+            search = start_search(question)
+
+    prefetched_search = None
+    web_search = False
+    try:
+        grades = _prefilter(documents, config)
+        ambiguous = [i for i, grade in enumerate(grades) if grade is None]
+        if speculative == "eager" or (
+            speculative == "on_irrelevant" and ("no" in grades or _uncertain_route(state, config))
+        ):
+            start_speculative_search()
+        to_grade = [documents[i] for i in ambiguous]
+        if get_setting(config, "grader_mode") == "listwise":
+            llm_grades = grade_listwise(question, to_grade, config)
         else:
-            # And finally, if we have found any document that's not relevant, we're going to change the web searching
-            # flag to be true so we can go and later on search for that query.
-            print("---GRADE: DOCUMENT NOT RELEVANT---")
-            web_search = True
-            continue
+            on_irrelevant = start_speculative_search if speculative == "on_irrelevant" else None
+            llm_grades = grade_pointwise(question, to_grade, config, on_irrelevant)
+        for i, grade in zip(ambiguous, llm_grades):
+            grades[i] = grade
+        filtered_docs, web_search = _filter_relevant(documents, grades)
+        if search is not None and web_search:
+            try:
+                prefetched_search = search.result()
+            except Exception as e:
+                # the web_search node will search again
+                print(f"---SPECULATIVE WEB SEARCH FAILED: {e}---")
+    finally:
+        if search is not None and not web_search:
+            # every document is relevant after all, or grading raised: the search result is not needed
+            print("---SPECULATIVE WEB SEARCH DISCARDED---")
+            search.cancel()
     # update graph state
-    return {"documents": filtered_docs, "question": question, "web_search": web_search}
+    return {
+        "documents": filtered_docs,
+        "question": question,
+        "web_search": web_search,
+        "prefetched_search": prefetched_search,
+    }
+
+
+async def agrade_documents(state: GraphState, config: RunnableConfig = None) -> Dict[str, Any]:
+    """
+    Async version of grade_documents, the speculative search runs as a task on the same event loop
+    and a search that is not needed is cancelled and awaited
+    """
+    print("---CHECK DOCUMENT RELEVANCE TO QUESTION---")
+    question = state["question"]
+    documents = state["documents"]
+
+    speculative = get_setting(config, "speculative_search")
+    search: Optional[asyncio.Task] = None
+
+    def start_speculative_search() -> None:
+        nonlocal search
+        if search is None:
+            print("---SPECULATIVE WEB SEARCH STARTED---")
+            search = astart_search(question)
+
+    prefetched_search = None
+    web_search = False
+    try:
+        grades = _prefilter(documents, config)
+        ambiguous = [i for i, grade in enumerate(grades) if grade is None]
+        if speculative == "eager" or (
+            speculative == "on_irrelevant" and ("no" in grades or _uncertain_route(state, config))
+        ):
+            start_speculative_search()
+        to_grade = [documents[i] for i in ambiguous]
+        if get_setting(config, "grader_mode") == "listwise":
+            llm_grades = await agrade_listwise(question, to_grade, config)
+        else:
+            on_irrelevant = start_speculative_search if speculative == "on_irrelevant" else None
+            llm_grades = await agrade_pointwise(question, to_grade, config, on_irrelevant)
+        for i, grade in zip(ambiguous, llm_grades):
+            grades[i] = grade
+        filtered_docs, web_search = _filter_relevant(documents, grades)
+        if search is not None and web_search:
+            try:
+                prefetched_search = await search
+            except Exception as e:
+                print(f"---SPECULATIVE WEB SEARCH FAILED: {e}---")
+    finally:
+        if search is not None and not web_search:
+            print("---SPECULATIVE WEB SEARCH DISCARDED---")
+            search.cancel()
+            # wait for the task to end, so the search doesn't outlive the request that started it
+            await asyncio.gather(search, return_exceptions=True)
+    return {
+        "documents": filtered_docs,
+        "question": question,
+        "web_search": web_search,
+        "prefetched_search": prefetched_search,
+    }
@@ -1,44 +1,61 @@
-from typing import Any, Dict
+import asyncio
+from concurrent.futures import Future
+from typing import Any, Dict, List
 
 from dotenv import load_dotenv
 from langchain_core.documents import Document
-from langchain_tavily import TavilySearch
+from langchain_core.runnables.config import ContextThreadPoolExecutor
 
+from graph.packing import WEB_RESULTS
+from graph.search_cache import CachedTavilySearch
 from graph.state import GraphState
 
 load_dotenv()
-# get three web searches returned
-web_search_tool = TavilySearch(max_results=3)
+# get three web searches returned, repeated questions are answered from the search cache
+web_search_tool = CachedTavilySearch(max_results=3)
+# speculative searches run here while the documents are still being graded
+_speculative_executor = ContextThreadPoolExecutor(max_workers=4)
 
 
-def web_search(state: GraphState) -> Dict[str, Any]:
-    """
-      Web search based on the re-phrased question.
+def _join_results(tavily_results: List[Dict[str, Any]]) -> Document:
+    # get one huge string from search results
+    joined_tavily_result = "\n".join(
+        [tavily_result["content"] for tavily_result in tavily_results]
+    )
+    # And what we want to do is to take all the content from all the elements of this list, and to combine
+    # them into one document of length chain.
+    # flagged so the context packer ranks it ahead of the retrieved documents
+    return Document(page_content=joined_tavily_result, metadata={WEB_RESULTS: True})
 
-      Args:
-          state (dict): The current graph state
 
-      Returns:
-          state (dict): Updates documents key with appended web results
-      """
-    # receive the state and return a dictionary
-    print("---WEB SEARCH---")
-    # extract the question and documents from the graph state.
+def search_web(question: str) -> Document:
+    """Search Tavily for the question and join the results into one document."""
+    return _join_results(web_search_tool.invoke({"query": question})["results"])
+
+
+async def asearch_web(question: str) -> Document:
+    """Async version of search_web."""
+    return _join_results((await web_search_tool.ainvoke({"query": question}))["results"])
+
+
+def start_search(question: str) -> "Future[Document]":
+    """Start search_web in the background, the caller decides later whether it needs the result."""
+    return _speculative_executor.submit(search_web, question)
+
+
+def astart_search(question: str) -> "asyncio.Task[Document]":
+    """Start asearch_web as a task on the running event loop, like start_search does on a thread."""
+    return asyncio.ensure_future(asearch_web(question))
+
+
+def _add_web_results(state: GraphState, web_results: Document) -> Dict[str, Any]:
     question = state["question"]
     # we have already filtered out non-relevant documents, everything in the documents list are going to be relevant for our query.
     if "documents" in state: # if the route to web search in first time then give error
         documents = state["documents"]
     else:
         documents = None
-        
-    tavily_results = web_search_tool.invoke({"query": question})["results"]
-    # get one huge string from search results
-    joined_tavily_result = "\n".join(
-        [tavily_result["content"] for tavily_result in tavily_results]
-    )
-    # And what we want to do is to take all the content from all the elements of this list, and to combine
-    # them into one document of length chain.
-    web_results = Document(page_content=joined_tavily_result)
+
     if documents is not None:
         # if relevant documents then append to documents list
         documents.append(web_results)
@@ -46,8 +63,34 @@ def web_search(state: GraphState) -> Dict[str, Any]:
     else:
         # if no relevant documents found then just return the web results as one list
         documents = [web_results]
-    return {"documents": documents, "question": question}
+    return {"documents": documents, "question": question, "prefetched_search": None}
+
+
+def web_search(state: GraphState) -> Dict[str, Any]:
+    """
+      Web search based on the re-phrased question.
+
+      Args:
+          state (dict): The current graph state
+
+      Returns:
+          state (dict): Updates documents key with appended web results
+      """
+    # receive the state and return a dictionary
+    print("---WEB SEARCH---")
+    # extract the question from the graph state.
+    question = state["question"]
+    # grade_documents may already have searched while it was grading, the results are only used once
+    web_results = state.get("prefetched_search") or search_web(question)
+    return _add_web_results(state, web_results)
 
 
+async def aweb_search(state: GraphState) -> Dict[str, Any]:
+    """Async version of web_search."""
+    print("---WEB SEARCH---")
+    question = state["question"]
+    web_results = state.get("prefetched_search") or await asearch_web(question)
+    return _add_web_results(state, web_results)
+
 if __name__ == "__main__":
     web_search(state={"question": "agent memory", "documents": None})
@@ -1,4 +1,6 @@
-from typing import List, TypedDict
+from typing import List, Optional, TypedDict
+
+from langchain_core.documents import Document
 
 class GraphState(TypedDict):
     """
@@ -8,7 +10,15 @@ class GraphState(TypedDict):
         question: question
         generation: LLM generation
         web_search: whether to add search
+        datasource: where route_question sent the question, "vectorstore" or "websearch"
+        route_confidence: the local router's confidence in its route, None when it was not used
         documents: list of documents
+        prefetched_search: web results searched speculatively while grading, used by web_search
+        deadline: time.time() after which the request stops retrying
+        generation_attempts: number of generations so far, checked against the retry budget
+        generation_verdict: the graders' verdict on the latest generation
+        grounded_generation: latest generation that was grounded in the documents
+        degraded: whether the request ran out of retries or time and returned the best generation so far
     """
     # Want to have the question in our state, because we always want to reference it,
     # whether to determine if the documents retrieved are relevant
@@ -17,7 +27,19 @@ class GraphState(TypedDict):
     # generated answer
     generation: str
     web_search: bool
+    # grade_documents searches speculatively when the local router wasn't sure about the vectorstore
+    datasource: str
+    route_confidence: Optional[float]
     # We want to save the documents that are going to help us answer this question.
     # So those are going to be the retrieved documents or the documents that we get back from the search result.
     # And for that we're going to be saving in a list of documents.
     documents: List[str]
+    # grade_documents starts the web search as soon as a document is graded irrelevant, so it runs
+    # while the other documents are still being graded.
+    prefetched_search: Optional[Document]
+    # The generate -> grade loop stops when either runs out and returns the best generation so far.
+    deadline: float
+    generation_attempts: int
+    generation_verdict: str
+    grounded_generation: str
+    degraded: bool
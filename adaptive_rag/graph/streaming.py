@@ -0,0 +1,96 @@
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.graph.state import CompiledStateGraph
+
+from graph.consts import ANSWER_TAG, FINALIZE, GENERATE, WEBSEARCH
+
+# Without streaming, the caller only sees the answer after it was generated and graded. Here the graph
+# runs with stream_mode=["messages", "updates"]: "messages" carries the LLM tokens of every node, and
+# the ones from generation_chain are picked out by its tag, "updates" tells which node ran, so we know
+# when an answer was thrown away and regenerated. The caller gets these events:
+#   {"type": "token", "attempt": 1, "content": "..."}     a piece of the answer being generated
+#   {"type": "retract", "attempt": 1}                     the answer of that attempt failed grading
+#   {"type": "final", "generation": "...", "verdict": "useful" | "degraded"}
+STREAM_MODE = ["messages", "updates"]
+
+
+class _EventTranslator:
+    """Turns the (mode, chunk) pairs of the graph stream into answer events."""
+
+    def __init__(self) -> None:
+        self.attempt = 0
+        # an answer was generated and may still be retracted
+        self.answer_open = False
+        self.generation: Optional[str] = None
+
+    def feed(self, mode: str, chunk: Any) -> List[Dict[str, Any]]:
+        events = []
+        if mode == "messages":
+            message, metadata = chunk
+            if ANSWER_TAG in metadata.get("tags", []) and message.content:
+                if self.answer_open:
+                    # the previous answer is being regenerated right away
+                    events.append(self._retract())
+                if not self.attempt or self.generation is not None:
+                    self.attempt += 1
+                    self.generation = None
+                events.append(
+                    {"type": "token", "attempt": self.attempt, "content": message.content}
+                )
+            return events
+        for node, update in chunk.items():
+            if node == GENERATE:
+                self.generation = (update or {}).get("generation", "")
+                self.answer_open = True
+            elif node == WEBSEARCH and self.answer_open:
+                # the answer was grounded but didn't address the question, search and try again
+                events.append(self._retract())
+            elif node == FINALIZE:
+                self.answer_open = False
+                events.append(
+                    {"type": "final", "generation": update["generation"], "verdict": "degraded"}
+                )
+        return events
+
+    def _retract(self) -> Dict[str, Any]:
+        self.answer_open = False
+        return {"type": "retract", "attempt": self.attempt}
+
+    def close(self) -> List[Dict[str, Any]]:
+        if not self.answer_open:
+            return []
+        # the graph ended right after a generation, so the last answer passed grading
+        return [{"type": "final", "generation": self.generation, "verdict": "useful"}]
+
+
+def stream_answer(
+    app: CompiledStateGraph, question: str, config: Optional[RunnableConfig] = None
+) -> Iterator[Dict[str, Any]]:
+    """
+    Run the graph for a question and yield answer tokens as they are generated.
+
+    Args:
+        app (CompiledStateGraph): The compiled RAG graph
+        question (str): The user question
+        config (RunnableConfig): Passed on to the graph, e.g. {"configurable": {"max_generations": 2}}
+
+    Yields:
+        dict: token, retract and final events, see the top of this module
+    """
+    translator = _EventTranslator()
+    for mode, chunk in app.stream({"question": question}, config, stream_mode=STREAM_MODE):
+        yield from translator.feed(mode, chunk)
+    yield from translator.close()
+
+
+async def astream_answer(
+    app: CompiledStateGraph, question: str, config: Optional[RunnableConfig] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """Async version of stream_answer, for serving several questions from one event loop."""
+    translator = _EventTranslator()
+    async for mode, chunk in app.astream({"question": question}, config, stream_mode=STREAM_MODE):
+        for event in translator.feed(mode, chunk):
+            yield event
+    for event in translator.close():
+        yield event
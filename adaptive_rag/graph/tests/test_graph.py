@@ -0,0 +1,863 @@
+import asyncio
+import importlib
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda, RunnableParallel
+
+from graph.chains import local_router, verdict_cache
+from graph.chains.micro_batch import MicroBatcher, batch_schema
+from graph.chains.retrieval_grader import GradeDocumentList, GradeDocuments, grade_prompt
+from graph.chains.answer_grader import GradeAnswer
+from graph.chains.hallucination_grader import GradeHallucinations
+from graph.chains.router import RouteQuery
+from graph.chains.serialize import format_documents, with_formatted_documents
+from graph.consts import ANSWER_TAG
+from graph.streaming import stream_answer
+from graph import search_cache
+from graph.packing import TRUNCATED, WEB_RESULTS, pack_documents
+from graph.prefilter import fit_thresholds
+from indexing import sqlite_cache
+from indexing.hybrid import RELEVANCE_SCORE
+from server import CONFIGURABLE_RANGES, RAGService
+
+# graph.nodes re-exports the node functions under the names of their modules
+grade_documents_module = importlib.import_module("graph.nodes.grade_documents")
+web_search_module = importlib.import_module("graph.nodes.web_search")
+retrieve_module = importlib.import_module("graph.nodes.retrieve")
+generate_module = importlib.import_module("graph.nodes.generate")
+graph_module = importlib.import_module("graph.graph")
+
+
+def _fake_search(searches):
+    def start_search(question):
+        searches.append((question, time.perf_counter()))
+        future = Future()
+        future.set_result(Document(page_content=f"web results for {question}"))
+        return future
+
+    return start_search
+
+
+@pytest.fixture
+def offline_graph(monkeypatch):
+    """
+    Keeps graph_module.app off the network: questions go to the vectorstore, its one document is
+    relevant and web searches return a fixed document. Returns a function that sets the generation
+    chain and the hallucination and answer graders of the test.
+    """
+    retriever = RunnableLambda(lambda question: [Document(page_content="agent memory")])
+    monkeypatch.setattr(retrieve_module, "get_retriever", lambda: retriever)
+
+    async def aroute(*args):
+        return RouteQuery(datasource="vectorstore"), None
+
+    monkeypatch.setattr(
+        graph_module,
+        "route_with_confidence",
+        lambda *args: (RouteQuery(datasource="vectorstore"), None),
+    )
+    monkeypatch.setattr(graph_module, "aroute_with_confidence", aroute)
+    monkeypatch.setattr(
+        grade_documents_module,
+        "retrieval_grader",
+        RunnableLambda(lambda inputs: GradeDocuments(binary_score="yes")),
+    )
+
+    async def asearch_web(question):
+        return Document(page_content="web results")
+
+    monkeypatch.setattr(
+        web_search_module, "search_web", lambda question: Document(page_content="web results")
+    )
+    monkeypatch.setattr(web_search_module, "asearch_web", asearch_web)
+
+    def use(hallucination, answer, generation_chain=None):
+        if generation_chain is not None:
+            monkeypatch.setattr(generate_module, "generation_chain", generation_chain)
+        monkeypatch.setattr(
+            graph_module,
+            "generation_graders",
+            RunnableParallel(hallucination=hallucination, answer=answer),
+        )
+        monkeypatch.setattr(graph_module, "hallucination_grader", hallucination)
+        monkeypatch.setattr(graph_module, "answer_grader", answer)
+
+    return use
+
+
+# main.py has to import within this many seconds, override with IMPORT_BUDGET_SECONDS on slow machines
+IMPORT_BUDGET_SECONDS = float(os.getenv("IMPORT_BUDGET_SECONDS", "5"))
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# any connection attempt fails loudly, so importing must not need the network at all
+_MEASURE_IMPORT = """
+import socket, time
+
+def no_network(*args, **kwargs):
+    raise RuntimeError("network access at import time")
+
+socket.socket.connect = no_network
+socket.create_connection = no_network
+start = time.perf_counter()
+import main
+print(time.perf_counter() - start)
+"""
+
+
+def test_main_imports_offline_within_budget() -> None:
+    # clients only check that keys are present when they are constructed
+    env = {"OPENAI_API_KEY": "sk-import-check", "TAVILY_API_KEY": "tvly-import-check", **os.environ}
+    result = subprocess.run(
+        [sys.executable, "-c", _MEASURE_IMPORT],
+        cwd=PROJECT_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    elapsed = float(result.stdout.strip().splitlines()[-1])
+    assert elapsed < IMPORT_BUDGET_SECONDS
+
+
+def test_grade_documents_grades_concurrently_in_order(monkeypatch) -> None:
+    running = peak = 0
+    lock = threading.Lock()
+    searched = threading.Event()
+
+    def fake_grader(inputs):
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        if "relevant" in inputs["document"]:
+            # a relevant document's grade only comes back once the search has started
+            assert searched.wait(timeout=5)
+        else:
+            time.sleep(0.05)
+        with lock:
+            running -= 1
+        return GradeDocuments(binary_score="yes" if "relevant" in inputs["document"] else "no")
+
+    searches = []
+    in_flight = []
+
+    def start_search(question):
+        with lock:
+            in_flight.append(running)
+        searched.set()
+        return _fake_search(searches)(question)
+
+    monkeypatch.setattr(grade_documents_module, "retrieval_grader", RunnableLambda(fake_grader))
+    monkeypatch.setattr(grade_documents_module, "start_search", start_search)
+    documents = [Document(page_content=f"doc {i} relevant") for i in range(6)]
+    documents[1] = Document(page_content="doc 1 off topic")
+
+    state = {"question": "agent memory?", "documents": documents}
+    result = grade_documents_module.grade_documents(
+        state, {"configurable": {"grader_concurrency": 3}}
+    )
+    assert [d.page_content for d in result["documents"]] == [
+        d.page_content for i, d in enumerate(documents) if i != 1
+    ]
+    assert result["web_search"] is True
+    assert peak == 3
+    # the irrelevant document started the search while the other grades were still running
+    assert len(searches) == 1
+    assert in_flight[0] > 0
+    assert result["prefetched_search"].page_content == "web results for agent memory?"
+
+
+def test_grade_documents_listwise_uses_one_call(monkeypatch) -> None:
+    calls = []
+
+    def fake_list_grader(inputs):
+        calls.append(inputs)
+        return GradeDocumentList(binary_scores=["yes", "no", "yes"])
+
+    monkeypatch.setattr(
+        grade_documents_module, "list_retrieval_grader", RunnableLambda(fake_list_grader)
+    )
+    documents = [Document(page_content=f"doc {i}") for i in range(3)]
+
+    state = {"question": "agent memory?", "documents": documents}
+    result = grade_documents_module.grade_documents(
+        state, {"configurable": {"grader_mode": "listwise"}}
+    )
+    assert len(calls) == 1
+    assert calls[0]["documents"].startswith("[1] doc 0")
+    assert result["documents"] == [documents[0], documents[2]]
+    assert result["web_search"] is True
+
+
+def test_speculative_search_is_discarded_or_reused(monkeypatch) -> None:
+    searches = []
+    monkeypatch.setattr(
+        grade_documents_module,
+        "retrieval_grader",
+        RunnableLambda(lambda inputs: GradeDocuments(binary_score="yes")),
+    )
+    monkeypatch.setattr(grade_documents_module, "start_search", _fake_search(searches))
+    documents = [Document(page_content=f"doc {i}") for i in range(3)]
+
+    state = {"question": "agent memory?", "documents": documents}
+    result = grade_documents_module.grade_documents(
+        state, {"configurable": {"speculative_search": "eager"}}
+    )
+    assert len(searches) == 1
+    assert result["web_search"] is False
+    assert result["prefetched_search"] is None
+
+    # a question the local router wasn't sure about searches before any document is graded irrelevant
+    for confidence, expected in [(0.5, 2), (0.95, 2), (None, 2)]:
+        grade_documents_module.grade_documents(
+            {**state, "route_confidence": confidence}, {"configurable": {"router_confidence": 0.9}}
+        )
+        assert len(searches) == expected
+
+    # a prefetched result is used by the web_search node instead of searching again
+    def no_search(question):
+        raise AssertionError("searched twice")
+
+    monkeypatch.setattr(web_search_module, "search_web", no_search)
+    prefetched = Document(page_content="web results")
+    update = web_search_module.web_search(
+        {"question": "agent memory?", "documents": [], "prefetched_search": prefetched}
+    )
+    assert update["documents"] == [prefetched]
+    assert update["prefetched_search"] is None
+
+
+def test_speculative_search_is_cancelled_when_grading_fails(monkeypatch) -> None:
+    def failing_grader(inputs):
+        raise RuntimeError("grader is down")
+
+    monkeypatch.setattr(grade_documents_module, "retrieval_grader", RunnableLambda(failing_grader))
+    state = {"question": "agent memory?", "documents": [Document(page_content="doc")]}
+    config = {"configurable": {"speculative_search": "eager"}}
+
+    # a search still waiting for a worker thread is cancelled
+    searches = []
+
+    def start_search(question):
+        searches.append(Future())
+        return searches[-1]
+
+    monkeypatch.setattr(grade_documents_module, "start_search", start_search)
+    with pytest.raises(RuntimeError):
+        grade_documents_module.grade_documents(state, config)
+    assert searches[0].cancelled()
+
+    # the async search task is cancelled and has ended by the time the node raises
+    async def asearch_web(question):
+        await asyncio.sleep(10)
+
+    tasks = []
+
+    def astart_search(question):
+        tasks.append(asyncio.ensure_future(asearch_web(question)))
+        return tasks[-1]
+
+    monkeypatch.setattr(grade_documents_module, "astart_search", astart_search)
+
+    async def run():
+        with pytest.raises(RuntimeError):
+            await grade_documents_module.agrade_documents(state, config)
+        return tasks[0].cancelled()
+
+    assert asyncio.run(run())
+
+
+def test_prefilter_thresholds_skip_obvious_documents(monkeypatch) -> None:
+    examples = [(0.1, False), (0.2, False), (0.3, False), (0.5, True), (0.55, False), (0.8, True)]
+    examples += [(0.9, True), (0.95, True)]
+    thresholds = fit_thresholds(examples, max_error=0.0)
+    assert (thresholds.reject, thresholds.accept) == (0.5, 0.8)
+
+    graded = []
+
+    def fake_grader(inputs):
+        graded.append(inputs["document"])
+        return GradeDocuments(binary_score="yes")
+
+    monkeypatch.setattr(grade_documents_module, "retrieval_grader", RunnableLambda(fake_grader))
+    monkeypatch.setattr(grade_documents_module, "load_thresholds", lambda: thresholds)
+    monkeypatch.setattr(grade_documents_module, "start_search", _fake_search([]))
+    documents = [
+        Document(page_content=name, metadata={RELEVANCE_SCORE: score})
+        for name, score in [("high", 0.9), ("middle", 0.6), ("low", 0.2)]
+    ]
+    documents.append(Document(page_content="lexical only"))
+
+    state = {"question": "agent memory?", "documents": documents}
+    result = grade_documents_module.grade_documents(state)
+    assert sorted(graded) == ["lexical only", "middle"]
+    assert [d.page_content for d in result["documents"]] == ["high", "middle", "lexical only"]
+    assert result["web_search"] is True
+
+
+def test_grader_verdicts_are_cached_by_question_and_document(tmp_path, monkeypatch) -> None:
+    cache = verdict_cache.VerdictCache(str(tmp_path / "verdicts.sqlite"), ttl=60, max_entries=3)
+    monkeypatch.setattr(verdict_cache, "get_verdict_cache", lambda: cache)
+    calls = []
+
+    def fake_chain(inputs):
+        calls.append(inputs)
+        return GradeDocuments(binary_score="yes")
+
+    grader = verdict_cache.CachedGrader(
+        "retrieval_grader", RunnableLambda(fake_chain), GradeDocuments, "v1"
+    )
+    grader.invoke({"question": "What is agent memory?", "document": "doc 1"})
+    # the same question spelled differently hits the cache
+    verdict = grader.invoke({"question": "  what is AGENT memory? ", "document": "doc 1"})
+    assert verdict == GradeDocuments(binary_score="yes")
+    assert (grader.hits, grader.misses, len(calls)) == (1, 1, 1)
+
+    # another prompt version or another document is graded again
+    other = verdict_cache.CachedGrader(
+        "retrieval_grader", RunnableLambda(fake_chain), GradeDocuments, "v2"
+    )
+    other.invoke({"question": "What is agent memory?", "document": "doc 1"})
+    grader.invoke({"question": "What is agent memory?", "document": "doc 2"})
+    assert len(calls) == 3
+
+    # async callers look up the same verdicts, off the event loop
+    verdict = asyncio.run(
+        grader.ainvoke({"question": "What is agent memory?", "document": "doc 2"})
+    )
+    assert verdict == GradeDocuments(binary_score="yes")
+    assert len(calls) == 3
+
+    # a hit right after the verdict was stored doesn't write last_used again
+    changes = cache._conn.total_changes
+    grader.invoke({"question": "What is agent memory?", "document": "doc 1"})
+    assert cache._conn.total_changes == changes
+
+    # above max_entries the least recently used verdicts are evicted
+    monkeypatch.setattr(sqlite_cache, "TOUCH_INTERVAL", 0)
+    grader.invoke({"question": "What is agent memory?", "document": "doc 1"})
+    grader.invoke({"question": "What is agent memory?", "document": "doc 3"})
+    assert cache.stats()["entries"] == 2
+    grader.invoke({"question": "What is agent memory?", "document": "doc 1"})
+    assert len(calls) == 4
+
+    # expired verdicts are recomputed
+    cache.ttl = -1
+    grader.invoke({"question": "What is agent memory?", "document": "doc 4"})
+    grader.invoke({"question": "What is agent memory?", "document": "doc 4"})
+    assert len(calls) == 6
+    assert cache.hit_rate == cache.hits / (cache.hits + cache.misses)
+
+
+class KeywordEmbeddings(Embeddings):
+    vocabulary = ["agent", "prompt", "memory", "weather", "stock", "world", "the"]
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        words = text.lower().split()
+        return [float(sum(w.startswith(v) for w in words)) + 0.01 for v in self.vocabulary]
+
+
+def test_local_router_decides_obvious_questions(tmp_path, monkeypatch) -> None:
+    router = local_router.CentroidRouter.fit(
+        KeywordEmbeddings(),
+        [
+            ("agent memory", "vectorstore"),
+            ("prompt agent", "vectorstore"),
+            ("weather today", "websearch"),
+            ("stock world", "websearch"),
+        ],
+    )
+    monkeypatch.setattr(local_router, "get_local_router", lambda: router)
+    monkeypatch.setattr(local_router, "ROUTING_LOG_PATH", str(tmp_path / "routing.jsonl"))
+    llm_calls = []
+
+    def fake_llm_router(inputs):
+        llm_calls.append(inputs["question"])
+        return RouteQuery(datasource="websearch")
+
+    monkeypatch.setattr(local_router, "question_router", RunnableLambda(fake_llm_router))
+
+    assert local_router.route("how does agent memory work").datasource == "vectorstore"
+    assert local_router.route("weather in the world").datasource == "websearch"
+    assert llm_calls == []
+
+    # below the confidence threshold the LLM router decides, and its decision is logged
+    assert local_router.route("memory weather", min_confidence=1.0).datasource == "websearch"
+    assert local_router.route("agent memory", use_local=False).datasource == "websearch"
+    assert llm_calls == ["memory weather", "agent memory"]
+    assert (
+        len(local_router.load_examples(str(tmp_path / "routing.jsonl")))
+        == len(local_router.load_examples(str(tmp_path / "missing.jsonl"))) + 2
+    )
+
+
+def test_local_router_is_calibrated_on_logged_decisions(tmp_path, monkeypatch) -> None:
+    logged = [
+        ("agent memory", "vectorstore"),
+        ("prompt agent", "vectorstore"),
+        ("weather today", "websearch"),
+        ("stock world", "websearch"),
+    ] * 10
+    # a question of both topics, the LLM router decided it both ways
+    logged += [("agent weather", "vectorstore"), ("agent weather", "websearch")] * 5
+    monkeypatch.setattr(local_router, "MIN_LOGGED_DECISIONS", 50)
+    with pytest.raises(ValueError):
+        local_router.CentroidRouter.calibrate(KeywordEmbeddings(), logged[:40])
+
+    router = local_router.CentroidRouter.calibrate(KeywordEmbeddings(), logged, 0.95)
+    assert router.temperature in local_router.TEMPERATURES
+    # the clear questions are routed locally, the ambiguous one is left to the LLM router
+    assert router.classify("agent memory")[1] >= router.min_confidence
+    assert router.classify("agent weather")[1] < router.min_confidence
+
+    # only a calibrated router is used, until then the LLM router decides every question
+    path = tmp_path / "router_centroids.json"
+    monkeypatch.setattr(local_router, "ROUTER_CENTROIDS_PATH", str(path))
+    monkeypatch.setattr(importlib.import_module("ingestion"), "get_embeddings", KeywordEmbeddings)
+    local_router.get_local_router.cache_clear()
+    try:
+        assert local_router.get_local_router() is None
+        path.write_text(json.dumps({"vectorstore": [1.0] * 7, "websearch": [0.0] * 7}))
+        local_router.get_local_router.cache_clear()
+        assert local_router.get_local_router() is None
+        router.save(str(path))
+        local_router.get_local_router.cache_clear()
+        loaded = local_router.get_local_router()
+        assert (loaded.temperature, loaded.min_confidence) == (
+            router.temperature,
+            router.min_confidence,
+        )
+    finally:
+        local_router.get_local_router.cache_clear()
+
+
+def test_generation_graders_run_concurrently(offline_graph) -> None:
+    verdicts = {}
+    running = peak = calls = 0
+    lock = threading.Lock()
+
+    def grader(name, schema):
+        def grade(inputs):
+            nonlocal running, peak, calls
+            with lock:
+                running += 1
+                peak = max(peak, running)
+                calls += 1
+            time.sleep(0.05)
+            with lock:
+                running -= 1
+            return schema(binary_score=verdicts[name])
+
+        return RunnableLambda(grade)
+
+    offline_graph(grader("hallucination", GradeHallucinations), grader("answer", GradeAnswer))
+    state = {"question": "agent memory?", "documents": [], "generation": "answer"}
+
+    for grounded, addresses, decision in [
+        (True, True, "useful"),
+        (True, False, "not useful"),
+        (False, True, "not supported"),
+    ]:
+        verdicts.update(hallucination=grounded, answer=addresses)
+        for parallel in (True, False):
+            config = {"configurable": {"parallel_generation_grading": parallel}}
+            peak = calls = 0
+            assert graph_module.grade_generation(state, config)["generation_verdict"] == decision
+            # sequentially the answer grader waits for the hallucination grader, and is skipped
+            # when the generation isn't grounded
+            assert peak == (2 if parallel else 1)
+            assert calls == (2 if parallel or grounded else 1)
+
+
+def test_generate_loop_stops_at_retry_budget_and_deadline(offline_graph) -> None:
+    generations = []
+    # hallucination verdict of each generation
+    grounded = {}
+    graded = []
+
+    def fake_generation(inputs):
+        generations.append(inputs["question"])
+        return f"answer {len(generations)}"
+
+    def hallucination(inputs):
+        graded.append(inputs["generation"])
+        return GradeHallucinations(binary_score=grounded.get(inputs["generation"], False))
+
+    offline_graph(
+        RunnableLambda(hallucination),
+        RunnableLambda(lambda inputs: GradeAnswer(binary_score=False)),
+        RunnableLambda(fake_generation),
+    )
+
+    result = graph_module.app.invoke(
+        {"question": "agent memory?"}, config={"configurable": {"max_generations": 2}}
+    )
+    assert len(generations) == 2
+    assert result["generation"] == "answer 2"
+    assert result["degraded"] is True
+
+    # a deadline that already passed stops after the first generation
+    generations.clear()
+    result = graph_module.app.invoke({"question": "agent memory?", "deadline": time.time()})
+    assert len(generations) == 1
+    assert result["degraded"] is True
+
+    # grounded answers that don't answer the question go to web search and generate again; the
+    # latest grounded one is returned, from the verdicts recorded while grading, so nothing is
+    # graded again once the budget ran out
+    for grounded_answers, returned in [
+        ({"answer 1"}, "answer 1"),
+        ({"answer 1", "answer 2"}, "answer 2"),
+    ]:
+        generations.clear()
+        graded.clear()
+        grounded.clear()
+        grounded.update(dict.fromkeys(grounded_answers, True))
+        result = asyncio.run(
+            graph_module.app.ainvoke(
+                {"question": "agent memory?"}, config={"configurable": {"max_generations": 2}}
+            )
+        )
+        assert graded == ["answer 1", "answer 2"]
+        assert (result["generation"], result["degraded"]) == (returned, True)
+
+
+def test_stream_answer_streams_tokens_and_retracts_regenerated_answers(offline_graph) -> None:
+    model = GenericFakeChatModel(
+        messages=iter([AIMessage(content="first try"), AIMessage(content="second try")])
+    )
+    generation_chain = RunnableLambda(lambda inputs: inputs["question"]) | model | StrOutputParser()
+    grounded = iter([False, True])
+    offline_graph(
+        RunnableLambda(lambda inputs: GradeHallucinations(binary_score=next(grounded))),
+        RunnableLambda(lambda inputs: GradeAnswer(binary_score=True)),
+        generation_chain.with_config(tags=[ANSWER_TAG]),
+    )
+
+    events = list(stream_answer(graph_module.app, "agent memory?"))
+    tokens = [(e["attempt"], e["content"]) for e in events if e["type"] == "token"]
+    assert tokens == [(1, "first"), (1, " "), (1, "try"), (2, "second"), (2, " "), (2, "try")]
+    assert [e["type"] for e in events if e["type"] != "token"] == ["retract", "final"]
+    assert events.index({"type": "retract", "attempt": 1}) == 3
+    assert events[-1] == {"type": "final", "generation": "second try", "verdict": "useful"}
+
+
+def test_async_graph_answers_questions_concurrently(offline_graph) -> None:
+    running = peak = 0
+
+    async def slow_generation(inputs):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.1)
+        running -= 1
+        return f"answer to {inputs['question']}"
+
+    offline_graph(
+        RunnableLambda(lambda inputs: GradeHallucinations(binary_score=True)),
+        RunnableLambda(lambda inputs: GradeAnswer(binary_score=True)),
+        RunnableLambda(lambda inputs: "blocking call", afunc=slow_generation),
+    )
+
+    async def ask_all():
+        questions = [f"question {i}" for i in range(8)]
+        return await asyncio.gather(
+            *(graph_module.app.ainvoke({"question": q}) for q in questions)
+        )
+
+    results = asyncio.run(ask_all())
+    # the eight generations wait on the same event loop instead of one after the other
+    assert peak > 1
+    assert [r["generation"] for r in results] == [f"answer to question {i}" for i in range(8)]
+
+
+class GatedGraph:
+    """Stands in for the compiled graph, every question waits until the test opens the gate."""
+
+    def __init__(self) -> None:
+        self.gate = asyncio.Event()
+        self.configs = []
+
+    async def ainvoke(self, state, config=None):
+        self.configs.append(config)
+        await self.gate.wait()
+        return {"generation": f"answer to {state['question']}", "degraded": False}
+
+
+async def _request(api, method, path, body=None):
+    messages = [{"type": "http.request", "body": json.dumps(body or {}).encode()}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    await api({"type": "http", "method": method, "path": path}, receive, send)
+    headers = dict(sent[0]["headers"])
+    return sent[0]["status"], headers, json.loads(b"".join(m.get("body", b"") for m in sent[1:]))
+
+
+def test_service_limits_concurrency_and_sheds_excess_load() -> None:
+    async def scenario():
+        graph = GatedGraph()
+        api = RAGService(graph, max_concurrency=2, max_queue=1)
+        accepted = [
+            asyncio.create_task(_request(api, "POST", "/ask", {"question": f"q{i}"}))
+            for i in range(3)
+        ]
+        await asyncio.sleep(0.01)
+        status, _, health = await _request(api, "GET", "/healthz")
+        assert status == 200
+        assert (health["running"], health["waiting"]) == (2, 1)
+
+        # two running and one waiting fill the service, the next question is turned away
+        status, headers, body = await _request(api, "POST", "/ask", {"question": "q3"})
+        assert status == 503
+        assert b"retry-after" in headers
+
+        graph.gate.set()
+        responses = await asyncio.gather(*accepted)
+        assert [(status, body["generation"]) for status, _, body in responses] == [
+            (200, f"answer to q{i}") for i in range(3)
+        ]
+        assert (api.running, api.waiting) == (0, 0)
+
+        status, _, _ = await _request(api, "POST", "/ask", {"not a question": 1})
+        assert status == 400
+
+    asyncio.run(scenario())
+
+
+def test_service_checks_and_clamps_run_settings() -> None:
+    async def scenario():
+        graph = GatedGraph()
+        graph.gate.set()
+        api = RAGService(graph)
+        configurable = {
+            "max_generations": "2",
+            "deadline_seconds": 1e9,
+            "grader_concurrency": 0,
+            "grader_mode": "listwise",
+            "prefilter": False,
+        }
+        status, _, _ = await _request(
+            api, "POST", "/ask", {"question": "q", "configurable": configurable}
+        )
+        assert status == 200
+        assert graph.configs[-1]["configurable"] == {
+            "max_generations": 2,
+            "deadline_seconds": CONFIGURABLE_RANGES["deadline_seconds"][1],
+            "grader_concurrency": 1,
+            "grader_mode": "listwise",
+            "prefilter": False,
+        }
+
+        for bad in (
+            {"max_generations": "three"},
+            {"max_generations": 2.5},
+            {"deadline_seconds": True},
+            {"grader_mode": "everything"},
+            {"prefilter": "no"},
+            {"recursion_limit": 10_000},
+        ):
+            status, _, _ = await _request(
+                api, "POST", "/ask/stream", {"question": "q", "configurable": bad}
+            )
+            assert status == 400, bad
+        assert len(graph.configs) == 1
+
+    asyncio.run(scenario())
+
+
+class WordEncoding:
+    """Counts words instead of tiktoken tokens, the real encodings are downloaded on first use."""
+
+    def encode(self, text):
+        return text.split()
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+def test_micro_batcher_grades_concurrent_calls_in_one_call() -> None:
+    batch_sizes = []
+
+    def grade(document):
+        if document == "broken":
+            raise ValueError("bad document")
+        return "yes" if "memory" in document else "no"
+
+    def documents_in(text):
+        return re.findall(r"Retrieved document: \n\n (.*?) \n\n User question", text)
+
+    def structured_llm(prompt):
+        return GradeDocuments(binary_score=grade(documents_in(prompt.to_string())[0]))
+
+    def structured_batch_llm(messages):
+        # the grader's own instructions come once, then every call as a numbered item
+        assert messages[0].content.startswith("You are a grader assessing relevance")
+        documents = documents_in(messages[1].content)
+        assert messages[1].content.count("Item ") == len(documents)
+        batch_sizes.append(len(documents))
+        return batch_schema(GradeDocuments)(binary_scores=[grade(d) for d in documents])
+
+    batcher = MicroBatcher(
+        grade_prompt,
+        RunnableLambda(structured_llm),
+        RunnableLambda(structured_batch_llm),
+        GradeDocuments,
+        window_ms=20,
+        max_size=4,
+    )
+    documents = ["memory 1", "cooking", "memory 2", "weather", "memory 3", "broken", "memory 4"]
+
+    async def grade_all():
+        calls = [{"question": f"q{i}", "document": d} for i, d in enumerate(documents)]
+        return await asyncio.gather(
+            *(batcher.ainvoke(inputs) for inputs in calls), return_exceptions=True
+        )
+
+    results = asyncio.run(grade_all())
+    # one full batch right away, the rest once the window closes; the second one fails as a whole
+    # and is graded one by one
+    assert batch_sizes == [4, 3]
+    assert (batcher.batches, batcher.calls) == (2, 7)
+    assert [r.binary_score for r in results[:5]] == ["yes", "no", "yes", "no", "yes"]
+    # a failure only reaches the caller whose input caused it
+    assert isinstance(results[5], ValueError)
+    assert results[6].binary_score == "yes"
+    # a call alone in its window and sync calls go straight to the single grader
+    one = asyncio.run(batcher.ainvoke({"question": "q", "document": "memory"}))
+    assert one.binary_score == "yes"
+    assert batcher.invoke({"question": "q", "document": "cooking"}).binary_score == "no"
+    assert batch_sizes == [4, 3]
+
+
+def test_pack_documents_keeps_the_most_relevant_within_budget() -> None:
+    def document(words, score=None):
+        metadata = {} if score is None else {RELEVANCE_SCORE: score}
+        return Document(page_content=" ".join(["word"] * words), metadata=metadata)
+
+    documents = [
+        document(40, 0.5),
+        document(40, 0.9),
+        document(40, 0.1),
+        # a document without a retriever score
+        document(500),
+    ]
+    packed = pack_documents(documents, 100, WordEncoding())
+    # the two best fit whole and the third is cut to the 20 words left, which is below the minimum
+    assert [d.metadata[RELEVANCE_SCORE] for d in packed] == [0.5, 0.9]
+
+    packed = pack_documents(documents, 150, WordEncoding())
+    # the scored documents fit in their original order, the 30 words left are too few for the last
+    assert [len(d.page_content.split()) for d in packed] == [40, 40, 40]
+    assert packed[2].metadata == {RELEVANCE_SCORE: 0.1}
+    packed = pack_documents(documents, 200, WordEncoding())
+    assert len(packed[3].page_content.split()) == 80 and packed[3].metadata[TRUNCATED]
+
+    # web results are searched because retrieval fell short, so they beat every scored document
+    def web_results(words, word):
+        return Document(page_content=" ".join([word] * words), metadata={WEB_RESULTS: True})
+
+    packed = pack_documents(documents[:3] + [web_results(50, "web")], 100, WordEncoding())
+    assert [d.metadata.get(RELEVANCE_SCORE) for d in packed] == [0.9, None]
+    assert packed[1].page_content.split()[0] == "web"
+    # and the latest search comes first
+    searches = [web_results(60, "first"), web_results(60, "second")]
+    packed = pack_documents(searches, 100, WordEncoding())
+    assert [(d.page_content.split()[0], len(d.page_content.split())) for d in packed] == [
+        ("first", 40),
+        ("second", 60),
+    ]
+
+    # small prompts and a budget of 0 are passed through without counting
+    assert pack_documents(documents[:1], 1000, encoding=None) == documents[:1]
+    assert pack_documents(documents, 0, encoding=None) == documents
+
+
+def test_documents_are_rendered_as_compact_numbered_blocks() -> None:
+    from graph.chains.hallucination_grader import hallucination_grader, hallucination_prompt
+
+    documents = [
+        Document(page_content="Agents use\n\n  short-term   memory.", metadata={"source": "a.html"}),
+        Document(page_content="Long-term memory is a vector store.", metadata={"source": "b.html"}),
+    ]
+    assert format_documents(documents) == (
+        "[1] Agents use short-term memory.\n\n[2] Long-term memory is a vector store."
+    )
+    assert format_documents(documents[:1], with_sources=True) == (
+        "[1] (source: a.html) Agents use short-term memory."
+    )
+
+    prompt = with_formatted_documents(hallucination_prompt, "documents")
+    text = prompt.invoke({"documents": documents, "generation": "answer"}).to_string()
+    assert "[2] Long-term memory is a vector store." in text
+    assert "page_content" not in text and "metadata" not in text
+    # the verdict cache is still keyed on the prompt variables only
+    assert hallucination_grader.input_keys == {"documents", "generation"}
+
+
+def test_tavily_results_are_cached_by_normalized_query(tmp_path, monkeypatch) -> None:
+    from langchain_tavily import TavilySearch
+
+    cache = search_cache.SearchCache(str(tmp_path / "search.sqlite"), max_entries=10)
+    monkeypatch.setattr(search_cache, "get_search_cache", lambda: cache)
+    searches = []
+
+    def fake_run(self, query, run_manager=None, **kwargs):
+        searches.append(query)
+        if query == "broken":
+            return {"error": ValueError("rate limited")}
+        return {"query": query, "results": [{"content": f"results for {query}"}]}
+
+    async def fake_arun(self, query, run_manager=None, **kwargs):
+        return fake_run(self, query, run_manager, **kwargs)
+
+    monkeypatch.setattr(TavilySearch, "_run", fake_run)
+    monkeypatch.setattr(TavilySearch, "_arun", fake_arun)
+    tool = search_cache.CachedTavilySearch(max_results=3)
+
+    tool.invoke({"query": "Who won the world cup?"})
+    # the same query spelled differently, sync or async, is answered from the cache
+    result = tool.invoke({"query": "  who won the WORLD cup "})
+    assert result["results"] == [{"content": "results for Who won the world cup?"}]
+    asyncio.run(tool.ainvoke({"query": "who won the world cup"}))
+    assert len(searches) == 1
+    assert cache.stats() == {"hits": 2, "misses": 1, "hit_rate": 2 / 3, "entries": 1}
+
+    # other settings change the results, so they are searched again
+    search_cache.CachedTavilySearch(max_results=5).invoke({"query": "Who won the world cup?"})
+    tool.invoke({"query": "Who won the world cup?", "topic": "news"})
+    assert len(searches) == 3
+    # a setting made on the tool wins over the call's, like in TavilySearch, so they share results
+    news = search_cache.CachedTavilySearch(max_results=3, topic="news")
+    news.invoke({"query": "Who won the world cup?", "topic": "finance"})
+    assert len(searches) == 3
+
+    # failures are not cached and expired results are searched again
+    tool.invoke({"query": "broken"})
+    tool.invoke({"query": "broken"})
+    assert searches.count("broken") == 2
+    short_lived = search_cache.CachedTavilySearch(max_results=3, cache_ttl=-1)
+    short_lived.invoke({"query": "weather in Paris"})
+    short_lived.invoke({"query": "weather in Paris"})
+    assert searches.count("weather in Paris") == 2
@@ -0,0 +1,130 @@
+import gzip
+import heapq
+import json
+import math
+import re
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Tuple
+
+from langchain_core.vectorstores import VectorStore
+
+from indexing.shards import iter_shards
+
+# Dense retrieval alone is weak for keyword-heavy questions (product names, CVE ids, ...).
+# This is a small BM25 inverted index over the chunks in the collection. It only stores chunk ids and
+# term frequencies, the chunk texts stay in Chroma.
+K1 = 1.5
+B = 0.75
+
+# keep compound tokens like "cve-2023-4863" or "gpt-4" whole, and also index their parts
+_TOKEN = re.compile(r"[a-z0-9]+(?:[-_.][a-z0-9]+)*")
+_PART = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for token in _TOKEN.findall(text.lower()):
+        tokens.append(token)
+        parts = _PART.findall(token)
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return tokens
+
+
+class BM25Index:
+    """Inverted index with BM25 scoring, keyed by the chunk ids of the vector store."""
+
+    def __init__(
+        self,
+        ids: List[str],
+        doc_lengths: List[int],
+        postings: Dict[str, List[Tuple[int, int]]],
+        k1: float = K1,
+        b: float = B,
+    ) -> None:
+        self.ids = ids
+        self.doc_lengths = doc_lengths
+        self.postings = postings
+        self.k1 = k1
+        self.b = b
+        self.avg_length = sum(doc_lengths) / len(doc_lengths) if doc_lengths else 0.0
+
+    @classmethod
+    def build(cls, docs: Iterable[Tuple[str, str]], **kwargs) -> "BM25Index":
+        """
+        Index (chunk id, text) pairs.
+
+        Args:
+            docs (Iterable[Tuple[str, str]]): Chunk ids and their texts
+
+        Returns:
+            BM25Index: The index
+        """
+        ids: List[str] = []
+        doc_lengths: List[int] = []
+        postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        for doc_id, text in docs:
+            tokens = tokenize(text)
+            for term, tf in Counter(tokens).items():
+                postings[term].append((len(ids), tf))
+            ids.append(doc_id)
+            doc_lengths.append(len(tokens))
+        return cls(ids, doc_lengths, dict(postings), **kwargs)
+
+    @classmethod
+    def from_vectorstore(cls, vectorstore: VectorStore, page_size: int = 1000) -> "BM25Index":
+        """Index every chunk of a Chroma collection or all its shards, page by page. Nothing is re-embedded."""
+
+        def pages():
+            for shard in iter_shards(vectorstore):
+                offset = 0
+                while True:
+                    page = shard.get(limit=page_size, offset=offset, include=["documents"])
+                    if not page["ids"]:
+                        break
+                    yield from zip(page["ids"], page["documents"])
+                    offset += len(page["ids"])
+
+        return cls.build(pages())
+
+    def search(self, query: str, k: int = 4) -> List[Tuple[str, float]]:
+        """
+        Score the chunks against the query.
+
+        Args:
+            query (str): The question
+            k (int): How many chunks to return
+
+        Returns:
+            List[Tuple[str, float]]: (chunk id, BM25 score) pairs, best first
+        """
+        n_docs = len(self.ids)
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_idx, tf in postings:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_idx] / self.avg_length)
+                scores[doc_idx] += idf * tf * (self.k1 + 1) / (tf + norm)
+        best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [(self.ids[doc_idx], score) for doc_idx, score in best]
+
+    def save(self, path: str) -> None:
+        data = {
+            "k1": self.k1,
+            "b": self.b,
+            "ids": self.ids,
+            "doc_lengths": self.doc_lengths,
+            "postings": self.postings,
+        }
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            data = json.load(f)
+        postings = {term: [tuple(p) for p in plist] for term, plist in data["postings"].items()}
+        return cls(data["ids"], data["doc_lengths"], postings, k1=data["k1"], b=data["b"])
@@ -0,0 +1,140 @@
+import hashlib
+import re
+from collections import defaultdict
+from typing import Collection, Dict, List, Optional, Set
+
+import numpy as np
+from langchain_core.documents import Document
+
+# Crawled pages repeat a lot of text: navigation, footers, syndicated posts, several versions of the
+# same page. Stored as-is, the copies inflate the index, crowd the retriever's top-k and then get
+# graded one by one by grade_documents. Before embedding, every chunk gets a MinHash signature, and
+# locality-sensitive hashing over bands of the signature finds earlier chunks that are probably
+# similar. A chunk whose estimated Jaccard similarity with one of them reaches the threshold is dropped.
+NUM_PERM = 128
+BANDS = 16  # 16 bands of 8 rows put the LSH candidate threshold around 0.7
+SHINGLE_SIZE = 3
+DEDUP_THRESHOLD = 0.8
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> Set[str]:
+    """Word n-grams of the lower-cased text, so whitespace and punctuation changes don't matter."""
+    words = _TOKEN_RE.findall(text.lower())
+    if len(words) <= size:
+        return {" ".join(words)}
+    return {" ".join(words[i : i + size]) for i in range(len(words) - size + 1)}
+
+
+class MinHasher:
+    """Computes MinHash signatures with NUM_PERM universal hash functions."""
+
+    def __init__(self, num_perm: int = NUM_PERM, seed: int = 1) -> None:
+        rng = np.random.RandomState(seed)
+        # a and b stay below 2**32, so a * h + b never overflows 64 bits for 32 bit shingle hashes
+        self.a = rng.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = np.fromiter(
+            (
+                int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little")
+                for s in shingles(text)
+            ),
+            dtype=np.uint64,
+        )
+        permuted = (np.outer(hashes, self.a) + self.b) % _MERSENNE_PRIME & _MAX_HASH
+        return permuted.min(axis=0).astype(np.uint32)
+
+
+class NearDuplicateFilter:
+    """
+    Drops chunks that are near-duplicates of a chunk seen earlier in the same ingestion run.
+
+    A copy that is already embedded, its id being in the manifest, always wins: pages are fetched
+    concurrently, and letting whichever copy arrives first win would embed a new copy and delete the
+    old one on every run. When the known copy shows up after a new one was kept, the new one is
+    revoked and listed in revoked, for the pipeline to take out again. Among new copies the first
+    one is kept, and from the next run on it is the known one.
+    """
+
+    def __init__(
+        self, threshold: float = DEDUP_THRESHOLD, num_perm: int = NUM_PERM, bands: int = BANDS
+    ) -> None:
+        """
+        Args:
+            threshold (float): Estimated Jaccard similarity of the shingles from which a chunk is a duplicate
+            num_perm (int): Length of the MinHash signatures
+            bands (int): LSH bands, num_perm must be a multiple of it
+        """
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.hasher = MinHasher(num_perm)
+        self.signatures: List[np.ndarray] = []
+        # chunk id of every kept signature, and whether it was already embedded
+        self.ids: List[Optional[str]] = []
+        self.known: List[bool] = []
+        self.revoked: List[str] = []
+        self.buckets: List[Dict[bytes, List[int]]] = [defaultdict(list) for _ in range(bands)]
+        self.removed = 0
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [
+            signature[band * self.rows : (band + 1) * self.rows].tobytes()
+            for band in range(self.bands)
+        ]
+
+    def is_duplicate(self, text: str, doc_id: Optional[str] = None, known: bool = False) -> bool:
+        """
+        Check the text against the kept chunks, and remember it if it is kept.
+
+        Args:
+            text (str): The chunk text
+            doc_id (str): Its chunk id
+            known (bool): Whether the chunk is already embedded, it then replaces a new kept copy
+
+        Returns:
+            bool: True if the chunk should be dropped
+        """
+        signature = self.hasher.signature(text)
+        keys = self._band_keys(signature)
+        candidates = {i for band, key in enumerate(keys) for i in self.buckets[band].get(key, ())}
+        for i in sorted(candidates):
+            if np.mean(self.signatures[i] == signature) >= self.threshold:
+                self.removed += 1
+                if not known or self.known[i]:
+                    return True
+                # the revoked copy's signature stays, copies of it are still dropped
+                self.revoked.append(self.ids[i])
+                self.known[i] = True
+                break
+        index = len(self.signatures)
+        self.signatures.append(signature)
+        self.ids.append(doc_id)
+        self.known.append(known)
+        for band, key in enumerate(keys):
+            self.buckets[band][key].append(index)
+        return False
+
+    def filter(
+        self, chunks: Dict[str, Document], known_ids: Collection[str] = ()
+    ) -> Dict[str, Document]:
+        """
+        Args:
+            chunks (Dict[str, Document]): chunk id -> chunk of one source, as built by group_by_source
+            known_ids (Collection[str]): Ids of the chunks of this source that are already embedded
+
+        Returns:
+            Dict[str, Document]: The chunks that are not near-duplicates of anything kept so far
+        """
+        return {
+            doc_id: doc
+            for doc_id, doc in chunks.items()
+            if not self.is_duplicate(doc.page_content, doc_id, doc_id in known_ids)
+        }
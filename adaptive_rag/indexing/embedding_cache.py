@@ -0,0 +1,147 @@
+import hashlib
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from indexing import sqlite_cache
+from indexing.sqlite_cache import EVICT_TO, connect
+
+# Every rebuild and every query used to re-embed text we had already embedded before.
+# This wraps any Embeddings (OpenAIEmbeddings here) with an on-disk SQLite cache keyed by the model name
+# and the hash of the text. The same file can be shared by ingestion, the retriever and several processes.
+# When the cache grows past max_bytes, the least recently used vectors are evicted.
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings with a persistent, size-bounded, LRU cache for documents and queries."""
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        path: str,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        model: Optional[str] = None,
+    ) -> None:
+        """
+        Args:
+            embeddings (Embeddings): The embeddings model that is called on cache misses
+            path (str): SQLite file of the cache, created if missing
+            max_bytes (int): Size of the stored vectors above which the oldest entries are evicted
+            model (str): Cache namespace, defaults to the model name of the wrapped embeddings
+        """
+        self.embeddings = embeddings
+        self.model = model or getattr(embeddings, "model", type(embeddings).__name__)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # ingestion embeds from worker threads, so one connection is shared behind a lock
+        self._conn = connect(path)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, hash)
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+        self._size = self._stored_bytes()
+
+    def _stored_bytes(self) -> int:
+        return self._conn.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+
+    def _lookup(self, hashes: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        stale = []
+        now = time.time()
+        with self._lock:
+            # stay below SQLite's limit of host parameters per statement
+            for start in range(0, len(hashes), 500):
+                chunk = hashes[start : start + 500]
+                rows = self._conn.execute(
+                    f"SELECT hash, vector, last_used FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(chunk))})",
+                    [self.model, *chunk],
+                ).fetchall()
+                for h, v, last_used in rows:
+                    found[h] = np.frombuffer(v, dtype=np.float32).tolist()
+                    # like SQLiteCache, a hit only writes when last_used is stale enough to matter
+                    # for eviction, so texts that keep hitting don't commit on every call
+                    if last_used < now - sqlite_cache.TOUCH_INTERVAL:
+                        stale.append(h)
+            if stale:
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND hash = ?",
+                    [(now, self.model, h) for h in stale],
+                )
+                self._conn.commit()
+        return found
+
+    def _store(self, vectors: Dict[str, List[float]]) -> None:
+        now = time.time()
+        rows = [
+            (self.model, h, np.asarray(v, dtype=np.float32).tobytes(), now)
+            for h, v in vectors.items()
+        ]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            self._conn.commit()
+            self._size += sum(len(row[2]) for row in rows)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        # other processes write to the same file, so recount before deciding how much to drop
+        self._size = self._stored_bytes()
+        target = self.max_bytes * EVICT_TO
+        while self._size > target:
+            rows = self._conn.execute(
+                "SELECT model, hash, LENGTH(vector) FROM embeddings ORDER BY last_used LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                break
+            victims = []
+            for model, h, size in rows:
+                victims.append((model, h))
+                self._size -= size
+                if self._size <= target:
+                    break
+            self._conn.executemany("DELETE FROM embeddings WHERE model = ? AND hash = ?", victims)
+            self._conn.commit()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes = [text_hash(text) for text in texts]
+        cached = self._lookup(list(set(hashes)))
+        missing = {h: text for h, text in zip(hashes, texts) if h not in cached}
+        n_missing = sum(h in missing for h in hashes)
+        self.hits += len(texts) - n_missing
+        self.misses += n_missing
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            # round to float32 like the stored copy, so a hit and a miss return the same vector
+            new = {h: np.asarray(v, dtype=np.float32).tolist() for h, v in zip(missing, vectors)}
+            self._store(new)
+            cached.update(new)
+        return [cached[h] for h in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        # queries live in their own namespace, some models embed queries differently from documents
+        h = "query:" + text_hash(text)
+        cached = self._lookup([h])
+        if h in cached:
+            self.hits += 1
+            return cached[h]
+        self.misses += 1
+        vector = np.asarray(self.embeddings.embed_query(text), dtype=np.float32).tolist()
+        self._store({h: vector})
+        return vector
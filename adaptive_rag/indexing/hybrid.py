@@ -0,0 +1,98 @@
+from typing import Dict, List, Tuple
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
+
+from indexing.bm25 import BM25Index
+
+# Constant of reciprocal rank fusion, 60 is the value from the original paper.
+RRF_K = 60
+# metadata key of the vector store's relevance score in [0, 1], grade_documents uses it to skip the
+# LLM grader for documents that are obviously relevant or irrelevant
+RELEVANCE_SCORE = "relevance_score"
+
+
+def with_relevance_scores(docs_and_scores: List[Tuple[Document, float]]) -> List[Document]:
+    """Copies of the documents with their relevance score added to the metadata."""
+    return [
+        Document(
+            id=doc.id,
+            page_content=doc.page_content,
+            metadata={**doc.metadata, RELEVANCE_SCORE: score},
+        )
+        for doc, score in docs_and_scores
+    ]
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], rrf_k: int = RRF_K) -> Dict[str, float]:
+    """
+    Fuse several rankings of ids into one score per id.
+
+    Rank fusion only looks at positions, so it doesn't matter that BM25 and cosine scores live on
+    completely different scales.
+
+    Args:
+        rankings (List[List[str]]): Ids ordered best first, one list per retriever
+        rrf_k (int): Dampens the weight of the top ranks
+
+    Returns:
+        Dict[str, float]: Fused score per id, higher is better
+    """
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (rrf_k + rank + 1)
+    return scores
+
+
+class HybridRetriever(BaseRetriever):
+    """Retrieve with both the vector store and the BM25 index, fused with reciprocal rank fusion."""
+
+    vectorstore: VectorStore
+    bm25: BM25Index
+    # final number of documents, the same default as vectorstore.as_retriever()
+    k: int = 4
+    # how deep each retriever ranks before fusion
+    fetch_k: int = 20
+    rrf_k: int = RRF_K
+
+    model_config = {"arbitrary_types_allowed": True}
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        dense = with_relevance_scores(
+            self.vectorstore.similarity_search_with_relevance_scores(query, k=self.fetch_k)
+        )
+        sparse = self.bm25.search(query, k=self.fetch_k)
+
+        docs_by_id = {doc.id: doc for doc in dense}
+        scores = reciprocal_rank_fusion(
+            [[doc.id for doc in dense], [doc_id for doc_id, _ in sparse]], self.rrf_k
+        )
+        top_ids = sorted(scores, key=scores.get, reverse=True)[: self.k]
+
+        # lexical-only hits are not in the dense results, fetch their text from the store; they come
+        # without a relevance score
+        missing = [doc_id for doc_id in top_ids if doc_id not in docs_by_id]
+        if missing:
+            docs_by_id.update((doc.id, doc) for doc in self.vectorstore.get_by_ids(missing))
+        return [docs_by_id[doc_id] for doc_id in top_ids if doc_id in docs_by_id]
+
+
+class DenseRetriever(BaseRetriever):
+    """Plain vector search like vectorstore.as_retriever(), but keeping the relevance scores."""
+
+    vectorstore: VectorStore
+    k: int = 4
+
+    model_config = {"arbitrary_types_allowed": True}
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return with_relevance_scores(
+            self.vectorstore.similarity_search_with_relevance_scores(query, k=self.k)
+        )
@@ -0,0 +1,196 @@
+import asyncio
+import hashlib
+import json
+import os
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, Iterable, Iterator, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+import aiohttp
+from bs4 import BeautifulSoup
+from langchain_core.documents import Document
+
+# Fetching the pages one after the other makes ingestion time grow linearly with the url list.
+# Here we fetch them concurrently on one event loop, with a global cap, a smaller cap per host so we
+# don't hammer a single site, and retries with exponential backoff for flaky responses. A page that
+# still fails after its retries is logged and skipped, the rest of the crawl goes on.
+MAX_CONCURRENCY = 16
+MAX_PER_HOST = 4
+MAX_RETRIES = 3
+# urls read ahead of the ones in flight, per max_concurrency, so a host that is at its limit doesn't
+# keep the other hosts waiting
+LOOKAHEAD = 4
+RETRY_BACKOFF = 0.5
+REQUEST_TIMEOUT = 30
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# a saved snapshot directory keeps the original url of every file here, so offline re-runs produce
+# exactly the same chunk ids as an online crawl
+SOURCES_INDEX = "sources.jsonl"
+LOCAL_EXTENSIONS = (".html", ".htm", ".md", ".markdown")
+
+
+def html_to_document(html: str, source: str) -> Document:
+    """Turn a raw html page into a Document, the same way WebBaseLoader does."""
+    soup = BeautifulSoup(html, "html.parser")
+    metadata = {"source": source}
+    if title := soup.find("title"):
+        metadata["title"] = title.get_text()
+    if description := soup.find("meta", attrs={"name": "description"}):
+        metadata["description"] = description.get("content", "No description found.")
+    if html_tag := soup.find("html"):
+        metadata["language"] = html_tag.get("lang", "No language found.")
+    return Document(page_content=soup.get_text(), metadata=metadata)
+
+
+async def _fetch_page(
+    session: aiohttp.ClientSession,
+    url: str,
+    global_limit: asyncio.Semaphore,
+    host_limits: Dict[str, asyncio.Semaphore],
+    per_host: int,
+    retries: int,
+) -> str:
+    host_limit = host_limits.setdefault(urlparse(url).netloc, asyncio.Semaphore(per_host))
+    for attempt in range(retries + 1):
+        try:
+            # host first: a request waiting on a busy host must not hold a global slot
+            async with host_limit, global_limit:
+                async with session.get(url) as response:
+                    response.raise_for_status()
+                    return await response.text()
+        except aiohttp.ClientResponseError as e:
+            # a 404 won't get better by asking again
+            if e.status not in RETRY_STATUSES or attempt == retries:
+                raise
+            error = e
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == retries:
+                raise
+            error = e
+        print(f"---FETCH RETRY {attempt + 1}/{retries}: {url} ({error!r})---")
+        # back off outside of the semaphores so other hosts keep going
+        await asyncio.sleep(RETRY_BACKOFF * 2**attempt)
+
+
+def _client_session() -> aiohttp.ClientSession:
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+    headers = {"User-Agent": os.getenv("USER_AGENT", "langgraph-rag-ingestion")}
+    return aiohttp.ClientSession(timeout=timeout, headers=headers)
+
+
+async def aiter_pages(
+    urls: Iterable[str],
+    max_concurrency: int = MAX_CONCURRENCY,
+    per_host: int = MAX_PER_HOST,
+    retries: int = MAX_RETRIES,
+    failed: Optional[Set[str]] = None,
+) -> AsyncIterator[Tuple[str, str]]:
+    """
+    Download the raw html of the urls concurrently and yield the pages as they arrive.
+
+    At most max_concurrency pages are fetched or waiting to be consumed at any time, so memory
+    stays bounded no matter how long the url list is. A url is only started once its host has a
+    free slot, urls of other hosts further down the list go first meanwhile.
+
+    Args:
+        urls (Iterable[str]): Pages to fetch, read lazily
+        max_concurrency (int): Requests in flight over all hosts
+        per_host (int): Requests in flight against one host
+        retries (int): Extra attempts for connection errors, timeouts and 429/5xx responses
+        failed (Set[str]): Collects the urls that could not be fetched, they are skipped
+
+    Yields:
+        Tuple[str, str]: (url, html) pairs in completion order
+    """
+    global_limit = asyncio.Semaphore(max_concurrency)
+    host_limits: Dict[str, asyncio.Semaphore] = {}
+    url_iter = iter(urls)
+    # urls read but not started yet, by host
+    waiting: Dict[str, Deque[str]] = {}
+    buffered = 0
+    in_flight: Dict[str, int] = {}
+    pending: Dict[asyncio.Task, str] = {}
+
+    async def fetch(url: str) -> Optional[Tuple[str, str]]:
+        try:
+            html = await _fetch_page(session, url, global_limit, host_limits, per_host, retries)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"---FETCH FAILED: {url} ({e!r})---")
+            if failed is not None:
+                failed.add(url)
+            return None
+        return url, html
+
+    def fill() -> None:
+        nonlocal buffered
+        while buffered < max_concurrency * LOOKAHEAD and (url := next(url_iter, None)) is not None:
+            waiting.setdefault(urlparse(url).netloc, deque()).append(url)
+            buffered += 1
+        for host, queue in waiting.items():
+            while queue and in_flight.get(host, 0) < per_host and len(pending) < max_concurrency:
+                pending[asyncio.create_task(fetch(queue.popleft()))] = host
+                in_flight[host] = in_flight.get(host, 0) + 1
+                buffered -= 1
+
+    async with _client_session() as session:
+        try:
+            fill()
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    in_flight[pending.pop(task)] -= 1
+                for task in done:
+                    if (page := task.result()) is not None:
+                        yield page
+                    # refill the window only once a page has been handed downstream
+                    fill()
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+def save_snapshot(pages: Iterable[Tuple[str, str]], directory: str) -> None:
+    """Save fetched pages so they can be ingested again with iter_local_directory."""
+    os.makedirs(directory, exist_ok=True)
+    # the index is append only, so pages can be saved one by one while a crawl streams through
+    with open(os.path.join(directory, SOURCES_INDEX), "a", encoding="utf-8") as index:
+        for url, html in pages:
+            filename = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16] + ".html"
+            with open(os.path.join(directory, filename), "w", encoding="utf-8") as f:
+                f.write(html)
+            index.write(json.dumps({"file": filename, "source": url}) + "\n")
+
+
+def iter_local_directory(directory: str) -> Iterator[Document]:
+    """
+    Read saved html and markdown files one at a time, so ingestion can run without network access.
+
+    Args:
+        directory (str): Directory with .html/.htm/.md files, optionally with a sources.jsonl
+            mapping file names to their original urls
+
+    Yields:
+        Document: One document per file, sorted by file name
+    """
+    sources_path = os.path.join(directory, SOURCES_INDEX)
+    sources = {}
+    if os.path.exists(sources_path):
+        with open(sources_path, encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                sources[entry["file"]] = entry["source"]
+
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for filename in sorted(files):
+            if not filename.lower().endswith(LOCAL_EXTENSIONS):
+                continue
+            path = os.path.join(root, filename)
+            source = sources.get(os.path.relpath(path, directory), path)
+            with open(path, encoding="utf-8") as f:
+                content = f.read()
+            if filename.lower().endswith((".html", ".htm")):
+                yield html_to_document(content, source)
+            else:
+                yield Document(page_content=content, metadata={"source": source})
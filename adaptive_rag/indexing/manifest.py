@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Tuple
+
+from langchain_core.documents import Document
+
+# The manifest remembers, for every source URL, the content hashes of the chunks we already embedded.
+# On the next run we only embed the chunks whose hash we have never seen, and we delete the chunks
+# whose hash is gone, so re-indexing a corpus where a few pages changed only costs a few embeddings.
+MANIFEST_VERSION = 1
+
+
+@dataclass
+class IngestStats:
+    """Counts of what an incremental ingestion run changed in the vector store."""
+
+    added: int = 0
+    deleted: int = 0
+    unchanged: int = 0
+    # near-duplicate chunks dropped before embedding
+    duplicates: int = 0
+
+
+def chunk_id(doc: Document) -> str:
+    """
+    Stable id of a chunk: the hash of its source and its content.
+
+    Args:
+        doc (Document): A chunk produced by the text splitter
+
+    Returns:
+        str: Hex sha256 digest used both as the Chroma id and in the manifest
+    """
+    source = doc.metadata.get("source", "")
+    return hashlib.sha256(f"{source}\x00{doc.page_content}".encode("utf-8")).hexdigest()
+
+
+def load_manifest(path: str) -> Dict[str, List[str]]:
+    """Read the source -> chunk ids mapping, an empty mapping if there is no manifest yet."""
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if data.get("version") != MANIFEST_VERSION:
+        # an unknown layout means we can't trust it, so re-index everything
+        return {}
+    return data["sources"]
+
+
+def save_manifest(path: str, sources: Dict[str, List[str]]) -> None:
+    """Write the manifest atomically so a crash never leaves a half written file behind."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"version": MANIFEST_VERSION, "sources": sources}, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def group_by_source(doc_splits: Iterable[Document]) -> Dict[str, Dict[str, Document]]:
+    """Group chunks by source URL, keyed by chunk id and keeping the splitter order."""
+    grouped: Dict[str, Dict[str, Document]] = {}
+    for doc in doc_splits:
+        doc_id = chunk_id(doc)
+        doc.metadata["chunk_id"] = doc_id
+        # the same chunk text twice in one page is stored only once
+        grouped.setdefault(doc.metadata.get("source", ""), {}).setdefault(doc_id, doc)
+    return grouped
+
+
+def diff_source(known_ids: Iterable[str], chunks: Dict[str, Document]) -> Tuple[List[str], List[str]]:
+    """
+    Compare the chunks of one source against what the manifest knows about it.
+
+    Args:
+        known_ids (Iterable[str]): Chunk ids of this source from the previous run
+        chunks (Dict[str, Document]): Current chunks of this source keyed by chunk id
+
+    Returns:
+        Tuple[List[str], List[str]]: Ids to embed and upsert, ids to delete
+    """
+    known = set(known_ids)
+    new_ids = [doc_id for doc_id in chunks if doc_id not in known]
+    stale_ids = sorted(known - chunks.keys())
+    return new_ids, stale_ids
+
@@ -0,0 +1,273 @@
+import json
+import mmap
+import os
+import shutil
+from typing import Any, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from indexing.shards import iter_shards
+
+# Every worker process used to open its own Chroma client and keep its own copy of the index in memory.
+# This read-only store keeps the embeddings as one contiguous float32 matrix in a file that is memory
+# mapped, so the OS page cache holds the index once and all workers on the box share it.
+# The chunk texts are mapped the same way and only the ids are kept in Python objects.
+#
+# Optionally a float16 or int8 copy of the matrix is stored as well. The first pass of a search scans
+# only that smaller copy, then the best candidates are re-scored with the full precision vectors, of
+# which just those few rows get paged in. That keeps the top k close to exact at 1/2 or 1/4 the memory.
+VECTORS_FILE = "vectors.f32"
+QUANTIZED_FILES = {"float16": "vectors.f16", "int8": "vectors.i8"}
+QUANTIZED_DTYPES = {"float16": np.float16, "int8": np.int8}
+# per vector scale of the int8 copy, vector ~= int8 values * scale
+SCALES_FILE = "scales.f32"
+DOCS_FILE = "docs.jsonl"
+OFFSETS_FILE = "offsets.u64"
+IDS_FILE = "ids.json"
+META_FILE = "meta.json"
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+# candidates re-scored in full precision per requested result
+RESCORE_FACTOR = 4
+# rows scanned per block, bounds the temporary float32 copy a quantized block is upcast to
+SEARCH_BLOCK_ROWS = 65536
+
+
+def quantize_int8(vector: np.ndarray) -> Tuple[np.ndarray, float]:
+    """Symmetric per vector int8 quantization, returns the codes and their scale."""
+    scale = float(np.abs(vector).max()) / 127 or 1.0
+    return np.round(vector / scale).astype(np.int8), scale
+
+
+def write_index(
+    directory: str,
+    records: Iterable[Tuple[str, str, dict, Sequence[float]]],
+    quantization: str = "none",
+) -> int:
+    """
+    Write (id, text, metadata, embedding) records as a memory-mappable index.
+
+    The index is written next to the target and swapped in with a rename, so workers that still map
+    the previous files keep a consistent view until they reopen.
+
+    Args:
+        directory (str): Where the index lives
+        records: Chunks with their embeddings, streamed so the corpus never has to fit in memory
+        quantization (str): "none", or "float16" / "int8" to also store a quantized first pass copy
+
+    Returns:
+        int: Number of chunks written
+    """
+    if quantization != "none" and quantization not in QUANTIZED_FILES:
+        raise ValueError(f"unknown quantization {quantization!r}")
+    tmp_dir = directory.rstrip("/") + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    count = 0
+    dim = None
+    ids = []
+    offsets = []
+    scales = []
+    quantized_path = (
+        os.path.join(tmp_dir, QUANTIZED_FILES[quantization])
+        if quantization != "none"
+        else os.devnull
+    )
+    with open(os.path.join(tmp_dir, VECTORS_FILE), "wb") as vectors_file, open(
+        os.path.join(tmp_dir, DOCS_FILE), "wb"
+    ) as docs_file, open(quantized_path, "wb") as q_file:
+        for doc_id, text, metadata, embedding in records:
+            vector = _normalize(np.asarray(embedding, dtype=np.float32))
+            if dim is None:
+                dim = vector.shape[0]
+            vectors_file.write(vector.tobytes())
+            if quantization == "float16":
+                q_file.write(vector.astype(np.float16).tobytes())
+            elif quantization == "int8":
+                codes, scale = quantize_int8(vector)
+                q_file.write(codes.tobytes())
+                scales.append(scale)
+            offsets.append(docs_file.tell())
+            line = json.dumps({"id": doc_id, "text": text, "metadata": metadata or {}})
+            docs_file.write(line.encode("utf-8") + b"\n")
+            ids.append(doc_id)
+            count += 1
+        offsets.append(docs_file.tell())
+    np.asarray(offsets, dtype=np.uint64).tofile(os.path.join(tmp_dir, OFFSETS_FILE))
+    if quantization == "int8":
+        np.asarray(scales, dtype=np.float32).tofile(os.path.join(tmp_dir, SCALES_FILE))
+    with open(os.path.join(tmp_dir, IDS_FILE), "w", encoding="utf-8") as f:
+        json.dump(ids, f)
+    with open(os.path.join(tmp_dir, META_FILE), "w", encoding="utf-8") as f:
+        json.dump({"count": count, "dim": dim or 0, "quantization": quantization}, f)
+
+    old_dir = directory.rstrip("/") + ".old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(directory):
+        os.rename(directory, old_dir)
+    os.rename(tmp_dir, directory)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return count
+
+
+def export_from_chroma(
+    vectorstore: Any, directory: str, quantization: str = "none", page_size: int = 1000
+) -> int:
+    """Copy the chunks and embeddings out of a Chroma collection or its shards, nothing is re-embedded."""
+
+    def records():
+        for shard in iter_shards(vectorstore):
+            offset = 0
+            while True:
+                page = shard.get(
+                    limit=page_size, offset=offset, include=["documents", "metadatas", "embeddings"]
+                )
+                if not len(page["ids"]):
+                    break
+                yield from zip(
+                    page["ids"], page["documents"], page["metadatas"], page["embeddings"]
+                )
+                offset += len(page["ids"])
+
+    return write_index(directory, records(), quantization=quantization)
+
+
+class MmapVectorStore(VectorStore):
+    """Read-only vector store over a memory-mapped float32 matrix, searched with cosine similarity."""
+
+    def __init__(
+        self, directory: str, embedding: Embeddings, rescore_factor: int = RESCORE_FACTOR
+    ) -> None:
+        """
+        Args:
+            directory (str): Index written by write_index or export_from_chroma
+            embedding (Embeddings): Embeds the queries, must be the model the index was built with
+            rescore_factor (int): With a quantized index, k * rescore_factor candidates are re-scored
+        """
+        self.directory = directory
+        self.embedding = embedding
+        self.rescore_factor = rescore_factor
+        with open(os.path.join(directory, META_FILE), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.count = meta["count"]
+        self.dim = meta["dim"]
+        self.quantization = meta.get("quantization", "none")
+        self.vectors = self._map_matrix(VECTORS_FILE, np.float32, self.dim)
+        self.quantized = None
+        self.scales = None
+        if self.quantization != "none":
+            self.quantized = self._map_matrix(
+                QUANTIZED_FILES[self.quantization], QUANTIZED_DTYPES[self.quantization], self.dim
+            )
+        if self.quantization == "int8":
+            self.scales = np.fromfile(os.path.join(directory, SCALES_FILE), dtype=np.float32)
+        self._offsets = np.fromfile(os.path.join(directory, OFFSETS_FILE), dtype=np.uint64)
+        self._docs_file = open(os.path.join(directory, DOCS_FILE), "rb")
+        self._docs = (
+            mmap.mmap(self._docs_file.fileno(), 0, access=mmap.ACCESS_READ) if self.count else b""
+        )
+        with open(os.path.join(directory, IDS_FILE), encoding="utf-8") as f:
+            self._index_of = {doc_id: i for i, doc_id in enumerate(json.load(f))}
+
+    def _map_matrix(self, filename: str, dtype: Any, dim: int) -> np.ndarray:
+        if not self.count:
+            return np.zeros((0, dim), dtype=dtype)
+        # mode "r" maps the file read-only and shared, pages are loaded lazily by the OS
+        return np.memmap(
+            os.path.join(self.directory, filename), dtype=dtype, mode="r", shape=(self.count, dim)
+        )
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding
+
+    def _record(self, i: int) -> dict:
+        return json.loads(self._docs[int(self._offsets[i]) : int(self._offsets[i + 1])])
+
+    def _document(self, i: int) -> Document:
+        record = self._record(i)
+        return Document(id=record["id"], page_content=record["text"], metadata=record["metadata"])
+
+    def _scan(self, matrix: np.ndarray, query: np.ndarray) -> np.ndarray:
+        # block by block, so upcasting a quantized matrix never materializes a full float32 copy
+        scores = np.empty(self.count, dtype=np.float32)
+        for start in range(0, self.count, SEARCH_BLOCK_ROWS):
+            block = matrix[start : start + SEARCH_BLOCK_ROWS]
+            scores[start : start + len(block)] = block.astype(np.float32, copy=False) @ query
+        if self.scales is not None and matrix is self.quantized:
+            scores *= self.scales
+        return scores
+
+    @staticmethod
+    def _best(scores: np.ndarray, k: int) -> np.ndarray:
+        k = min(k, len(scores))
+        if k == 0:
+            return np.zeros(0, dtype=np.int64)
+        # argpartition finds the top k in linear time, only those k get sorted
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top])]
+
+    def _top_k(self, query: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        if self.quantized is None:
+            scores = self._scan(self.vectors, query)
+            top = self._best(scores, k)
+            return top, scores[top]
+        # first pass on the small quantized copy, then exact cosine for the candidates only
+        candidates = np.sort(self._best(self._scan(self.quantized, query), k * self.rescore_factor))
+        exact = np.asarray(self.vectors[candidates]) @ query
+        top = self._best(exact, k)
+        return candidates[top], exact[top]
+
+    def similarity_search_by_vector_with_score(
+        self, embedding: Sequence[float], k: int = 4
+    ) -> List[Tuple[Document, float]]:
+        query = _normalize(np.asarray(embedding, dtype=np.float32))
+        top, scores = self._top_k(query, k)
+        return [(self._document(int(i)), float(score)) for i, score in zip(top, scores)]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self.embedding.embed_query(query), k)
+
+    def similarity_search_by_vector(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k)]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    def _select_relevance_score_fn(self):
+        # cosine similarity in [-1, 1] -> relevance in [0, 1]
+        return lambda score: (score + 1) / 2
+
+    def get_by_ids(self, ids: Sequence[str], /) -> List[Document]:
+        return [
+            self._document(self._index_of[doc_id]) for doc_id in ids if doc_id in self._index_of
+        ]
+
+    def add_texts(
+        self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any
+    ) -> List[str]:
+        raise NotImplementedError(
+            "MmapVectorStore is read-only, rebuild it with export_from_chroma"
+        )
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        **kwargs: Any,
+    ):
+        raise NotImplementedError("MmapVectorStore is read-only, build it with write_index")
@@ -0,0 +1,159 @@
+import asyncio
+from typing import AsyncIterator, Iterable, List, Optional, Set, Union
+
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+from langchain_text_splitters import TextSplitter
+
+from indexing.chunking import ParallelSplitter, aiter_splits
+from indexing.dedup import NearDuplicateFilter
+from indexing.manifest import IngestStats, diff_source, group_by_source, load_manifest, save_manifest
+
+# Instead of holding every page, then every chunk, in memory before the first embedding call, documents
+# flow through fetch -> split -> embed -> upsert one batch at a time. Only a bounded window of batches
+# is ever in flight, so peak memory depends on the batch settings and not on the size of the crawl.
+BATCH_SIZE = 64
+EMBED_CONCURRENCY = 4
+MAX_IN_FLIGHT = 8
+
+
+async def _as_async_iter(documents: Iterable[Document]) -> AsyncIterator[Document]:
+    for doc in documents:
+        yield doc
+
+
+async def astream_ingest(
+    documents: Union[AsyncIterator[Document], Iterable[Document]],
+    text_splitter: Union[TextSplitter, ParallelSplitter],
+    vectorstore: VectorStore,
+    manifest_path: str,
+    batch_size: int = BATCH_SIZE,
+    embed_concurrency: int = EMBED_CONCURRENCY,
+    max_in_flight: int = MAX_IN_FLIGHT,
+    prune_missing_sources: bool = True,
+    dedup: Optional[NearDuplicateFilter] = None,
+    keep_sources: Optional[Set[str]] = None,
+) -> IngestStats:
+    """
+    Split, embed and upsert a stream of documents with bounded memory.
+
+    Only chunks whose id is not in the manifest yet get embedded, and chunks that disappeared from
+    their source are deleted.
+
+    Args:
+        documents: Sync or async stream of full documents, one per source
+        text_splitter: Splitter applied to each document as it arrives, a ParallelSplitter splits
+            several documents at once on other cores
+        vectorstore (VectorStore): The collection to update
+        manifest_path (str): Where the source -> chunk ids manifest lives
+        batch_size (int): Chunks per embedding request
+        embed_concurrency (int): Embedding requests running at the same time
+        max_in_flight (int): Batches allowed to wait for embedding before we stop reading input
+        prune_missing_sources (bool): Also delete chunks of sources that were not part of this run
+        dedup (NearDuplicateFilter): Drops chunks that nearly repeat a chunk seen earlier in the run
+        keep_sources (Set[str]): Sources that could not be read this run, e.g. pages that failed to
+            download; read once the documents are consumed, their chunks are kept as they were
+
+    Returns:
+        IngestStats: How many chunks were added, deleted, left untouched and dropped as duplicates
+    """
+    if not hasattr(documents, "__aiter__"):
+        documents = _as_async_iter(documents)
+
+    manifest = load_manifest(manifest_path)
+    sources = {} if prune_missing_sources else dict(manifest)
+    stats = IngestStats()
+    stale_ids: List[str] = []
+
+    embed_limit = asyncio.Semaphore(embed_concurrency)
+    pending: Set[asyncio.Task] = set()
+    batch_docs: List[Document] = []
+    batch_ids: List[str] = []
+
+    # revoked chunks that were dropped before their batch was embedded
+    skipped: Set[str] = set()
+
+    async def upsert(docs: List[Document], ids: List[str]) -> None:
+        async with embed_limit:
+            # a new chunk whose embedded copy came along while its batch waited is not embedded at all
+            if dedup is not None and dedup.revoked:
+                revoked = set(dedup.revoked)
+                keep = [i for i, doc_id in enumerate(ids) if doc_id not in revoked]
+                skipped.update(doc_id for doc_id in ids if doc_id in revoked)
+                docs, ids = [docs[i] for i in keep], [ids[i] for i in keep]
+            stats.added += len(ids)
+            if ids:
+                await vectorstore.aadd_documents(docs, ids=ids)
+
+    async def flush() -> None:
+        nonlocal batch_docs, batch_ids
+        if not batch_docs:
+            return
+        # backpressure: don't read more input while the window of batches is full
+        while len(pending) >= max_in_flight:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            pending.difference_update(done)
+            for task in done:
+                task.result()
+        pending.add(asyncio.create_task(upsert(batch_docs, batch_ids)))
+        batch_docs, batch_ids = [], []
+
+    try:
+        async for doc, splits in aiter_splits(documents, text_splitter):
+            source = doc.metadata.get("source", "")
+            chunks = group_by_source(splits).get(source, {})
+            if dedup is not None:
+                kept = dedup.filter(chunks, set(manifest.get(source, [])))
+                stats.duplicates += len(chunks) - len(kept)
+                chunks = kept
+            new_ids, stale = diff_source(manifest.get(source, []), chunks)
+            sources[source] = list(chunks)
+            stale_ids.extend(stale)
+            stats.unchanged += len(chunks) - len(new_ids)
+            for doc_id in new_ids:
+                batch_docs.append(chunks[doc_id])
+                batch_ids.append(doc_id)
+                if len(batch_docs) >= batch_size:
+                    await flush()
+        await flush()
+        if pending:
+            await asyncio.gather(*pending)
+    finally:
+        for task in pending:
+            task.cancel()
+
+    # new chunks that were kept until the copy embedded on an earlier run came along, the ones that
+    # were embedded before it did are deleted again
+    revoked = set(dedup.revoked) if dedup is not None else set()
+    embedded_revoked = revoked - skipped
+    if revoked:
+        for source, ids in sources.items():
+            sources[source] = [doc_id for doc_id in ids if doc_id not in revoked]
+        stats.added -= len(embedded_revoked)
+        stats.duplicates += len(revoked)
+    for source in (keep_sources or set()) & (manifest.keys() - sources.keys()):
+        sources[source] = manifest[source]
+    if prune_missing_sources:
+        for source in manifest.keys() - sources.keys():
+            stale_ids.extend(manifest[source])
+    stats.deleted = len(stale_ids)
+    stale_ids.extend(embedded_revoked)
+    # add before delete, so a crash in between leaves extra chunks rather than missing ones
+    for start in range(0, len(stale_ids), batch_size):
+        await vectorstore.adelete(ids=stale_ids[start : start + batch_size])
+    save_manifest(manifest_path, sources)
+
+    return stats
+
+
+def stream_ingest(
+    documents: Union[AsyncIterator[Document], Iterable[Document]],
+    text_splitter: Union[TextSplitter, ParallelSplitter],
+    vectorstore: VectorStore,
+    manifest_path: str,
+    **kwargs,
+) -> IngestStats:
+    """Synchronous entry point for astream_ingest."""
+    return asyncio.run(
+        astream_ingest(documents, text_splitter, vectorstore, manifest_path, **kwargs)
+    )
@@ -0,0 +1,120 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+# The embedding cache, the grader verdict cache and the Tavily search cache all keep their entries
+# in a SQLite file that several worker processes share. connect() opens such a file, and SQLiteCache
+# is the key/value store the verdict and search caches are built on: every entry expires after its
+# TTL, and the least recently used entries are evicted above max_entries.
+
+# evict down to this fraction of max_entries so we don't evict again on the very next insert
+EVICT_TO = 0.9
+# last_used is only rewritten when it is older than this, so hits on popular entries don't turn
+# every read into a write; eviction order is only needed to this precision
+TOUCH_INTERVAL = 600
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Open a cache file shared by threads and processes, creating its directory if missing."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # callers use the connection from worker threads, one connection is shared behind a lock
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+    # WAL lets several processes read while one writes
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+class SQLiteCache:
+    """Persistent, LRU and TTL bounded key/value store shared across processes."""
+
+    def __init__(self, path: str, table: str, ttl: float, max_entries: int) -> None:
+        """
+        Args:
+            path (str): SQLite file of the cache, created if missing
+            table (str): Table of this cache, several caches can share a file
+            ttl (float): Seconds an entry is kept, unless put is given another ttl
+            max_entries (int): Number of entries above which the least recently used are evicted
+        """
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = connect(path)
+        self._conn.execute(f"""CREATE TABLE IF NOT EXISTS {table} (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires REAL NOT NULL,
+                last_used REAL NOT NULL
+            )""")
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_last_used ON {table} (last_used)")
+        self._conn.commit()
+        self._count = self._count_entries()
+
+    def _count_entries(self) -> int:
+        return self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        """The stored value for key, if it has not expired."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, expires, last_used FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or row[1] <= now:
+                self.misses += 1
+                return None
+            if row[2] < now - TOUCH_INTERVAL:
+                self._conn.execute(
+                    f"UPDATE {self.table} SET last_used = ? WHERE key = ?", (now, key)
+                )
+                self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        """Store a value for ttl seconds, the cache's ttl by default."""
+        now = time.time()
+        expires = now + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?)",
+                (key, value, expires, now),
+            )
+            self._conn.commit()
+            self._count += 1
+            if self._count > self.max_entries:
+                self._evict()
+
+    def _evict(self) -> None:
+        self._conn.execute(f"DELETE FROM {self.table} WHERE expires <= ?", (time.time(),))
+        # other processes write to the same file, so recount before deciding how much to drop
+        self._count = self._count_entries()
+        excess = self._count - int(self.max_entries * EVICT_TO)
+        if excess > 0:
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN "
+                f"(SELECT key FROM {self.table} ORDER BY last_used LIMIT ?)",
+                (excess,),
+            )
+            self._count -= excess
+        self._conn.commit()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        """Hits, misses and hit rate of this process, and the entries in the shared file."""
+        with self._lock:
+            entries = self._count_entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "entries": entries,
+        }
@@ -0,0 +1,468 @@
+import asyncio
+import functools
+
+import numpy as np
+import pytest
+from aiohttp import web
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.vectorstores import InMemoryVectorStore
+from langchain_text_splitters import CharacterTextSplitter
+
+from indexing import loaders, sqlite_cache
+from indexing.bm25 import BM25Index
+from indexing.chunking import ParallelSplitter
+from indexing.dedup import NearDuplicateFilter
+from indexing.embedding_cache import CachedEmbeddings, text_hash
+from indexing.hybrid import RELEVANCE_SCORE, HybridRetriever
+from indexing.loaders import aiter_pages, html_to_document, iter_local_directory, save_snapshot
+from indexing.manifest import chunk_id, load_manifest
+from indexing.mmap_store import MmapVectorStore, write_index
+from indexing.pipeline import stream_ingest
+from indexing.shards import ShardedVectorStore, ShardMap
+
+
+def _chunks(source, texts):
+    return [Document(page_content=t, metadata={"source": source}) for t in texts]
+
+
+def test_stream_ingest_only_embeds_changed_chunks(tmp_path) -> None:
+    manifest_path = str(tmp_path / "manifest.json")
+    vectorstore = InMemoryVectorStore(DeterministicFakeEmbedding(size=8))
+    splitter = CharacterTextSplitter(separator=" ", chunk_size=1, chunk_overlap=0)
+
+    def page(source, text):
+        return Document(page_content=text, metadata={"source": source})
+
+    stats = stream_ingest(
+        [page("a", "one two"), page("b", "three")], splitter, vectorstore, manifest_path
+    )
+    assert (stats.added, stats.deleted, stats.unchanged) == (3, 0, 0)
+
+    # "two" changed into "2" and source b is gone
+    stats = stream_ingest([page("a", "one 2")], splitter, vectorstore, manifest_path)
+    assert (stats.added, stats.deleted, stats.unchanged) == (1, 2, 1)
+
+    stored = {record["text"] for record in vectorstore.store.values()}
+    assert stored == {"one", "2"}
+    assert load_manifest(manifest_path) == {"a": [chunk_id(d) for d in _chunks("a", ["one", "2"])]}
+
+
+def test_local_directory_keeps_snapshot_sources(tmp_path) -> None:
+    url = "https://example.com/post/"
+    save_snapshot(
+        [(url, "<html lang='en'><title>Post</title><body>agent memory</body></html>")],
+        str(tmp_path),
+    )
+    (tmp_path / "notes.md").write_text("# Notes\nprompt engineering", encoding="utf-8")
+
+    docs = list(iter_local_directory(str(tmp_path)))
+
+    assert [d.metadata["source"] for d in docs] == [url, str(tmp_path / "notes.md")]
+    assert (
+        docs[0].page_content
+        == html_to_document(
+            "<html lang='en'><title>Post</title><body>agent memory</body></html>", url
+        ).page_content
+    )
+    assert docs[0].metadata["title"] == "Post"
+
+
+class PageServer:
+    """A local aiohttp server, so the page fetching is tested without the network."""
+
+    def __init__(self, handlers) -> None:
+        self.handlers = handlers
+
+    async def __aenter__(self) -> "PageServer":
+        app = web.Application()
+        for path, handler in self.handlers.items():
+            app.router.add_get(path, handler)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.base_url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.runner.cleanup()
+
+
+async def _collect(pages):
+    return [page async for page in pages]
+
+
+def test_aiter_pages_retries_and_yields_in_completion_order(monkeypatch) -> None:
+    monkeypatch.setattr(loaders, "RETRY_BACKOFF", 0)
+    calls = {"flaky": 0}
+
+    async def flaky(request):
+        calls["flaky"] += 1
+        if calls["flaky"] == 1:
+            return web.Response(status=503)
+        return web.Response(text="flaky page")
+
+    async def slow(request):
+        await asyncio.sleep(0.3)
+        return web.Response(text="slow page")
+
+    async def fast(request):
+        return web.Response(text="fast page")
+
+    async def run():
+        async with PageServer({"/flaky": flaky, "/slow": slow, "/fast": fast}) as server:
+            urls = [f"{server.base_url}/{path}" for path in ("slow", "flaky", "fast")]
+            return urls, await _collect(aiter_pages(urls, per_host=3))
+
+    urls, pages = asyncio.run(run())
+
+    assert sorted(pages) == sorted(zip(urls, ["slow page", "flaky page", "fast page"]))
+    assert calls["flaky"] == 2
+    # the slow page doesn't hold back the ones after it
+    assert pages[-1] == (urls[0], "slow page")
+
+
+def test_aiter_pages_limits_requests_per_host() -> None:
+    running = {"now": 0, "peak": 0}
+
+    async def page(request):
+        running["now"] += 1
+        running["peak"] = max(running["peak"], running["now"])
+        await asyncio.sleep(0.05)
+        running["now"] -= 1
+        return web.Response(text=request.path)
+
+    async def run():
+        async with PageServer({"/{name}": page}) as server:
+            urls = [f"{server.base_url}/{i}" for i in range(8)]
+            return await _collect(aiter_pages(urls, max_concurrency=8, per_host=2))
+
+    pages = asyncio.run(run())
+    assert len(pages) == 8
+    assert running["peak"] == 2
+
+
+def test_aiter_pages_busy_host_does_not_block_other_hosts() -> None:
+    running = {"now": 0, "peak": 0}
+    started = []
+
+    def handler(host):
+        async def page(request):
+            started.append(host)
+            running["now"] += 1
+            running["peak"] = max(running["peak"], running["now"])
+            await asyncio.sleep(0.05)
+            running["now"] -= 1
+            return web.Response(text=request.path)
+
+        return {"/{name}": page}
+
+    async def run():
+        # two servers on different ports count as two hosts
+        async with PageServer(handler("a")) as a, PageServer(handler("b")) as b:
+            urls = [f"{a.base_url}/{i}" for i in range(8)] + [f"{b.base_url}/{i}" for i in range(8)]
+            return await _collect(aiter_pages(urls, max_concurrency=4, per_host=2))
+
+    pages = asyncio.run(run())
+    assert len(pages) == 16
+    assert running["peak"] == 4
+    # host b starts right away instead of after host a's urls, while host a is at its limit
+    assert sorted(started[:4]) == ["a", "a", "b", "b"]
+
+
+def test_failed_page_is_skipped_and_keeps_its_chunks(tmp_path) -> None:
+    online = {"/ok", "/flaky"}
+
+    async def page(request):
+        if request.path not in online:
+            return web.Response(status=404)
+        return web.Response(text=f"<html><body>{request.path[1:]} text</body></html>")
+
+    manifest_path = str(tmp_path / "manifest.json")
+    vectorstore = InMemoryVectorStore(DeterministicFakeEmbedding(size=8))
+    splitter = CharacterTextSplitter(separator=" ", chunk_size=1, chunk_overlap=0)
+
+    async def run():
+        async with PageServer({"/{name}": page}) as server:
+            urls = [f"{server.base_url}/ok", f"{server.base_url}/flaky"]
+            first = [html_to_document(html, url) async for url, html in aiter_pages(urls)]
+            await asyncio.to_thread(stream_ingest, first, splitter, vectorstore, manifest_path)
+            manifest = load_manifest(manifest_path)
+
+            online.discard("/flaky")
+            failed = set()
+            second = [html_to_document(h, u) async for u, h in aiter_pages(urls, failed=failed)]
+            stats = await asyncio.to_thread(
+                stream_ingest, second, splitter, vectorstore, manifest_path, keep_sources=failed
+            )
+            return urls, manifest, failed, second, stats
+
+    urls, manifest, failed, second, stats = asyncio.run(run())
+    assert failed == {urls[1]}
+    assert [doc.metadata["source"] for doc in second] == [urls[0]]
+    # the page that failed to download is not mistaken for a removed one
+    assert (stats.added, stats.deleted) == (0, 0)
+    assert load_manifest(manifest_path) == manifest
+
+
+def test_stream_ingest_batches_and_caps_concurrency(tmp_path) -> None:
+    manifest_path = str(tmp_path / "manifest.json")
+    splitter = CharacterTextSplitter(separator=" ", chunk_size=1, chunk_overlap=0)
+
+    class CountingStore(InMemoryVectorStore):
+        running = peak = calls = 0
+
+        async def aadd_documents(self, documents, **kwargs):
+            CountingStore.running += 1
+            CountingStore.calls += 1
+            CountingStore.peak = max(CountingStore.peak, CountingStore.running)
+            await asyncio.sleep(0.01)
+            CountingStore.running -= 1
+            return self.add_documents(documents, **kwargs)
+
+    vectorstore = CountingStore(DeterministicFakeEmbedding(size=8))
+    docs = [
+        Document(page_content=f"w{i} x{i} y{i}", metadata={"source": str(i)}) for i in range(10)
+    ]
+
+    stats = stream_ingest(
+        docs,
+        splitter,
+        vectorstore,
+        manifest_path,
+        batch_size=4,
+        embed_concurrency=2,
+        max_in_flight=2,
+    )
+    assert (stats.added, stats.deleted, stats.unchanged) == (30, 0, 0)
+    assert CountingStore.calls == 8
+    assert CountingStore.peak == 2
+
+    # a second run over a changed crawl only embeds what changed
+    docs[0] = Document(page_content="w0 x0 z0", metadata={"source": "0"})
+    stats = stream_ingest(docs[:5], splitter, vectorstore, manifest_path, batch_size=4)
+    assert (stats.added, stats.deleted, stats.unchanged) == (1, 16, 14)
+    assert len(vectorstore.store) == 15
+
+
+@pytest.mark.parametrize("kind", ["process", "thread"])
+def test_parallel_splitter_matches_serial_split(tmp_path, kind) -> None:
+    make_splitter = functools.partial(
+        CharacterTextSplitter, separator=" ", chunk_size=12, chunk_overlap=0
+    )
+    docs = [
+        Document(page_content=" ".join(f"w{i}-{j}" for j in range(i)), metadata={"source": str(i)})
+        for i in range(40)
+    ]
+    serial = make_splitter().split_documents(docs)
+
+    splitter = ParallelSplitter(make_splitter, workers=3, kind=kind)
+    try:
+        assert splitter.split_documents(docs) == serial
+        vectorstore = InMemoryVectorStore(DeterministicFakeEmbedding(size=8))
+        stats = stream_ingest(docs, splitter, vectorstore, str(tmp_path / "manifest.json"))
+    finally:
+        splitter.shutdown()
+    assert stats.added == len({chunk_id(doc) for doc in serial})
+    assert set(vectorstore.store) == {chunk_id(doc) for doc in serial}
+
+
+def test_near_duplicate_chunks_are_dropped_before_embedding(tmp_path) -> None:
+    article = " ".join(
+        f"sentence {i} about agents planning with memory and tools." for i in range(30)
+    )
+    nav = "Home | Posts | Archive | Tags | FAQ | Subscribe to the newsletter for weekly updates"
+    docs = [
+        Document(page_content=f"{nav}\n\n{article}", metadata={"source": "a"}),
+        # syndicated copy with a different nav bar and a small edit
+        Document(
+            page_content=f"Menu\n\n{article.replace('sentence 3 ', 'Sentence three ')}",
+            metadata={"source": "b"},
+        ),
+        Document(page_content=f"{nav}\n\nSomething else entirely.", metadata={"source": "c"}),
+    ]
+    splitter = CharacterTextSplitter(separator="\n\n", chunk_size=100, chunk_overlap=0)
+    vectorstore = InMemoryVectorStore(DeterministicFakeEmbedding(size=8))
+
+    stats = stream_ingest(
+        docs,
+        splitter,
+        vectorstore,
+        str(tmp_path / "manifest.json"),
+        dedup=NearDuplicateFilter(threshold=0.8),
+    )
+    assert stats.duplicates == 2
+    assert stats.added == 4
+    stored = [record["metadata"]["source"] for record in vectorstore.store.values()]
+    assert sorted(stored) == ["a", "a", "b", "c"]
+
+
+def test_near_duplicate_keeps_the_copy_already_embedded(tmp_path) -> None:
+    article = " ".join(
+        f"sentence {i} about agents planning with memory and tools." for i in range(30)
+    )
+    original = Document(page_content=article, metadata={"source": "a"})
+    copy = Document(
+        page_content=article.replace("sentence 3 ", "Sentence three "), metadata={"source": "b"}
+    )
+    manifest_path = str(tmp_path / "manifest.json")
+    splitter = CharacterTextSplitter(separator="\n\n", chunk_size=100, chunk_overlap=0)
+
+    class RecordingStore(InMemoryVectorStore):
+        embedded = []
+
+        async def aadd_documents(self, documents, **kwargs):
+            RecordingStore.embedded.extend(d.metadata["source"] for d in documents)
+            return self.add_documents(documents, **kwargs)
+
+    vectorstore = RecordingStore(DeterministicFakeEmbedding(size=8))
+
+    def run(docs):
+        return stream_ingest(
+            docs, splitter, vectorstore, manifest_path, dedup=NearDuplicateFilter(threshold=0.8)
+        )
+
+    stats = run([original, copy])
+    assert (stats.added, stats.duplicates) == (1, 1)
+    manifest = load_manifest(manifest_path)
+
+    # the copy is downloaded first this time, the embedded original still wins
+    stats = run([copy, original])
+    assert (stats.added, stats.deleted, stats.unchanged, stats.duplicates) == (0, 0, 1, 1)
+    # the revoked copy was taken out of its batch before it was embedded
+    assert RecordingStore.embedded == ["a"]
+    assert load_manifest(manifest_path) == manifest
+    assert [r["metadata"]["source"] for r in vectorstore.store.values()] == ["a"]
+
+
+def test_cached_embeddings_reuses_vectors_and_evicts(tmp_path, monkeypatch) -> None:
+    class CountingEmbeddings(DeterministicFakeEmbedding):
+        calls: int = 0
+
+        def embed_documents(self, texts):
+            self.calls += len(texts)
+            return super().embed_documents(texts)
+
+    inner = CountingEmbeddings(size=4)
+    path = str(tmp_path / "cache.sqlite")
+    cache = CachedEmbeddings(inner, path, model="fake")
+
+    first = cache.embed_documents(["a", "b", "a"])
+    # a second process opening the same file gets the vectors without calling the model
+    again = CachedEmbeddings(inner, path, model="fake").embed_documents(["b", "a"])
+    assert inner.calls == 2
+    assert again == [first[1], first[0]]
+    assert cache.embed_query("a") == cache.embed_query("a")
+    assert cache.hits == 1
+
+    # a hit only refreshes last_used once it is older than TOUCH_INTERVAL
+    def last_used(text):
+        return cache._conn.execute(
+            "SELECT last_used FROM embeddings WHERE hash = ?", (text_hash(text),)
+        ).fetchone()[0]
+
+    before = last_used("a")
+    cache.embed_documents(["a"])
+    assert last_used("a") == before
+    monkeypatch.setattr(sqlite_cache, "TOUCH_INTERVAL", -1)
+    cache.embed_documents(["a"])
+    assert last_used("a") > before
+
+    # every vector is 16 bytes, keep at most two of them
+    small = CachedEmbeddings(inner, str(tmp_path / "small.sqlite"), max_bytes=32, model="fake")
+    small.embed_documents(["a", "b", "c"])
+    assert small._stored_bytes() <= 32
+
+
+class ScoredInMemoryVectorStore(InMemoryVectorStore):
+    def _select_relevance_score_fn(self):
+        # InMemoryVectorStore returns cosine similarities
+        return lambda score: (score + 1) / 2
+
+
+def test_hybrid_retriever_finds_keyword_matches() -> None:
+    vectorstore = ScoredInMemoryVectorStore(DeterministicFakeEmbedding(size=8))
+    texts = {
+        "agents": "LLM powered autonomous agents use planning and memory",
+        "cve": "The patch for CVE-2023-4863 fixes a heap overflow in libwebp",
+        "prompts": "Chain of thought prompting improves reasoning",
+    }
+    vectorstore.add_documents(
+        [Document(page_content=text, metadata={"source": key}) for key, text in texts.items()],
+        ids=list(texts),
+    )
+    bm25 = BM25Index.build(texts.items())
+    assert bm25.search("cve-2023-4863", k=1)[0][0] == "cve"
+    assert bm25.search("4863", k=1)[0][0] == "cve"
+
+    retriever = HybridRetriever(vectorstore=vectorstore, bm25=bm25, k=2, fetch_k=1)
+    docs = retriever.invoke("what does CVE-2023-4863 fix?")
+    assert "cve" in [doc.id for doc in docs]
+    # dense hits carry their relevance score, lexical-only hits have none
+    dense_id = vectorstore.similarity_search("what does CVE-2023-4863 fix?", k=1)[0].id
+    scored = {doc.id: doc.metadata.get(RELEVANCE_SCORE) for doc in docs}
+    assert 0 <= scored[dense_id] <= 1
+    assert [doc_id for doc_id, score in scored.items() if score is None] != [dense_id]
+
+
+def test_bm25_index_round_trips(tmp_path) -> None:
+    bm25 = BM25Index.build([("a", "agent memory"), ("b", "prompt engineering")])
+    path = str(tmp_path / "bm25.json.gz")
+    bm25.save(path)
+    assert BM25Index.load(path).search("memory") == bm25.search("memory")
+
+
+@pytest.mark.parametrize("quantization", ["none", "float16", "int8"])
+def test_mmap_vector_store_matches_brute_force_cosine(tmp_path, quantization) -> None:
+    embedding = DeterministicFakeEmbedding(size=16)
+    texts = [f"chunk number {i}" for i in range(50)]
+    vectors = embedding.embed_documents(texts)
+    directory = str(tmp_path / "mmap")
+    write_index(
+        directory,
+        (
+            (f"id{i}", text, {"source": "s"}, vector)
+            for i, (text, vector) in enumerate(zip(texts, vectors))
+        ),
+        quantization=quantization,
+    )
+
+    store = MmapVectorStore(directory, embedding)
+    query = embedding.embed_query("question")
+    matrix = np.asarray(vectors)
+    cosine = matrix @ query / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query))
+
+    results = store.similarity_search_by_vector_with_score(query, k=5)
+    assert [doc.id for doc, _ in results] == [f"id{i}" for i in np.argsort(-cosine)[:5]]
+    assert store.get_by_ids(["id7"])[0].page_content == "chunk number 7"
+    assert len(store.as_retriever(search_kwargs={"k": 3}).invoke("question")) == 3
+
+
+def test_sharded_store_merges_shards_and_keeps_assignments(tmp_path) -> None:
+    embedding = DeterministicFakeEmbedding(size=8)
+    map_path = str(tmp_path / "shards.json")
+    docs = [Document(page_content=f"text {i}", metadata={"source": f"s{i}"}) for i in range(12)]
+    ids = [f"id{i}" for i in range(12)]
+
+    single = ScoredInMemoryVectorStore(embedding)
+    single.add_documents(docs, ids=ids)
+    shards = {name: ScoredInMemoryVectorStore(embedding) for name in ("a", "b", "c")}
+    sharded = ShardedVectorStore(shards, ShardMap(map_path, ["a", "b", "c"], "balanced"))
+    sharded.add_documents(docs, ids=ids)
+    sharded.shard_map.save()
+
+    assert all(len(store.store) == 4 for store in shards.values())
+    expected = [doc.id for doc, _ in single.similarity_search_with_relevance_scores("text 3", k=5)]
+    assert [doc.id for doc in sharded.similarity_search("text 3", k=5)] == expected
+    assert [doc.id for doc in sharded.get_by_ids(["id5", "id0"])] == ["id5", "id0"]
+
+    # a new shard only receives new sources
+    grown = ShardMap(map_path, ["a", "b", "c", "d"], "balanced")
+    assert [grown.shard_of(f"s{i}") for i in range(12)] == [
+        sharded.shard_map.shard_of(f"s{i}") for i in range(12)
+    ]
+    assert grown.shard_of("new source") == "d"
+
+    sharded.delete(ids=["id0"])
+    assert sum(len(store.store) for store in shards.values()) == 11
@@ -3,7 +3,16 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from graph.graph import app
+from graph.streaming import stream_answer
 
 if __name__ == "__main__":
     print("Hello Advanced RAG")
-    print(app.invoke(input={"question": "Who was the first CEO of Google Brain Labs Europe?"}))
+    # the answer is printed token by token while it is generated, instead of after grading
+    for event in stream_answer(app, "Who was the first CEO of Google Brain Labs Europe?"):
+        if event["type"] == "token":
+            print(event["content"], end="", flush=True)
+        elif event["type"] == "retract":
+            print("\n---ANSWER RETRACTED, TRYING AGAIN---")
+        else:
+            print(f"\n---FINAL ANSWER ({event['verdict'].upper()})---")
+            print(event["generation"])
@@ -0,0 +1,264 @@
+import asyncio
+import json
+import math
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from langgraph.graph.state import CompiledStateGraph
+
+from graph.config import DEFAULTS
+from graph.graph import app
+from graph.streaming import astream_answer
+
+# A small ASGI service around the compiled graph. The graph runs with app.ainvoke / app.astream, so
+# one process serves many questions at once on its event loop while they wait on the LLM, the
+# vectorstore and Tavily. At most SERVER_MAX_CONCURRENCY questions run at a time, up to
+# SERVER_MAX_QUEUE more wait for a slot, and anything beyond that is turned away right away with a
+# 503 and Retry-After instead of piling up. Run it with:
+#   uvicorn server:api --port 8000
+# Endpoints:
+#   POST /ask         {"question": "...", "configurable": {...}}, answers {"generation", "degraded"}
+#   POST /ask/stream  same body, answers with the events of graph/streaming.py, one JSON per line
+#   GET  /healthz     {"status": "ok", "running": 0, "waiting": 0}
+SERVER_MAX_CONCURRENCY = int(os.getenv("SERVER_MAX_CONCURRENCY", 32))
+SERVER_MAX_QUEUE = int(os.getenv("SERVER_MAX_QUEUE", 64))
+# seconds a client is told to wait before retrying a rejected request
+SERVER_RETRY_AFTER = int(os.getenv("SERVER_RETRY_AFTER", 1))
+MAX_BODY_BYTES = 64 * 1024
+# The run settings of graph/config.py a client may pass in "configurable". Numbers are clamped to
+# these (min, max) ranges, so a client can lower the budgets that bound the cost of one question but
+# not raise them past what the server allows; 0 meaning "no limit" is not accepted for the budgets.
+CONFIGURABLE_RANGES = {
+    "grader_concurrency": (1, int(os.getenv("SERVER_MAX_GRADER_CONCURRENCY", 16))),
+    "max_generations": (1, int(os.getenv("SERVER_MAX_GENERATIONS", DEFAULTS["max_generations"]))),
+    "deadline_seconds": (1.0, float(os.getenv("SERVER_MAX_DEADLINE_SECONDS", 60))),
+    "router_confidence": (0.0, 1.0),
+    "generation_context_tokens": (1, int(os.getenv("SERVER_MAX_CONTEXT_TOKENS", 8000))),
+    "grading_context_tokens": (1, int(os.getenv("SERVER_MAX_CONTEXT_TOKENS", 8000))),
+}
+CONFIGURABLE_CHOICES = {
+    "grader_mode": ("pointwise", "listwise"),
+    "speculative_search": ("on_irrelevant", "eager", "off"),
+}
+CONFIGURABLE_FLAGS = ("prefilter", "local_router", "parallel_generation_grading")
+
+Scope = Dict[str, Any]
+Receive = Callable[[], Awaitable[Dict[str, Any]]]
+Send = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class HTTPError(Exception):
+    def __init__(
+        self, status: int, message: str, headers: Optional[List[Tuple[bytes, bytes]]] = None
+    ):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or []
+
+
+async def _send_json(
+    send: Send, status: int, body: Any, headers: Optional[List[Tuple[bytes, bytes]]] = None
+) -> None:
+    payload = json.dumps(body).encode("utf-8")
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(payload)).encode()),
+                *(headers or []),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": payload})
+
+
+async def _read_json(receive: Receive) -> Dict[str, Any]:
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise HTTPError(400, "client disconnected")
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if len(body) > MAX_BODY_BYTES:
+            raise HTTPError(413, "request body too large")
+    try:
+        request = json.loads(body or b"{}")
+    except json.JSONDecodeError:
+        raise HTTPError(400, "request body is not valid JSON")
+    if not isinstance(request, dict) or not isinstance(request.get("question"), str):
+        raise HTTPError(400, 'expected a JSON object with a "question" string')
+    if not isinstance(request.get("configurable", {}), dict):
+        raise HTTPError(400, '"configurable" must be a JSON object')
+    return request
+
+
+def _run_config(configurable: Dict[str, Any]) -> Dict[str, Any]:
+    """The graph config for the client's settings, checked, converted and clamped."""
+    settings = {}
+    for name, value in configurable.items():
+        if name in CONFIGURABLE_RANGES:
+            low, high = CONFIGURABLE_RANGES[name]
+            kind = type(DEFAULTS[name])
+            try:
+                # bool is an int to Python but not a number to the client
+                if isinstance(value, bool):
+                    raise ValueError
+                number = float(value)
+                if not math.isfinite(number) or (kind is int and not number.is_integer()):
+                    raise ValueError
+            except (TypeError, ValueError):
+                raise HTTPError(400, f'"{name}" must be a number')
+            settings[name] = kind(min(max(number, low), high))
+        elif name in CONFIGURABLE_CHOICES:
+            if value not in CONFIGURABLE_CHOICES[name]:
+                choices = ", ".join(CONFIGURABLE_CHOICES[name])
+                raise HTTPError(400, f'"{name}" must be one of {choices}')
+            settings[name] = value
+        elif name in CONFIGURABLE_FLAGS:
+            if not isinstance(value, bool):
+                raise HTTPError(400, f'"{name}" must be true or false')
+            settings[name] = value
+        else:
+            raise HTTPError(400, f'unknown setting "{name}"')
+    return {"configurable": settings}
+
+
+class RAGService:
+    """ASGI app answering questions with the graph, with a concurrency limit and a bounded queue."""
+
+    def __init__(
+        self,
+        graph: CompiledStateGraph,
+        max_concurrency: int = SERVER_MAX_CONCURRENCY,
+        max_queue: int = SERVER_MAX_QUEUE,
+    ) -> None:
+        """
+        Args:
+            graph (CompiledStateGraph): The compiled RAG graph
+            max_concurrency (int): Questions that run at the same time
+            max_queue (int): Questions that may wait for a slot before new ones get a 503
+        """
+        self.graph = graph
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.running = 0
+        self.waiting = 0
+        # created on first use, so it belongs to the event loop the server runs on
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    def _admit(self) -> None:
+        # backpressure: reject at the door instead of letting the queue grow without bound
+        if self.running + self.waiting >= self.max_concurrency + self.max_queue:
+            raise HTTPError(
+                503,
+                "server is busy, retry later",
+                [(b"retry-after", str(SERVER_RETRY_AFTER).encode())],
+            )
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+
+    async def _acquire(self) -> None:
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+
+    def _release(self) -> None:
+        self.running -= 1
+        self._slots.release()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        route = (scope["method"], scope["path"].rstrip("/"))
+        try:
+            if route == ("GET", "/healthz"):
+                await _send_json(
+                    send, 200, {"status": "ok", "running": self.running, "waiting": self.waiting}
+                )
+            elif route == ("POST", "/ask"):
+                await self._ask(receive, send)
+            elif route == ("POST", "/ask/stream"):
+                await self._ask_stream(receive, send)
+            else:
+                raise HTTPError(404, "not found")
+        except HTTPError as e:
+            await _send_json(send, e.status, {"error": str(e)}, e.headers)
+
+    async def _ask(self, receive: Receive, send: Send) -> None:
+        request = await _read_json(receive)
+        config = _run_config(request.get("configurable", {}))
+        self._admit()
+        await self._acquire()
+        try:
+            result = await self.graph.ainvoke({"question": request["question"]}, config)
+        except Exception as e:
+            print(f"---REQUEST FAILED: {e!r}---")
+            raise HTTPError(500, "the question could not be answered")
+        finally:
+            self._release()
+        await _send_json(
+            send,
+            200,
+            {"generation": result.get("generation"), "degraded": result.get("degraded", False)},
+        )
+
+    async def _ask_stream(self, receive: Receive, send: Send) -> None:
+        request = await _read_json(receive)
+        config = _run_config(request.get("configurable", {}))
+        self._admit()
+        await self._acquire()
+        try:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 200,
+                    "headers": [(b"content-type", b"application/x-ndjson")],
+                }
+            )
+            try:
+                async for event in astream_answer(self.graph, request["question"], config):
+                    line = json.dumps(event).encode("utf-8") + b"\n"
+                    await send({"type": "http.response.body", "body": line, "more_body": True})
+            except Exception as e:
+                # the status line is already sent, the failure is reported as the last event
+                print(f"---REQUEST FAILED: {e!r}---")
+                line = json.dumps({"type": "error", "error": "the question could not be answered"})
+                await send({"type": "http.response.body", "body": line.encode("utf-8") + b"\n"})
+            else:
+                await send({"type": "http.response.body", "body": b""})
+        finally:
+            self._release()
+
+    async def _lifespan(self, receive: Receive, send: Send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+api = RAGService(app)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        api, host=os.getenv("SERVER_HOST", "127.0.0.1"), port=int(os.getenv("SERVER_PORT", 8000))
+    )
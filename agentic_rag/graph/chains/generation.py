@@ -1,8 +1,15 @@
-from langchain_classic import hub
 from langchain_core.output_parsers import StrOutputParser
 from langchain_openai import ChatOpenAI
 
+from graph.chains.prompts import load_prompt
+from graph.chains.serialize import with_formatted_documents
+from graph.consts import ANSWER_TAG
+
 llm = ChatOpenAI(temperature=0)
-prompt = hub.pull("rlm/rag-prompt")
+prompt = load_prompt("rlm/rag-prompt")
 
-generation_chain = prompt | llm | StrOutputParser()
+# tagged so graph.streaming can tell the answer tokens apart from the graders' tokens, the context
+# documents are rendered as numbered plain text, see serialize
+generation_chain = (
+    with_formatted_documents(prompt, "context") | llm | StrOutputParser()
+).with_config(tags=[ANSWER_TAG])
@@ -1,8 +1,12 @@
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnableSequence
+from langchain_core.runnables import Runnable
 from langchain_openai import ChatOpenAI
 from pydantic import BaseModel, Field
 
+from graph.chains.micro_batch import GRADER_BATCH_MAX_SIZE, MicroBatcher, batch_schema
+from graph.chains.serialize import SERIALIZER_VERSION, with_formatted_documents
+from graph.chains.verdict_cache import CachedGrader, prompt_version
+
 llm = ChatOpenAI(temperature=0)
 
 
@@ -18,6 +22,7 @@ class GradeHallucinations(BaseModel):
 
 # cast the LLM answer into a boolean.
 structured_llm_grader = llm.with_structured_output(GradeHallucinations)
+structured_llm_batch_grader = llm.with_structured_output(batch_schema(GradeHallucinations))
 
 system = """You are a grader assessing whether an LLM generation is grounded in / supported by a set of retrieved facts. \n 
      Give a binary score 'yes' or 'no'. 'Yes' means that the answer is grounded in / supported by the set of facts."""
@@ -29,4 +34,24 @@ hallucination_prompt = ChatPromptTemplate.from_messages(
 )
 # create the hallucination greater chain, which is going to take the hallucination prompt.
 # And it's going to pipe it to the structured LLM grader.
-hallucination_grader: RunnableSequence = hallucination_prompt | structured_llm_grader
+# verdicts are memoized per set of documents and generation, see verdict_cache
+# cache misses of concurrent requests are graded together in one call, see micro_batch; every item
+# carries a whole packed context, so fewer of them go into one call
+hallucination_grader: Runnable = CachedGrader(
+    "hallucination_grader",
+    MicroBatcher(
+        # the documents are rendered as numbered plain text, see serialize
+        with_formatted_documents(hallucination_prompt, "documents"),
+        structured_llm_grader,
+        structured_llm_batch_grader,
+        GradeHallucinations,
+        max_size=min(GRADER_BATCH_MAX_SIZE, 4),
+    ),
+    GradeHallucinations,
+    prompt_version(
+        hallucination_prompt,
+        GradeHallucinations.model_json_schema(),
+        llm.model_name,
+        SERIALIZER_VERSION,
+    ),
+)
@@ -0,0 +1,333 @@
+import argparse
+import asyncio
+import json
+import os
+import threading
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+from langchain_core.embeddings import Embeddings
+
+from graph.chains.router import RouteQuery, question_router
+
+load_dotenv()
+
+# question_router costs an LLM round trip before any other work can start. Most questions are
+# obvious, so a nearest-centroid classifier on the question embedding decides them locally: one
+# centroid per datasource, averaged over example questions and over the decisions the LLM router
+# logged. Only when the classifier is not confident enough does the LLM router decide, and that
+# decision is logged so the next fit learns from it. The retriever embeds the same question right
+# after, so with the embedding cache the local route costs no extra embedding call on the RAG path.
+#
+# The classifier is only used once it was calibrated on logged traffic:
+#   python -m graph.chains.local_router
+# cross-validates it against the logged LLM decisions, picks the temperature that gives the best
+# calibrated probabilities and the lowest confidence at which the local routes still agree with the
+# LLM router often enough, and saves both with the centroids. Until then every question goes to the
+# LLM router, which logs the decisions the calibration needs.
+ROUTER_CENTROIDS_PATH = os.getenv("ROUTER_CENTROIDS_PATH", "./.cache/router_centroids.json")
+ROUTING_LOG_PATH = os.getenv("ROUTING_LOG_PATH", "./.cache/routing_log.jsonl")
+# turns the gap between the two cosine similarities into a probability, smaller is more decisive;
+# the calibration picks one of TEMPERATURES, TEMPERATURE is for routers fit without calibration
+TEMPERATURE = 0.02
+TEMPERATURES = (0.005, 0.01, 0.02, 0.05, 0.1)
+# logged LLM decisions needed before the calibration trusts its estimate
+MIN_LOGGED_DECISIONS = int(os.getenv("ROUTER_MIN_LOGGED_DECISIONS", 200))
+# share of the held-out logged decisions the local routes above the threshold must agree with
+ROUTER_TARGET_AGREEMENT = float(os.getenv("ROUTER_TARGET_AGREEMENT", 0.98))
+CALIBRATION_FOLDS = 5
+
+# starting point before there are any logged decisions
+SEED_QUESTIONS = {
+    "vectorstore": [
+        "What are the types of agent memory?",
+        "How do LLM powered autonomous agents plan?",
+        "What is chain of thought prompting?",
+        "How does few-shot prompting work?",
+        "What is tree of thoughts?",
+        "How do agents use tools?",
+        "What are adversarial attacks on LLMs?",
+        "How does a jailbreak prompt work?",
+        "What is prompt injection?",
+        "What is the ReAct framework?",
+    ],
+    "websearch": [
+        "Who won the world cup in 2022?",
+        "What is the weather in Paris today?",
+        "Who founded the Wikimedia Foundation?",
+        "What is the latest iPhone model?",
+        "How tall is the Eiffel Tower?",
+        "What is the capital of Australia?",
+        "When is the next Olympics?",
+        "What is the stock price of Nvidia?",
+        "Who wrote Pride and Prejudice?",
+        "What are the best restaurants in New York?",
+    ],
+}
+
+_log_lock = threading.Lock()
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+def _centroids(vectors: np.ndarray, labels: np.ndarray) -> Dict[str, List[float]]:
+    return {d: vectors[labels == d].mean(axis=0).tolist() for d in sorted(set(labels))}
+
+
+def _softmax(similarities: np.ndarray, temperature: float) -> np.ndarray:
+    logits = similarities / temperature
+    probabilities = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return probabilities / probabilities.sum(axis=-1, keepdims=True)
+
+
+class CentroidRouter:
+    """Routes a question to the datasource whose centroid is closest to its embedding."""
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        centroids: Dict[str, List[float]],
+        temperature: float = TEMPERATURE,
+        min_confidence: float = 0.0,
+    ) -> None:
+        """
+        Args:
+            embeddings (Embeddings): Embeds the questions, must be the model the centroids were fit with
+            centroids (Dict[str, List[float]]): Mean question embedding per datasource
+            temperature (float): Turns the cosine similarities into probabilities
+            min_confidence (float): Calibrated probability below which the LLM router decides
+        """
+        self.embeddings = embeddings
+        self.datasources = list(centroids)
+        self.centroids = _normalize(np.asarray([centroids[d] for d in self.datasources]))
+        self.temperature = temperature
+        self.min_confidence = min_confidence
+
+    @classmethod
+    def fit(cls, embeddings: Embeddings, examples: List[Tuple[str, str]]) -> "CentroidRouter":
+        """
+        Args:
+            embeddings (Embeddings): Embeds the example questions
+            examples (List[Tuple[str, str]]): (question, datasource) pairs
+
+        Returns:
+            CentroidRouter: A router with the normalized mean embedding of each datasource
+        """
+        vectors = _normalize(np.asarray(embeddings.embed_documents([q for q, _ in examples])))
+        return cls(embeddings, _centroids(vectors, np.asarray([d for _, d in examples])))
+
+    @classmethod
+    def calibrate(
+        cls,
+        embeddings: Embeddings,
+        logged: List[Tuple[str, str]],
+        target_agreement: float = ROUTER_TARGET_AGREEMENT,
+        folds: int = CALIBRATION_FOLDS,
+    ) -> "CentroidRouter":
+        """
+        Fit on the seed questions and the logged decisions, and calibrate on the logged decisions.
+
+        Args:
+            embeddings (Embeddings): Embeds the questions
+            logged (List[Tuple[str, str]]): (question, datasource) decisions of the LLM router
+            target_agreement (float): Share of the local routes that must agree with the LLM router
+            folds (int): Cross-validation folds, every logged decision is held out once
+
+        Returns:
+            CentroidRouter: A router with its temperature and min_confidence set
+
+        Raises:
+            ValueError: With too few logged decisions, or when no threshold reaches target_agreement
+        """
+        if len(logged) < MIN_LOGGED_DECISIONS:
+            raise ValueError(
+                f"{len(logged)} logged routing decisions, calibrating needs {MIN_LOGGED_DECISIONS}"
+            )
+        seeds = [(q, d) for d, questions in SEED_QUESTIONS.items() for q in questions]
+        examples = seeds + logged
+        vectors = _normalize(np.asarray(embeddings.embed_documents([q for q, _ in examples])))
+        labels = np.asarray([d for _, d in examples])
+        datasources = sorted(set(labels))
+        # similarities of every logged question to centroids fit without it
+        held_out = np.arange(len(examples)) % folds
+        held_out[: len(seeds)] = -1
+        similarities = np.zeros((len(logged), len(datasources)))
+        for fold in range(folds):
+            rows = held_out == fold
+            centroids = _centroids(vectors[~rows], labels[~rows])
+            centroids = _normalize(np.asarray([centroids[d] for d in datasources]))
+            similarities[rows[len(seeds) :]] = vectors[rows] @ centroids.T
+        truth = np.asarray([datasources.index(d) for _, d in logged])
+
+        # the temperature whose probabilities best predict the LLM router's decisions
+        def log_loss(temperature: float) -> float:
+            probabilities = _softmax(similarities, temperature)[np.arange(len(truth)), truth]
+            return float(-np.log(np.maximum(probabilities, 1e-12)).mean())
+
+        temperature = min(TEMPERATURES, key=log_loss)
+        probabilities = _softmax(similarities, temperature)
+        confidence = probabilities.max(axis=1)
+        agrees = probabilities.argmax(axis=1) == truth
+        # the lowest threshold at which the routes above it agree often enough, so the most
+        # questions skip the LLM router
+        passing = [
+            threshold
+            for threshold in np.unique(confidence)
+            if agrees[confidence >= threshold].mean() >= target_agreement
+        ]
+        if not passing:
+            raise ValueError(f"no confidence threshold reaches {target_agreement:.0%} agreement")
+        min_confidence = float(passing[0])
+        print(
+            f"temperature {temperature}, threshold {min_confidence:.3f}: "
+            f"{(confidence >= min_confidence).mean():.0%} of the logged questions routed locally, "
+            f"{agrees[confidence >= min_confidence].mean():.1%} like the LLM router"
+        )
+        return cls(embeddings, _centroids(vectors, labels), temperature, min_confidence)
+
+    def classify(self, question: str) -> Tuple[RouteQuery, float]:
+        """
+        Returns:
+            Tuple[RouteQuery, float]: The closest datasource and the probability the classifier gives it
+        """
+        query = _normalize(np.asarray(self.embeddings.embed_query(question)))
+        probabilities = _softmax(self.centroids @ query, self.temperature)
+        best = int(np.argmax(probabilities))
+        return RouteQuery(datasource=self.datasources[best]), float(probabilities[best])
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "temperature": self.temperature,
+                    "min_confidence": self.min_confidence,
+                    "centroids": dict(zip(self.datasources, self.centroids.tolist())),
+                },
+                f,
+            )
+
+
+def load_logged_decisions(log_path: str = ROUTING_LOG_PATH) -> List[Tuple[str, str]]:
+    """Every decision the LLM router logged."""
+    if not os.path.exists(log_path):
+        return []
+    with open(log_path, "r", encoding="utf-8") as f:
+        return [
+            (record["question"], record["datasource"])
+            for record in map(json.loads, filter(str.strip, f))
+        ]
+
+
+def load_examples(log_path: str = ROUTING_LOG_PATH) -> List[Tuple[str, str]]:
+    """The seed questions plus every decision the LLM router logged."""
+    examples = [(q, d) for d, questions in SEED_QUESTIONS.items() for q in questions]
+    return examples + load_logged_decisions(log_path)
+
+
+@lru_cache(maxsize=None)
+def get_local_router() -> Optional[CentroidRouter]:
+    """The calibrated centroid router, None until it was calibrated on logged decisions."""
+    if not os.path.exists(ROUTER_CENTROIDS_PATH):
+        return None
+    with open(ROUTER_CENTROIDS_PATH, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if "min_confidence" not in data:
+        # fit on the seed questions alone by an older version, never checked against real traffic
+        return None
+    # the embeddings (and their cache) are the ones the retriever uses
+    from ingestion import get_embeddings
+
+    return CentroidRouter(
+        get_embeddings(), data["centroids"], data["temperature"], data["min_confidence"]
+    )
+
+
+def log_decision(question: str, source: RouteQuery) -> None:
+    os.makedirs(os.path.dirname(ROUTING_LOG_PATH) or ".", exist_ok=True)
+    line = json.dumps({"question": question, "datasource": source.datasource})
+    with _log_lock, open(ROUTING_LOG_PATH, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+
+def route_with_confidence(
+    question: str, use_local: bool = True, min_confidence: float = 0.9
+) -> Tuple[RouteQuery, Optional[float]]:
+    """
+    Route locally when the centroid router is confident, ask question_router otherwise.
+
+    Args:
+        question (str): The user question
+        use_local (bool): Try the centroid router first, False always asks the LLM router
+        min_confidence (float): Probability below which the LLM router decides, the calibrated
+            threshold of the router applies when it is higher
+
+    Returns:
+        Tuple[RouteQuery, Optional[float]]: The route, the same type question_router returns, and
+            the centroid router's confidence, None when it was not used
+    """
+    confidence = None
+    router = get_local_router() if use_local else None
+    if router is not None:
+        source, confidence = router.classify(question)
+        if confidence >= max(min_confidence, router.min_confidence):
+            print(f"---LOCAL ROUTE ({confidence:.2f} CONFIDENT)---")
+            return source, confidence
+        print(f"---LOCAL ROUTE NOT CONFIDENT ({confidence:.2f}), ASKING THE LLM ROUTER---")
+    source = question_router.invoke({"question": question})
+    log_decision(question, source)
+    return source, confidence
+
+
+async def aroute_with_confidence(
+    question: str, use_local: bool = True, min_confidence: float = 0.9
+) -> Tuple[RouteQuery, Optional[float]]:
+    """Async version of route_with_confidence, the classifier's embedding call runs off the loop."""
+    confidence = None
+    router = get_local_router() if use_local else None
+    if router is not None:
+        source, confidence = await asyncio.to_thread(router.classify, question)
+        if confidence >= max(min_confidence, router.min_confidence):
+            print(f"---LOCAL ROUTE ({confidence:.2f} CONFIDENT)---")
+            return source, confidence
+        print(f"---LOCAL ROUTE NOT CONFIDENT ({confidence:.2f}), ASKING THE LLM ROUTER---")
+    source = await question_router.ainvoke({"question": question})
+    log_decision(question, source)
+    return source, confidence
+
+
+def route(question: str, use_local: bool = True, min_confidence: float = 0.9) -> RouteQuery:
+    """route_with_confidence without the confidence, a drop-in for question_router."""
+    return route_with_confidence(question, use_local, min_confidence)[0]
+
+
+async def aroute(question: str, use_local: bool = True, min_confidence: float = 0.9) -> RouteQuery:
+    """Async version of route."""
+    return (await aroute_with_confidence(question, use_local, min_confidence))[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Fit and calibrate the local router on the seed questions and the logged LLM "
+        "routing decisions"
+    )
+    parser.add_argument("--log", default=ROUTING_LOG_PATH, help="jsonl of question and datasource")
+    parser.add_argument("--output", default=ROUTER_CENTROIDS_PATH)
+    parser.add_argument(
+        "--target-agreement",
+        type=float,
+        default=ROUTER_TARGET_AGREEMENT,
+        help="share of the local routes that must agree with the LLM router",
+    )
+    args = parser.parse_args()
+
+    from ingestion import get_embeddings
+
+    logged = load_logged_decisions(args.log)
+    router = CentroidRouter.calibrate(get_embeddings(), logged, args.target_agreement)
+    router.save(args.output)
+    print(f"fit {len(router.datasources)} centroids on the seeds and {len(logged)} logged questions")
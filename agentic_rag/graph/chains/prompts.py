@@ -0,0 +1,51 @@
+import os
+
+from langchain_core.load import dumps, loads
+from langchain_core.prompts import BasePromptTemplate, ChatPromptTemplate
+
+# Pulling prompts from the LangChain hub at import time meant a worker could not even start when the
+# hub was slow or down. The prompts we use are vendored here, anything else is pulled from the hub
+# once and cached on disk, so from then on loading a prompt never leaves the machine.
+PROMPT_CACHE_DIR = os.getenv("PROMPT_CACHE_DIR", "./.cache/prompts")
+
+VENDORED_PROMPTS = {
+    # copy of https://smith.langchain.com/hub/rlm/rag-prompt
+    "rlm/rag-prompt": ChatPromptTemplate.from_messages(
+        [
+            (
+                "human",
+                "You are an assistant for question-answering tasks. Use the following pieces of retrieved "
+                "context to answer the question. If you don't know the answer, just say that you don't know. "
+                "Use three sentences maximum and keep the answer concise.\n"
+                "Question: {question} \nContext: {context} \nAnswer:",
+            )
+        ]
+    ),
+}
+
+
+def load_prompt(name: str) -> BasePromptTemplate:
+    """
+    Load a prompt from the vendored registry, the local cache or, as a last resort, the hub.
+
+    Args:
+        name (str): Hub name of the prompt, e.g. "rlm/rag-prompt"
+
+    Returns:
+        BasePromptTemplate: The prompt template
+    """
+    if name in VENDORED_PROMPTS:
+        return VENDORED_PROMPTS[name]
+
+    path = os.path.join(PROMPT_CACHE_DIR, name.replace("/", "__") + ".json")
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return loads(f.read(), allowed_objects="core")
+
+    from langchain_classic import hub
+
+    prompt = hub.pull(name)
+    os.makedirs(PROMPT_CACHE_DIR, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(dumps(prompt))
+    return prompt
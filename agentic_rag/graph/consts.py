@@ -1,4 +1,10 @@
 RETRIEVE = "retrieve"
 GRADE_DOCUMENTS = "grade_documents"
 GENERATE = "generate"
+GRADE_GENERATION = "grade_generation"
 WEBSEARCH = "websearch"
+START_REQUEST = "start_request"
+ROUTE_QUESTION = "route_question"
+FINALIZE = "finalize"
+# tag of the answer generation chain, streaming picks its tokens out of all LLM calls by it
+ANSWER_TAG = "answer"
@@ -0,0 +1,20 @@
+from typing import Any, Dict
+
+from graph.state import GraphState
+
+
+def finalize(state: GraphState) -> Dict[str, Any]:
+    """
+    Ends a request that ran out of retries or time with the best generation so far
+
+    Args:
+        state (dict): The current graph state
+
+    Returns:
+        state (dict): generation set to the best one so far and the degraded flag set
+    """
+    print("---OUT OF RETRIES OR TIME, RETURNING THE BEST GENERATION SO FAR---")
+    # grade_generation recorded the latest grounded generation, a grounded generation that didn't
+    # answer the question beats one that isn't grounded; nothing is graded again past the deadline
+    generation = state.get("grounded_generation") or state["generation"]
+    return {"generation": generation, "degraded": True}
@@ -1,7 +1,7 @@
 from typing import Any, Dict
 
 from graph.state import GraphState
-from ingestion import retriever
+from ingestion import get_retriever
 
 # This function is going to receive the state.
 # And it's going to return a dictionary.
@@ -10,5 +10,14 @@ def retrieve(state: GraphState) -> Dict[str, Any]:
     question = state["question"]
 
     # To do the semantic search and get us all the relevant documents
-    documents = retriever.invoke(question)
+    # the retriever is opened on first use, not when the graph is imported
+    documents = get_retriever().invoke(question)
+    return {"documents": documents, "question": question}
+
+
+async def aretrieve(state: GraphState) -> Dict[str, Any]:
+    """Async version of retrieve, the embedding and vectorstore calls don't block the event loop."""
+    print("---RETRIEVE---")
+    question = state["question"]
+    documents = await get_retriever().ainvoke(question)
     return {"documents": documents, "question": question}
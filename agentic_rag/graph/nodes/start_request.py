@@ -0,0 +1,25 @@
+import time
+from typing import Any, Dict
+
+from langchain_core.runnables import RunnableConfig
+
+from graph.config import get_setting
+from graph.state import GraphState
+
+
+# The generate -> grade loop can go around until LangGraph's recursion limit. Every request therefore
+# starts with a deadline and a count of generation attempts in the state, which the conditional edges
+# check before sending the flow around the loop again.
+def start_request(state: GraphState, config: RunnableConfig = None) -> Dict[str, Any]:
+    """
+    Sets the deadline and the retry budget of the request
+
+    Args:
+        state (dict): The current graph state, a deadline passed in the input is kept
+        config (RunnableConfig): Run config, "deadline_seconds" is the time the request may take
+
+    Returns:
+        state (dict): deadline, generation attempts and degraded flag
+    """
+    deadline = state.get("deadline") or time.time() + get_setting(config, "deadline_seconds")
+    return {"deadline": deadline, "generation_attempts": 0, "degraded": False}
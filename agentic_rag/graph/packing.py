@@ -0,0 +1,82 @@
+import os
+from functools import lru_cache
+from typing import List, Optional, Sequence
+
+import tiktoken
+from langchain_core.documents import Document
+
+from indexing.hybrid import RELEVANCE_SCORE
+
+# Every web search loop appends another joined Tavily blob to the documents, and generate and the
+# hallucination grader put all of them in the prompt, so prompts kept growing with every retry.
+# pack_documents fits the documents into a token budget: the best ones by retriever relevance score
+# are kept whole, the first one that doesn't fit is cut to the tokens left, and the rest are dropped.
+# Web results rank first, newest first: web_search only runs when the retrieved documents were graded
+# irrelevant or the answer from them didn't address the question. Other documents without a score
+# rank after the scored ones.
+PACKING_ENCODING = os.getenv("PACKING_ENCODING", "cl100k_base")
+# a cut document is only kept when at least this many of its tokens fit
+MIN_TRUNCATED_TOKENS = 32
+# metadata flag of documents that were cut to fit
+TRUNCATED = "truncated"
+# metadata flag of the joined web search results, set by web_search
+WEB_RESULTS = "web_results"
+
+
+@lru_cache(maxsize=None)
+def get_encoding() -> tiktoken.Encoding:
+    """The tokenizer, loaded on first use since tiktoken downloads its encoding."""
+    return tiktoken.get_encoding(PACKING_ENCODING)
+
+
+def rank_documents(documents: Sequence[Document]) -> List[int]:
+    """Indexes of the documents, best first: web results, scored ones by relevance score, the rest."""
+
+    def key(i: int):
+        if documents[i].metadata.get(WEB_RESULTS):
+            return (0, 0.0, -i)
+        score = documents[i].metadata.get(RELEVANCE_SCORE)
+        return (1 if score is not None else 2, -(score or 0.0), i)
+
+    return sorted(range(len(documents)), key=key)
+
+
+def pack_documents(
+    documents: Sequence[Document], max_tokens: int, encoding: Optional[tiktoken.Encoding] = None
+) -> List[Document]:
+    """
+    Keep the most relevant documents that fit in max_tokens.
+
+    Args:
+        documents (Sequence[Document]): The documents that would go into the prompt
+        max_tokens (int): Token budget for the document texts, 0 keeps everything
+        encoding (tiktoken.Encoding): Tokenizer to count with, get_encoding() by default
+
+    Returns:
+        List[Document]: The documents that fit, in their original order, the last one possibly cut
+    """
+    documents = list(documents)
+    # every token is at least one byte, so when the bytes fit there is nothing to count
+    if not max_tokens or sum(len(d.page_content.encode("utf-8")) for d in documents) <= max_tokens:
+        return documents
+    encoding = encoding or get_encoding()
+    kept = {}
+    cut = False
+    remaining = max_tokens
+    for i in rank_documents(documents):
+        tokens = encoding.encode(documents[i].page_content)
+        if len(tokens) <= remaining:
+            kept[i] = documents[i]
+            remaining -= len(tokens)
+        elif remaining >= MIN_TRUNCATED_TOKENS:
+            kept[i] = Document(
+                page_content=encoding.decode(tokens[:remaining]),
+                metadata={**documents[i].metadata, TRUNCATED: True},
+            )
+            remaining = 0
+            cut = True
+    if cut or len(kept) < len(documents):
+        print(
+            f"---CONTEXT PACKED: {len(kept)} OF {len(documents)} DOCUMENTS FIT {max_tokens} TOKENS---"
+        )
+    return [kept[i] for i in sorted(kept)]
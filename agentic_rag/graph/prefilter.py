@@ -0,0 +1,160 @@
+import argparse
+import json
+import os
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+from typing import List, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+
+from indexing.hybrid import RELEVANCE_SCORE
+
+# Most grader calls are for obvious cases: chunks whose similarity to the question is very high are
+# almost always graded relevant, and very low ones irrelevant. With calibrated thresholds,
+# grade_documents decides those without the LLM and only grades the ambiguous band in between.
+PREFILTER_PATH = os.getenv("PREFILTER_PATH", "./.cache/prefilter.json")
+# largest share of wrong decisions the calibration tolerates in each band
+MAX_ERROR = 0.02
+
+
+@dataclass
+class Thresholds:
+    """Relevance scores below reject are graded "no", at or above accept "yes". None disables a band."""
+
+    reject: Optional[float] = None
+    accept: Optional[float] = None
+
+    def grade(self, score: Optional[float]) -> Optional[str]:
+        """The grade for a relevance score, None if the LLM has to decide."""
+        if score is None:
+            return None
+        if self.accept is not None and score >= self.accept:
+            return "yes"
+        if self.reject is not None and score < self.reject:
+            return "no"
+        return None
+
+
+@lru_cache(maxsize=None)
+def load_thresholds(path: str = PREFILTER_PATH) -> Optional[Thresholds]:
+    """Read calibrated thresholds, None when the calibration has not been run yet."""
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return Thresholds(**json.load(f))
+
+
+def prefilter_grades(
+    documents: Sequence[Document], thresholds: Optional[Thresholds]
+) -> List[Optional[str]]:
+    """
+    Grade the documents from their relevance scores alone.
+
+    Args:
+        documents (Sequence[Document]): Retrieved documents, scored ones carry RELEVANCE_SCORE metadata
+        thresholds (Thresholds): Calibrated thresholds, None grades nothing
+
+    Returns:
+        List[Optional[str]]: "yes" or "no" per document, None for the ones the LLM grader has to see
+    """
+    if thresholds is None:
+        return [None] * len(documents)
+    return [thresholds.grade(d.metadata.get(RELEVANCE_SCORE)) for d in documents]
+
+
+def fit_thresholds(
+    examples: Sequence[Tuple[float, bool]], max_error: float = MAX_ERROR
+) -> Thresholds:
+    """
+    Pick the widest reject and accept bands whose share of wrong decisions stays within max_error.
+
+    Args:
+        examples (Sequence[Tuple[float, bool]]): (relevance score, labeled relevant) pairs
+        max_error (float): Tolerated share of relevant chunks rejected, and of irrelevant ones accepted
+
+    Returns:
+        Thresholds: The fitted thresholds, a band is None if no threshold meets max_error
+    """
+    scores = sorted({score for score, _ in examples})
+    thresholds = Thresholds()
+    # reject everything strictly below the threshold
+    for t in scores:
+        band = [relevant for score, relevant in examples if score < t]
+        if band and sum(band) / len(band) <= max_error:
+            thresholds.reject = t
+    # accept everything at or above the threshold, the bands must not overlap
+    for t in reversed(scores):
+        if thresholds.reject is not None and t < thresholds.reject:
+            break
+        band = [relevant for score, relevant in examples if score >= t]
+        if sum(not relevant for relevant in band) / len(band) <= max_error:
+            thresholds.accept = t
+    return thresholds
+
+
+def collect(questions_path: str, output_path: str) -> None:
+    """Retrieve for every question and write the scored chunks, pre-labeled by the LLM grader."""
+    from graph.chains.retrieval_grader import retrieval_grader
+    from ingestion import get_retriever
+
+    with open(questions_path, "r", encoding="utf-8") as f:
+        questions = [line.strip() for line in f if line.strip()]
+    with open(output_path, "w", encoding="utf-8") as out:
+        for question in questions:
+            for d in get_retriever().invoke(question):
+                if d.metadata.get(RELEVANCE_SCORE) is None:
+                    continue
+                grade = retrieval_grader.invoke({"question": question, "document": d.page_content})
+                record = {
+                    "question": question,
+                    "document": d.page_content,
+                    RELEVANCE_SCORE: d.metadata[RELEVANCE_SCORE],
+                    "relevant": grade.binary_score.lower() == "yes",
+                }
+                out.write(json.dumps(record) + "\n")
+
+
+def fit(
+    labeled_path: str, output_path: str = PREFILTER_PATH, max_error: float = MAX_ERROR
+) -> Thresholds:
+    """Fit the thresholds on a labeled jsonl file and save them where grade_documents looks."""
+    with open(labeled_path, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    examples = [(r[RELEVANCE_SCORE], bool(r["relevant"])) for r in records]
+    thresholds = fit_thresholds(examples, max_error)
+
+    decided = [(thresholds.grade(score), relevant) for score, relevant in examples]
+    skipped = [(grade, relevant) for grade, relevant in decided if grade is not None]
+    wrong = sum((grade == "yes") != relevant for grade, relevant in skipped)
+    print(f"reject below {thresholds.reject}, accept from {thresholds.accept}")
+    print(
+        f"{len(skipped)}/{len(examples)} grader calls saved, {wrong} of them disagree with the labels"
+    )
+
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(asdict(thresholds), f)
+    return thresholds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Calibrate the relevance score thresholds of the grading prefilter"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    collect_parser = commands.add_parser(
+        "collect", help="retrieve for a file of questions, one per line, and pre-label the chunks"
+    )
+    collect_parser.add_argument("questions")
+    collect_parser.add_argument("output")
+    fit_parser = commands.add_parser(
+        "fit", help="fit the thresholds on a jsonl file of relevance_score and relevant labels"
+    )
+    fit_parser.add_argument("labeled")
+    fit_parser.add_argument("--output", default=PREFILTER_PATH)
+    fit_parser.add_argument("--max-error", type=float, default=MAX_ERROR)
+    args = parser.parse_args()
+    if args.command == "collect":
+        collect(args.questions, args.output)
+    else:
+        fit(args.labeled, args.output, args.max_error)
@@ -0,0 +1,120 @@
+import asyncio
+import hashlib
+import json
+import os
+from functools import lru_cache
+from typing import Any, Dict, Optional
+
+from dotenv import load_dotenv
+from langchain_tavily import TavilySearch
+
+from indexing.sqlite_cache import SQLiteCache
+
+load_dotenv()
+
+# Tavily is the slowest call we make and it is rate limited, yet the same queries come back all the
+# time. CachedTavilySearch is a drop-in TavilySearch that keeps each search result in SQLite, keyed by
+# the normalized query and every setting that changes the results (max_results, topic, domains, ...),
+# in a SQLiteCache that every worker process can share. Entries expire after their TTL, web results
+# go stale, and the least recently used ones are evicted above max_entries. Failed searches are
+# never cached. Set SEARCH_CACHE_PATH to an empty string to disable it.
+SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH", "./.cache/search.sqlite")
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", 6 * 3600))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", 10_000))
+
+# TavilySearch settings that change what a search returns and can only be set on the tool
+TOOL_SETTINGS = (
+    "max_results",
+    "include_answer",
+    "include_raw_content",
+    "include_image_descriptions",
+    "include_favicon",
+    "auto_parameters",
+    "country",
+    "exact_match",
+)
+# settings a call can also pass, TavilySearch._run only uses the call's value when the tool's is unset
+CALL_SETTINGS = (
+    "topic",
+    "search_depth",
+    "include_domains",
+    "exclude_domains",
+    "time_range",
+    "include_images",
+)
+
+
+def normalize_query(query: str) -> str:
+    """Lower-case, collapse whitespace and drop trailing punctuation, so near-identical queries match."""
+    return " ".join(query.lower().split()).rstrip("?!. ")
+
+
+class SearchCache(SQLiteCache):
+    """Persistent, LRU and TTL bounded store of search results shared across processes."""
+
+    def __init__(self, path: str, max_entries: int = SEARCH_CACHE_MAX_ENTRIES) -> None:
+        """
+        Args:
+            path (str): SQLite file of the cache, created if missing
+            max_entries (int): Number of results above which the least recently used are evicted
+        """
+        super().__init__(path, "search_results", SEARCH_CACHE_TTL, max_entries)
+
+
+@lru_cache(maxsize=None)
+def get_search_cache() -> Optional[SearchCache]:
+    """The shared search cache, opened on first use so importing the tools stays cheap."""
+    if not SEARCH_CACHE_PATH:
+        return None
+    return SearchCache(SEARCH_CACHE_PATH)
+
+
+class CachedTavilySearch(TavilySearch):
+    """TavilySearch that answers repeated queries from the search cache."""
+
+    # seconds a result of this tool is reused
+    cache_ttl: float = SEARCH_CACHE_TTL
+
+    def _cache_key(self, query: str, kwargs: Dict[str, Any]) -> str:
+        settings = {name: getattr(self, name, None) for name in TOOL_SETTINGS}
+        # the key holds what is actually sent: like TavilySearch._run, a setting made on the tool
+        # wins over the call's argument, and the other arguments (start_date, ...) are passed as is
+        for name in CALL_SETTINGS:
+            settings[name] = getattr(self, name, None) or kwargs.get(name)
+        settings.update(
+            {
+                name: value
+                for name, value in kwargs.items()
+                if name not in CALL_SETTINGS and value is not None
+            }
+        )
+        key = json.dumps([normalize_query(query), settings], sort_keys=True, default=str)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _run(self, query: str, run_manager: Any = None, **kwargs: Any) -> Dict[str, Any]:
+        cache = get_search_cache()
+        if cache is None:
+            return super()._run(query, run_manager=run_manager, **kwargs)
+        key = self._cache_key(query, kwargs)
+        cached = cache.get(key)
+        if cached is not None:
+            return json.loads(cached)
+        result = super()._run(query, run_manager=run_manager, **kwargs)
+        # TavilySearch reports failures as {"error": ...}, those are retried next time
+        if "error" not in result:
+            cache.put(key, json.dumps(result), self.cache_ttl)
+        return result
+
+    async def _arun(self, query: str, run_manager: Any = None, **kwargs: Any) -> Dict[str, Any]:
+        cache = get_search_cache()
+        if cache is None:
+            return await super()._arun(query, run_manager=run_manager, **kwargs)
+        key = self._cache_key(query, kwargs)
+        # SQLite calls block, so they run in a worker thread instead of on the event loop
+        cached = await asyncio.to_thread(cache.get, key)
+        if cached is not None:
+            return json.loads(cached)
+        result = await super()._arun(query, run_manager=run_manager, **kwargs)
+        if "error" not in result:
+            await asyncio.to_thread(cache.put, key, json.dumps(result), self.cache_ttl)
+        return result
@@ -0,0 +1,95 @@
+import asyncio
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Deque, Iterable, List, Optional, Tuple, Union
+
+from langchain_core.documents import Document
+from langchain_text_splitters import TextSplitter
+
+# tiktoken token counting inside RecursiveCharacterTextSplitter dominates CPU time of large ingests,
+# and splitting one document after the other only ever uses one core. Documents are independent, so
+# they are split in a pool of worker processes, each with its own splitter. Results are always handed
+# back in input order and every document is split by the same splitter configuration as before, so
+# chunk boundaries (and therefore chunk ids) are exactly the same as with a serial splitter.
+
+# set by the pool initializer, one splitter per worker
+_worker_splitter: Optional[TextSplitter] = None
+
+
+def _init_worker(make_splitter: Callable[[], TextSplitter]) -> None:
+    global _worker_splitter
+    _worker_splitter = make_splitter()
+
+
+def _split_in_worker(doc: Document) -> List[Document]:
+    return _worker_splitter.split_documents([doc])
+
+
+class ParallelSplitter:
+    """Splits documents on several cores while keeping the output identical to a serial split."""
+
+    def __init__(
+        self, make_splitter: Callable[[], TextSplitter], workers: int, kind: str = "process"
+    ) -> None:
+        """
+        Args:
+            make_splitter (Callable[[], TextSplitter]): Picklable factory building the splitter in each
+                worker, e.g. functools.partial(RecursiveCharacterTextSplitter.from_tiktoken_encoder, ...)
+            workers (int): Number of worker processes or threads
+            kind (str): "process", or "thread" when the splitter's length function releases the GIL
+        """
+        self.workers = workers
+        if kind == "process":
+            self._executor: Executor = ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker, initargs=(make_splitter,)
+            )
+            self._split: Callable[[Document], List[Document]] = _split_in_worker
+        else:
+            # threads share one splitter, it keeps no state between calls
+            splitter = make_splitter()
+            self._executor = ThreadPoolExecutor(max_workers=workers)
+            self._split = lambda doc: splitter.split_documents([doc])
+
+    def split_documents(self, documents: Iterable[Document]) -> List[Document]:
+        """Split all documents, chunks come back in the same order a serial split_documents gives."""
+        # chunksize amortizes the inter process round trips over several documents
+        results = self._executor.map(self._split, documents, chunksize=4)
+        return [chunk for chunks in results for chunk in chunks]
+
+    async def asplit_document(self, doc: Document) -> List[Document]:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._split, doc
+        )
+
+    def shutdown(self) -> None:
+        self._executor.shutdown()
+
+
+async def aiter_splits(
+    documents: AsyncIterator[Document],
+    text_splitter: Union[TextSplitter, ParallelSplitter],
+) -> AsyncIterator[Tuple[Document, List[Document]]]:
+    """
+    Split a stream of documents, yielding (document, chunks) in input order.
+
+    With a ParallelSplitter, up to twice its number of workers documents are split at the same time, so
+    all cores stay busy while memory stays bounded.
+    """
+    if not isinstance(text_splitter, ParallelSplitter):
+        async for doc in documents:
+            yield doc, text_splitter.split_documents([doc])
+        return
+
+    window: Deque[Tuple[Document, asyncio.Future]] = deque()
+    try:
+        async for doc in documents:
+            window.append((doc, asyncio.ensure_future(text_splitter.asplit_document(doc))))
+            if len(window) >= 2 * text_splitter.workers:
+                doc, future = window.popleft()
+                yield doc, await future
+        while window:
+            doc, future = window.popleft()
+            yield doc, await future
+    finally:
+        for _, future in window:
+            future.cancel()
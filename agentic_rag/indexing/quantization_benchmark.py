@@ -0,0 +1,97 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from indexing.mmap_store import META_FILE, VECTORS_FILE, MmapVectorStore, write_index
+
+# Recall vs memory of the quantized first pass, on synthetic clustered embeddings or on the vectors of
+# an existing mmap index. Recall@k is measured against exact float32 cosine search.
+#
+#   python -m indexing.quantization_benchmark --n 100000 --dim 1536
+#   python -m indexing.quantization_benchmark --index ./.chroma/mmap
+
+
+def synthetic_vectors(n: int, dim: int, clusters: int, seed: int) -> np.ndarray:
+    # embeddings of real corpora are clustered by topic, uniform noise would make recall look too easy
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(clusters, size=n)] + 0.5 * rng.normal(size=(n, dim)).astype(
+        np.float32
+    )
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def load_index_vectors(directory: str) -> np.ndarray:
+    with open(os.path.join(directory, META_FILE), encoding="utf-8") as f:
+        meta = json.load(f)
+    return np.fromfile(os.path.join(directory, VECTORS_FILE), dtype=np.float32).reshape(
+        meta["count"], meta["dim"]
+    )
+
+
+class _NoEmbeddings:
+    """The benchmark searches with query vectors, nothing needs to be embedded."""
+
+
+def run(vectors: np.ndarray, queries: np.ndarray, k: int, rescore_factor: int) -> None:
+    exact = np.argsort(-(vectors @ queries.T), axis=0)[:k].T
+    print(f"{len(vectors)} vectors of dim {vectors.shape[1]}, {len(queries)} queries, k={k}")
+    print(f"{'storage':<10}{'first pass MB':>15}{'recall@k':>10}{'no rescore':>12}{'ms/query':>10}")
+    for quantization in ("none", "float16", "int8"):
+        with tempfile.TemporaryDirectory() as tmp:
+            directory = f"{tmp}/index"
+            write_index(
+                directory,
+                ((str(i), "", {}, v) for i, v in enumerate(vectors)),
+                quantization=quantization,
+            )
+
+            def recall(rescore: int) -> float:
+                store = MmapVectorStore(directory, _NoEmbeddings(), rescore_factor=rescore)
+                hits = 0
+                for query, truth in zip(queries, exact):
+                    top, _ = store._top_k(query, k)
+                    hits += len(set(top.tolist()) & set(truth.tolist()))
+                return hits / exact.size
+
+            store = MmapVectorStore(directory, _NoEmbeddings(), rescore_factor=rescore_factor)
+            first_pass = store.quantized if store.quantized is not None else store.vectors
+            start = time.perf_counter()
+            rescored = recall(rescore_factor)
+            latency = (time.perf_counter() - start) / len(queries) * 1000
+            print(
+                f"{quantization:<10}{first_pass.nbytes / 2**20:>15.1f}{rescored:>10.3f}"
+                f"{recall(1):>12.3f}{latency:>10.2f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recall vs memory of quantized vector storage")
+    parser.add_argument("--index", help="benchmark on the vectors of this mmap index directory")
+    parser.add_argument("--n", type=int, default=50000, help="synthetic vectors")
+    parser.add_argument("--dim", type=int, default=1536, help="synthetic dimensions")
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--rescore-factor", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    vectors = (
+        load_index_vectors(args.index)
+        if args.index
+        else synthetic_vectors(args.n, args.dim, args.clusters, args.seed)
+    )
+    rng = np.random.default_rng(args.seed + 1)
+    # queries near existing chunks, like questions about something that is in the corpus; the noise
+    # has about the same norm as the vectors themselves
+    queries = vectors[rng.integers(len(vectors), size=args.queries)]
+    queries = queries + rng.normal(size=queries.shape).astype(np.float32) / np.sqrt(
+        vectors.shape[1]
+    )
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    run(vectors, queries.astype(np.float32), args.k, args.rescore_factor)
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+# One monolithic collection was the scaling limit for both ingestion time and query latency.
+# Chunks are partitioned across several collections by source: every source is assigned to one shard
+# and stays there, the assignment is persisted next to the manifest. A query fans out to all shards
+# concurrently and the per-shard top k lists are merged by relevance score.
+#
+# Because assignments are sticky, adding a shard doesn't move anything: existing sources stay where
+# they are and only sources seen for the first time can land on the new shard.
+STRATEGIES = ("hash", "balanced")
+
+
+class ShardMap:
+    """Persistent source -> shard assignment."""
+
+    def __init__(self, path: str, shard_names: List[str], strategy: str = "hash") -> None:
+        if strategy not in STRATEGIES:
+            raise ValueError(
+                f"unknown sharding strategy {strategy!r}, expected one of {STRATEGIES}"
+            )
+        self.path = path
+        self.shard_names = shard_names
+        self.strategy = strategy
+        self.sources: Dict[str, str] = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.sources = json.load(f)["sources"]
+        self._lock = threading.Lock()
+
+    def shard_of(self, source: str) -> str:
+        """The shard a source lives in, assigning it on first sight."""
+        with self._lock:
+            if source not in self.sources:
+                self.sources[source] = self._assign(source)
+            return self.sources[source]
+
+    def _assign(self, source: str) -> str:
+        if self.strategy == "balanced":
+            # the shard with the fewest sources, new shards fill up first
+            counts = {name: 0 for name in self.shard_names}
+            for name in self.sources.values():
+                if name in counts:
+                    counts[name] += 1
+            return min(self.shard_names, key=lambda name: counts[name])
+        digest = hashlib.sha1(source.encode("utf-8")).digest()
+        return self.shard_names[int.from_bytes(digest[:8], "big") % len(self.shard_names)]
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with self._lock, open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"shards": self.shard_names, "sources": self.sources}, f, indent=1, sort_keys=True
+            )
+        os.replace(tmp_path, self.path)
+
+
+class ShardedVectorStore(VectorStore):
+    """A vector store that writes each source to one shard and queries all shards in parallel."""
+
+    def __init__(self, shards: Dict[str, VectorStore], shard_map: ShardMap) -> None:
+        """
+        Args:
+            shards (Dict[str, VectorStore]): Shard name -> store, e.g. one Chroma collection each
+            shard_map (ShardMap): Which source lives in which shard
+        """
+        self.shards = shards
+        self.shard_map = shard_map
+        self._executor = ThreadPoolExecutor(max_workers=len(shards), thread_name_prefix="shard")
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return next(iter(self.shards.values())).embeddings
+
+    def _fan_out(self, fn, *args, **kwargs) -> List[Any]:
+        futures = [
+            self._executor.submit(fn, shard, *args, **kwargs) for shard in self.shards.values()
+        ]
+        return [future.result() for future in futures]
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        *,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [None] * len(texts)
+        groups: Dict[str, Tuple[List[str], List[dict], List[str]]] = {}
+        for text, metadata, doc_id in zip(texts, metadatas, ids):
+            name = self.shard_map.shard_of(metadata.get("source", ""))
+            group = groups.setdefault(name, ([], [], []))
+            group[0].append(text)
+            group[1].append(metadata)
+            group[2].append(doc_id)
+        added = []
+        for name, (shard_texts, shard_metadatas, shard_ids) in groups.items():
+            added.extend(
+                self.shards[name].add_texts(
+                    shard_texts,
+                    shard_metadatas,
+                    ids=shard_ids if all(shard_ids) else None,
+                    **kwargs,
+                )
+            )
+        return added
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        # we don't keep an id -> shard index, deleting ids a shard doesn't have is a no-op
+        self._fan_out(lambda shard: shard.delete(ids=ids, **kwargs))
+        return True
+
+    def delete_collection(self) -> None:
+        self._fan_out(lambda shard: shard.delete_collection())
+
+    def get_by_ids(self, ids: Sequence[str], /) -> List[Document]:
+        found = {
+            doc.id: doc
+            for docs in self._fan_out(lambda shard: shard.get_by_ids(ids))
+            for doc in docs
+        }
+        return [found[doc_id] for doc_id in ids if doc_id in found]
+
+    def similarity_search_with_relevance_scores(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        if self.embeddings is not None:
+            # embed once up front, the shards then get the query vector from the embedding cache
+            self.embeddings.embed_query(query)
+        results = self._fan_out(
+            lambda shard: shard.similarity_search_with_relevance_scores(query, k=k, **kwargs)
+        )
+        # all shards use the same embedding model and distance, so their scores are comparable
+        merged = [pair for shard_results in results for pair in shard_results]
+        merged.sort(key=lambda pair: pair[1], reverse=True)
+        return merged[:k]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_relevance_scores(query, k, **kwargs)]
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas=None, **kwargs: Any):
+        raise NotImplementedError("build a ShardedVectorStore from existing shards")
+
+
+def iter_shards(vectorstore: VectorStore) -> List[VectorStore]:
+    """The underlying stores of a sharded store, or the store itself."""
+    if isinstance(vectorstore, ShardedVectorStore):
+        return list(vectorstore.shards.values())
+    return [vectorstore]
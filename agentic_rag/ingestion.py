@@ -1,35 +1,265 @@
+import argparse
+import os
+from functools import lru_cache, partial
+from typing import AsyncIterator, List, Optional, Set, Union
+
 from dotenv import load_dotenv
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_chroma import Chroma
-from langchain_community.document_loaders import WebBaseLoader
 from langchain_openai import OpenAIEmbeddings
 
+from indexing.bm25 import BM25Index
+from indexing.chunking import ParallelSplitter
+from indexing.dedup import DEDUP_THRESHOLD, NearDuplicateFilter
+from indexing.embedding_cache import DEFAULT_MAX_BYTES, CachedEmbeddings
+from indexing.hybrid import DenseRetriever, HybridRetriever
+from indexing.loaders import aiter_pages, html_to_document, iter_local_directory, save_snapshot
+from indexing.manifest import load_manifest
+from indexing.mmap_store import MmapVectorStore, export_from_chroma
+from indexing.pipeline import BATCH_SIZE, EMBED_CONCURRENCY, MAX_IN_FLIGHT, stream_ingest
+from indexing.shards import ShardedVectorStore, ShardMap, iter_shards
+
 load_dotenv()
 
+COLLECTION_NAME = "rag-chroma"
+PERSIST_DIRECTORY = "./.chroma"
+# source URL -> content hashes of the chunks that are already embedded in the collection
+MANIFEST_PATH = os.path.join(PERSIST_DIRECTORY, "manifest.json")
+# with more than one shard, sources are spread over collections rag-chroma, rag-chroma-1, ...
+# raising the count later only adds empty collections, nothing already indexed is moved
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+# "hash" spreads new sources by a hash of their url, "balanced" puts them on the emptiest shard
+SHARD_STRATEGY = os.getenv("SHARD_STRATEGY", "hash")
+SHARD_MAP_PATH = os.path.join(PERSIST_DIRECTORY, "shards.json")
+# BM25 inverted index over the same chunks, rebuilt after every ingestion run
+BM25_PATH = os.path.join(PERSIST_DIRECTORY, "bm25.json.gz")
+# "hybrid" fuses BM25 and vector search, "dense" only uses the vector store
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+# "chroma" queries the Chroma collection, "mmap" a memory-mapped copy of it that all worker
+# processes on a box share through the page cache
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+MMAP_INDEX_DIR = os.path.join(PERSIST_DIRECTORY, "mmap")
+# "float16" or "int8" search a quantized copy first and re-score the candidates in full precision
+VECTOR_QUANTIZATION = os.getenv("VECTOR_QUANTIZATION", "none")
+# a directory of saved html/markdown pages to ingest instead of the urls, e.g. for offline benchmarks
+SOURCE_DIR = os.getenv("INGEST_SOURCE_DIR")
+# when set, the fetched pages are also saved here so they can later be used as INGEST_SOURCE_DIR
+SNAPSHOT_DIR = os.getenv("INGEST_SNAPSHOT_DIR")
+# embeddings of documents and queries are cached on disk; point several environments at the same
+# file to share them between e.g. staging and prod rebuilds
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "./.cache/embeddings.sqlite")
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+# documents are chunked on this many cores, tiktoken counting dominates ingestion on large crawls
+SPLIT_WORKERS = int(os.getenv("INGEST_SPLIT_WORKERS", os.cpu_count() or 1))
+# chunks whose word shingles overlap an earlier chunk at least this much are not embedded, 1 disables
+INGEST_DEDUP_THRESHOLD = float(os.getenv("INGEST_DEDUP_THRESHOLD", DEDUP_THRESHOLD))
+
 urls = [
     "https://lilianweng.github.io/posts/2023-06-23-agent/",
     "https://lilianweng.github.io/posts/2023-03-15-prompt-engineering/",
     "https://lilianweng.github.io/posts/2023-10-25-adv-attack-llm/",
 ]
 
-docs = [WebBaseLoader(url).load() for url in urls]
-docs_list = [item for sublist in docs for item in sublist]
 
-text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-    chunk_size=250, chunk_overlap=0
+# a partial of a library function pickles by reference, so worker processes can rebuild the splitter
+make_text_splitter = partial(
+    RecursiveCharacterTextSplitter.from_tiktoken_encoder, chunk_size=250, chunk_overlap=0
 )
-doc_splits = text_splitter.split_documents(docs_list)
 
 
-#vectorstore = Chroma.from_documents(
-#     documents=doc_splits,
-#     collection_name="rag-chroma",
-#     embedding=OpenAIEmbeddings(),
-#     persist_directory="./.chroma",
-# )
+# Nothing in this module touches the network or the disk at import time: the graph nodes import it,
+# and workers should become ready without downloading tokenizers or opening the collection.
+@lru_cache(maxsize=None)
+def get_text_splitter() -> RecursiveCharacterTextSplitter:
+    """The chunker used for ingestion, built on first use since tiktoken downloads its encoding."""
+    return make_text_splitter()
+
+
+def get_parallel_splitter(workers: int) -> Union[RecursiveCharacterTextSplitter, ParallelSplitter]:
+    """The ingestion chunker spread over worker processes, each building its own tokenizer."""
+    if workers <= 1:
+        return get_text_splitter()
+    return ParallelSplitter(make_text_splitter, workers)
+
+
+async def iter_documents(failed: Optional[Set[str]] = None) -> AsyncIterator[Document]:
+    """
+    Stream the documents to ingest: the urls fetched concurrently, or the local source directory.
+
+    Args:
+        failed (Set[str]): Collects the urls that could not be fetched
+    """
+    if SOURCE_DIR:
+        for doc in iter_local_directory(SOURCE_DIR):
+            yield doc
+        return
+    async for url, html in aiter_pages(urls, failed=failed):
+        if SNAPSHOT_DIR:
+            save_snapshot([(url, html)], SNAPSHOT_DIR)
+        yield html_to_document(html, url)
+
+
+def get_embeddings() -> CachedEmbeddings:
+    """OpenAI embeddings behind the persistent embedding cache."""
+    return CachedEmbeddings(
+        OpenAIEmbeddings(), EMBEDDING_CACHE_PATH, max_bytes=EMBEDDING_CACHE_MAX_BYTES
+    )
+
+
+def shard_names() -> List[str]:
+    # shard 0 is the original collection, so turning sharding on doesn't need a rebuild
+    return [COLLECTION_NAME] + [f"{COLLECTION_NAME}-{i}" for i in range(1, SHARD_COUNT)]
+
+
+def get_vectorstore() -> VectorStore:
+    """Open the persisted Chroma collection, or all of its shards behind one ShardedVectorStore."""
+    # chromadb alone takes about a second to import, so only pay for it when the store is opened
+    from langchain_chroma import Chroma
+
+    embeddings = get_embeddings()
+    collections = {
+        name: Chroma(
+            collection_name=name,
+            persist_directory=PERSIST_DIRECTORY,
+            embedding_function=embeddings,
+        )
+        for name in shard_names()
+    }
+    if SHARD_COUNT <= 1:
+        return collections[COLLECTION_NAME]
+    return ShardedVectorStore(collections, ShardMap(SHARD_MAP_PATH, shard_names(), SHARD_STRATEGY))
+
+
+def untracked_ids(vectorstore: VectorStore, manifest_path: str, page_size: int = 1000) -> List[str]:
+    """Ids in the collection that no manifest entry points to, e.g. the random ids of old builds."""
+    tracked = {doc_id for ids in load_manifest(manifest_path).values() for doc_id in ids}
+    untracked = []
+    for shard in iter_shards(vectorstore):
+        offset = 0
+        while True:
+            page = shard.get(limit=page_size, offset=offset, include=[])
+            if not page["ids"]:
+                break
+            untracked.extend(doc_id for doc_id in page["ids"] if doc_id not in tracked)
+            offset += len(page["ids"])
+    return untracked
+
+
+def ingest(
+    full: bool = False,
+    split_workers: int = SPLIT_WORKERS,
+    dedup_threshold: float = INGEST_DEDUP_THRESHOLD,
+    **kwargs,
+) -> None:
+    """
+    Bring the collection in sync with the current crawl.
+
+    Args:
+        full (bool): Drop the collection and the manifest and re-embed every chunk
+        split_workers (int): Processes chunking the documents, 1 splits in the main process
+        dedup_threshold (float): Similarity from which a chunk counts as a near-duplicate, 1 keeps all
+        **kwargs: Batch and concurrency settings forwarded to stream_ingest
+    """
+    vectorstore = get_vectorstore()
+    if full:
+        vectorstore.delete_collection()
+        for path in (MANIFEST_PATH, SHARD_MAP_PATH):
+            if os.path.exists(path):
+                os.remove(path)
+        vectorstore = get_vectorstore()
+    # collections built before the manifest existed, or with a manifest we can't read, stored their
+    # chunks under ids we don't know; they are all re-added under content ids on this run, and the
+    # old copies removed once it is done
+    legacy = not full and not load_manifest(MANIFEST_PATH)
+    # documents are split and embedded batch by batch as they arrive, and only chunks whose content
+    # hash is not in the manifest yet get embedded
+    text_splitter = get_parallel_splitter(split_workers)
+    dedup = NearDuplicateFilter(dedup_threshold) if dedup_threshold < 1 else None
+    # a page that failed to download keeps its chunks instead of being pruned as a removed source
+    failed: Set[str] = set()
+    try:
+        stats = stream_ingest(
+            iter_documents(failed),
+            text_splitter,
+            vectorstore,
+            MANIFEST_PATH,
+            dedup=dedup,
+            keep_sources=failed,
+            **kwargs,
+        )
+    finally:
+        if isinstance(text_splitter, ParallelSplitter):
+            text_splitter.shutdown()
+        # chunks that made it into a shard must stay assigned to it, even if the run failed
+        if isinstance(vectorstore, ShardedVectorStore):
+            vectorstore.shard_map.save()
+    if legacy and (stale_ids := untracked_ids(vectorstore, MANIFEST_PATH)):
+        for start in range(0, len(stale_ids), BATCH_SIZE):
+            vectorstore.delete(ids=stale_ids[start : start + BATCH_SIZE])
+        stats.deleted += len(stale_ids)
+    print(
+        f"---INGESTION: {stats.added} ADDED, {stats.deleted} DELETED, {stats.unchanged} UNCHANGED, "
+        f"{stats.duplicates} NEAR-DUPLICATES REMOVED, {len(failed)} PAGES FAILED---"
+    )
+    # the lexical index is rebuilt from the texts stored in the collection, nothing is re-embedded
+    BM25Index.from_vectorstore(vectorstore).save(BM25_PATH)
+    if VECTOR_BACKEND == "mmap":
+        # copies the stored embeddings, nothing is re-embedded
+        export_from_chroma(vectorstore, MMAP_INDEX_DIR, quantization=VECTOR_QUANTIZATION)
+
+
+@lru_cache(maxsize=None)
+def get_retriever() -> BaseRetriever:
+    """The retriever over the collection, opened once on first use."""
+    if VECTOR_BACKEND == "mmap":
+        vectorstore = MmapVectorStore(MMAP_INDEX_DIR, get_embeddings())
+    else:
+        vectorstore = get_vectorstore()
+    if RETRIEVAL_MODE == "hybrid":
+        if os.path.exists(BM25_PATH):
+            return HybridRetriever(vectorstore=vectorstore, bm25=BM25Index.load(BM25_PATH))
+        print("---NO BM25 INDEX, RUN INGESTION TO ENABLE HYBRID RETRIEVAL. USING DENSE ONLY---")
+    return DenseRetriever(vectorstore=vectorstore)
+
+
+def __getattr__(name: str):
+    # keeps `from ingestion import retriever` working without opening the store at import time
+    if name == "retriever":
+        return get_retriever()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
-retriever = Chroma(
-    collection_name="rag-chroma",
-    persist_directory="./.chroma",
-    embedding_function=OpenAIEmbeddings(),
-).as_retriever()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index the source urls into Chroma")
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="rebuild the collection from scratch instead of updating only changed chunks",
+    )
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="chunks per embedding request")
+    parser.add_argument(
+        "--embed-concurrency", type=int, default=EMBED_CONCURRENCY, help="embedding requests in parallel"
+    )
+    parser.add_argument(
+        "--max-in-flight", type=int, default=MAX_IN_FLIGHT, help="batches buffered before reading pauses"
+    )
+    parser.add_argument(
+        "--split-workers", type=int, default=SPLIT_WORKERS, help="processes chunking the documents"
+    )
+    parser.add_argument(
+        "--dedup-threshold",
+        type=float,
+        default=INGEST_DEDUP_THRESHOLD,
+        help="similarity from which chunks are dropped as near-duplicates, 1 keeps every chunk",
+    )
+    args = parser.parse_args()
+    ingest(
+        full=args.full,
+        split_workers=args.split_workers,
+        dedup_threshold=args.dedup_threshold,
+        batch_size=args.batch_size,
+        embed_concurrency=args.embed_concurrency,
+        max_in_flight=args.max_in_flight,
+    )
@@ -0,0 +1,202 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+from typing import Any, Dict, Optional
+
+from dotenv import load_dotenv
+from langchain_tavily import TavilySearch
+
+load_dotenv()
+
+# Tavily is the slowest call we make and it is rate limited, yet the same queries come back all the
+# time. CachedTavilySearch is a drop-in TavilySearch that keeps each search result in SQLite, keyed by
+# the normalized query and every setting that changes the results (max_results, topic, domains, ...).
+# One file can be shared by every worker process. Entries expire after their TTL, web results go
+# stale, and the least recently used ones are evicted above max_entries. Failed searches are never
+# cached. Set SEARCH_CACHE_PATH to an empty string to disable it.
+SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH", "./.cache/search.sqlite")
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", 6 * 3600))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", 10_000))
+# evict down to this fraction of max_entries so we don't evict again on the very next insert
+EVICT_TO = 0.9
+# last_used is only rewritten when it is older than this, so hits on popular entries don't turn
+# every read into a write; eviction order is only needed to this precision
+TOUCH_INTERVAL = 600
+
+# TavilySearch settings that change what a search returns and can only be set on the tool
+TOOL_SETTINGS = (
+    "max_results",
+    "include_answer",
+    "include_raw_content",
+    "include_image_descriptions",
+    "include_favicon",
+    "auto_parameters",
+    "country",
+    "exact_match",
+)
+# settings a call can also pass, TavilySearch._run only uses the call's value when the tool's is unset
+CALL_SETTINGS = (
+    "topic",
+    "search_depth",
+    "include_domains",
+    "exclude_domains",
+    "time_range",
+    "include_images",
+)
+
+
+def normalize_query(query: str) -> str:
+    """Lower-case, collapse whitespace and drop trailing punctuation, so near-identical queries match."""
+    return " ".join(query.lower().split()).rstrip("?!. ")
+
+
+class SearchCache:
+    """Persistent, LRU and TTL bounded store of search results shared across processes."""
+
+    def __init__(self, path: str, max_entries: int = SEARCH_CACHE_MAX_ENTRIES) -> None:
+        """
+        Args:
+            path (str): SQLite file of the cache, created if missing
+            max_entries (int): Number of results above which the least recently used are evicted
+        """
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        # searches run from worker threads, so one connection is shared behind a lock
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        # WAL lets several processes read while one writes
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS searches (
+                key TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                expires REAL NOT NULL,
+                last_used REAL NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS searches_last_used ON searches (last_used)")
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM searches").fetchone()[0]
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """The stored search result for key, if it has not expired."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result, expires, last_used FROM searches WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or row[1] <= now:
+                self.misses += 1
+                return None
+            if row[2] < now - TOUCH_INTERVAL:
+                self._conn.execute("UPDATE searches SET last_used = ? WHERE key = ?", (now, key))
+                self._conn.commit()
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, key: str, result: Dict[str, Any], ttl: float = SEARCH_CACHE_TTL) -> None:
+        """Store a search result for ttl seconds."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO searches VALUES (?, ?, ?, ?)",
+                (key, json.dumps(result), now + ttl, now),
+            )
+            self._conn.commit()
+            self._count += 1
+            if self._count > self.max_entries:
+                self._evict()
+
+    def _evict(self) -> None:
+        self._conn.execute("DELETE FROM searches WHERE expires <= ?", (time.time(),))
+        # other processes write to the same file, so recount before deciding how much to drop
+        self._count = self._conn.execute("SELECT COUNT(*) FROM searches").fetchone()[0]
+        excess = self._count - int(self.max_entries * EVICT_TO)
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM searches WHERE key IN "
+                "(SELECT key FROM searches ORDER BY last_used LIMIT ?)",
+                (excess,),
+            )
+            self._count -= excess
+        self._conn.commit()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        """Hits, misses and hit rate of this process, and the entries in the shared file."""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM searches").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "entries": entries,
+        }
+
+
+@lru_cache(maxsize=None)
+def get_search_cache() -> Optional[SearchCache]:
+    """The shared search cache, opened on first use so importing the tools stays cheap."""
+    if not SEARCH_CACHE_PATH:
+        return None
+    return SearchCache(SEARCH_CACHE_PATH)
+
+
+class CachedTavilySearch(TavilySearch):
+    """TavilySearch that answers repeated queries from the search cache."""
+
+    # seconds a result of this tool is reused
+    cache_ttl: float = SEARCH_CACHE_TTL
+
+    def _cache_key(self, query: str, kwargs: Dict[str, Any]) -> str:
+        settings = {name: getattr(self, name, None) for name in TOOL_SETTINGS}
+        # the key holds what is actually sent: like TavilySearch._run, a setting made on the tool
+        # wins over the call's argument, and the other arguments (start_date, ...) are passed as is
+        for name in CALL_SETTINGS:
+            settings[name] = getattr(self, name, None) or kwargs.get(name)
+        settings.update(
+            {
+                name: value
+                for name, value in kwargs.items()
+                if name not in CALL_SETTINGS and value is not None
+            }
+        )
+        key = json.dumps([normalize_query(query), settings], sort_keys=True, default=str)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _run(self, query: str, run_manager: Any = None, **kwargs: Any) -> Dict[str, Any]:
+        cache = get_search_cache()
+        if cache is None:
+            return super()._run(query, run_manager=run_manager, **kwargs)
+        key = self._cache_key(query, kwargs)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+        result = super()._run(query, run_manager=run_manager, **kwargs)
+        # TavilySearch reports failures as {"error": ...}, those are retried next time
+        if "error" not in result:
+            cache.put(key, result, self.cache_ttl)
+        return result
+
+    async def _arun(self, query: str, run_manager: Any = None, **kwargs: Any) -> Dict[str, Any]:
+        cache = get_search_cache()
+        if cache is None:
+            return await super()._arun(query, run_manager=run_manager, **kwargs)
+        key = self._cache_key(query, kwargs)
+        # SQLite calls block, so they run in a worker thread instead of on the event loop
+        cached = await asyncio.to_thread(cache.get, key)
+        if cached is not None:
+            return cached
+        result = await super()._arun(query, run_manager=run_manager, **kwargs)
+        if "error" not in result:
+            await asyncio.to_thread(cache.put, key, result, self.cache_ttl)
+        return result
@@ -3,13 +3,13 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from langchain_core.tools import StructuredTool
-from langchain_tavily import TavilySearch
 from langgraph.prebuilt import ToolNode
 
 from schemas import AnswerQuestion, ReviseAnswer
+from search_cache import CachedTavilySearch
 
-# get five results back
-tavily_tool = TavilySearch(max_results=5)
+# get five results back, queries that were searched before are answered from the search cache
+tavily_tool = CachedTavilySearch(max_results=5)
 
 def run_queries(search_queries: list[str], **kwargs):
     """Run the generated queries."""